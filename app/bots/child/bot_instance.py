@@ -1,34 +1,40 @@
 # app/bots/child/bot_instance.py
 from __future__ import annotations
 
+from dataclasses import dataclass
+from datetime import datetime, timedelta
 from pathlib import Path
 from typing import Dict, Tuple, Optional, List
 
 import asyncio
 import hashlib
 import hmac
+import html
 import json
 import re
+import time
 from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
 
-from aiogram import Bot, Dispatcher, Router, F
-from aiogram.client.default import DefaultBotProperties
+from aiogram import BaseMiddleware, Bot, Router, F
 from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.filters import Command, StateFilter
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import (
     Message,
     CallbackQuery,
+    ChatMemberUpdated,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     FSInputFile,
+    TelegramObject,
     WebAppInfo,
 )
-from sqlalchemy import select, func, or_, cast, String
+from sqlalchemy import select, func, or_, cast, String, tuple_, bindparam
+from sqlalchemy.exc import NoResultFound
 
 from app.db import SessionLocal
+from app.membership import is_member, note_chat_member
 from app.models import (
     Tenant,
     UserAccess,
@@ -36,8 +42,17 @@ from app.models import (
     UserState,
     Event,
     ContentOverride,
+    AssetFileId,
+    Broadcast,
 )
 from app.settings import settings
+from app.bots.child.broadcast import (
+    RECURRENCE, broadcasts, cancel_broadcast, count_recipients, create_broadcast, fmt_local,
+    kb_bc_progress, parse_send_at, scheduled_broadcasts, scheduler,
+)
+from app.stats import bump_daily, daily_trend, format_trend, user_stats
+from app.tenant_config import TenantConfig, get_tenant_config, invalidate_tenant
+from app.utils.logging import logger
 
 # =========================
 #            i18n
@@ -327,6 +342,7 @@ async def ensure_click_id(tenant_id: int, user_id: int) -> str:
                     tenant_id=tenant_id, user_id=user_id, click_id=cid
                 )
             )
+            await bump_daily(s, tenant_id, new_users=1)
         elif not ua.click_id:
             await s.execute(
                 UserAccess.__table__.update().where(UserAccess.id == ua.id).values(click_id=cid)
@@ -377,10 +393,11 @@ async def has_lang_set(tenant_id: int, user_id: int) -> bool:
         )
         return res.scalar_one_or_none() is not None
 
-async def get_tenant(tenant_id: int) -> Tenant:
-    async with SessionLocal() as s:
-        res = await s.execute(select(Tenant).where(Tenant.id == tenant_id))
-        return res.scalar_one()
+async def get_tenant(tenant_id: int) -> TenantConfig:
+    cfg = await get_tenant_config(tenant_id)
+    if cfg is None:
+        raise NoResultFound(f"tenant {tenant_id} not found")
+    return cfg
 
 async def get_or_create_access(tenant_id: int, user_id: int) -> UserAccess:
     async with SessionLocal() as s:
@@ -400,6 +417,7 @@ async def get_or_create_access(tenant_id: int, user_id: int) -> UserAccess:
                     platinum_shown=False,
                 )
             )
+            await bump_daily(s, tenant_id, new_users=1)
             await s.commit()
             res = await s.execute(
                 select(UserAccess).where(UserAccess.tenant_id == tenant_id, UserAccess.user_id == user_id)
@@ -407,13 +425,69 @@ async def get_or_create_access(tenant_id: int, user_id: int) -> UserAccess:
             acc = res.scalar_one()
         return acc
 
+# =========================
+#   Per-update user context
+# =========================
+@dataclass
+class UserContext:
+    """
+    Всё, что хендлерам нужно о тенанте и пользователе, — загружается один раз на апдейт
+    (UserContextMiddleware) и приходит в хендлер аргументом `ctx: UserContext`.
+    """
+    tenant_id: int
+    user_id: int
+    tenant: TenantConfig
+    access: Optional[UserAccess]
+    lang_row: Optional[str]
+
+    @property
+    def lang(self) -> str:
+        return self.lang_row or settings.LANG_DEFAULT
+
+    @property
+    def lang_set(self) -> bool:
+        return self.lang_row is not None
+
+    @property
+    def is_owner(self) -> bool:
+        return self.tenant.owner_telegram_id == self.user_id
+
+    @property
+    def support_url(self) -> str:
+        return self.tenant.support_url or settings.SUPPORT_URL
+
+    async def ensure_access(self) -> UserAccess:
+        if self.access is None:
+            self.access = await get_or_create_access(self.tenant_id, self.user_id)
+        return self.access
+
+
+async def load_user_context(tenant_id: int, user_id: int) -> UserContext:
+    tenant = await get_tenant(tenant_id)
+    async with SessionLocal() as s:
+        access = (await s.execute(
+            select(UserAccess).where(UserAccess.tenant_id == tenant_id, UserAccess.user_id == user_id)
+        )).scalar_one_or_none()
+        lang_row = (await s.execute(
+            select(UserLang.lang).where(UserLang.tenant_id == tenant_id, UserLang.user_id == user_id)
+        )).scalar_one_or_none()
+    return UserContext(tenant_id, user_id, tenant, access, lang_row)
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """Кладёт в data['ctx'] контекст пользователя, если у апдейта есть tenant_id и from_user."""
+
+    async def __call__(self, handler, event: TelegramObject, data: dict):
+        user = data.get("event_from_user")
+        tenant_id = data.get("tenant_id")
+        if user is not None and tenant_id is not None:
+            data["ctx"] = await load_user_context(tenant_id, user.id)
+        return await handler(event, data)
+
 async def mark_unlocked_shown(tenant_id: int, user_id: int):
+    # «Доступ открыт» не удаляем следующим экраном
+    await set_last_bot_message_id(tenant_id, user_id, None)
     async with SessionLocal() as s:
-        await s.execute(
-            UserState.__table__.update()
-            .where(UserState.tenant_id == tenant_id, UserState.chat_id == user_id)
-            .values(last_bot_message_id=None)
-        )
         await s.execute(
             UserAccess.__table__.update()
             .where(UserAccess.tenant_id == tenant_id, UserAccess.user_id == user_id)
@@ -430,7 +504,44 @@ async def mark_platinum_shown(tenant_id: int, user_id: int):
         )
         await s.commit()
 
-async def set_last_bot_message_id(tenant_id: int, chat_id: int, message_id: Optional[int]):
+# -------- last bot message (write-behind) --------
+# Процесс детей включает write-behind: id последнего сообщения живёт в памяти (_LAST_MSG,
+# грузится лениво), новые значения уходят в user_state пачками по таймеру и при остановке.
+# Остальные процессы (postbacks-пушер) пишут/читают БД напрямую; их записи попадают в память
+# через sync_last_message_ids() — раз в LAST_MSG_SYNC_SEC один запрос «что изменилось с прошлого
+# раза» по user_state.updated_at на весь процесс. Более свежее значение побеждает в обе стороны:
+# пачка не затирает запись пушера, синк не затирает нашу более позднюю.
+_LAST_MSG_WRITE_BEHIND = False
+# key -> (message_id, момент значения (UTC), monotonic последнего обращения)
+_LAST_MSG: Dict[Tuple[int, int], Tuple[Optional[int], datetime, float]] = {}
+_LAST_MSG_DIRTY: Dict[Tuple[int, int], Tuple[Optional[int], datetime]] = {}  # key -> (message_id, set_at)
+_LAST_MSG_FLUSH_LOCK = asyncio.Lock()
+_LAST_MSG_SYNCED_TO: Optional[datetime] = None   # updated_at, до которого изменения уже применены
+_LAST_MSG_SYNC_OVERLAP = timedelta(seconds=5)    # запас на записи, закоммиченные позже своего updated_at
+
+
+def enable_last_message_write_behind():
+    global _LAST_MSG_WRITE_BEHIND, _LAST_MSG_SYNCED_TO
+    _LAST_MSG_WRITE_BEHIND = True
+    _LAST_MSG_SYNCED_TO = datetime.utcnow()
+
+
+async def _db_last_bot_message(tenant_id: int, chat_id: int) -> Optional[Tuple[Optional[int], Optional[datetime]]]:
+    async with SessionLocal() as s:
+        res = await s.execute(
+            select(UserState.last_bot_message_id, UserState.updated_at)
+            .where(UserState.tenant_id == tenant_id, UserState.chat_id == chat_id)
+        )
+        row = res.first()
+        return (row[0], row[1]) if row else None
+
+
+async def _db_get_last_bot_message_id(tenant_id: int, chat_id: int) -> Optional[int]:
+    row = await _db_last_bot_message(tenant_id, chat_id)
+    return row[0] if row else None
+
+
+async def _db_set_last_bot_message_id(tenant_id: int, chat_id: int, message_id: Optional[int]):
     async with SessionLocal() as s:
         res = await s.execute(
             select(UserState).where(UserState.tenant_id == tenant_id, UserState.chat_id == chat_id)
@@ -448,27 +559,197 @@ async def set_last_bot_message_id(tenant_id: int, chat_id: int, message_id: Opti
             )
         await s.commit()
 
+
+async def set_last_bot_message_id(tenant_id: int, chat_id: int, message_id: Optional[int]):
+    if not _LAST_MSG_WRITE_BEHIND:
+        await _db_set_last_bot_message_id(tenant_id, chat_id, message_id)
+        return
+    key = (tenant_id, chat_id)
+    now = datetime.utcnow()
+    _LAST_MSG[key] = (message_id, now, time.monotonic())
+    _LAST_MSG_DIRTY[key] = (message_id, now)
+    if len(_LAST_MSG_DIRTY) >= settings.LAST_MSG_FLUSH_BATCH and not _LAST_MSG_FLUSH_LOCK.locked():
+        asyncio.create_task(flush_last_message_ids())
+
+
 async def get_last_bot_message_id(tenant_id: int, chat_id: int) -> Optional[int]:
+    if not _LAST_MSG_WRITE_BEHIND:
+        return await _db_get_last_bot_message_id(tenant_id, chat_id)
+    key = (tenant_id, chat_id)
+    hit = _LAST_MSG.get(key)
+    if hit is not None:
+        _LAST_MSG[key] = (hit[0], hit[1], time.monotonic())
+        return hit[0]
+    row = await _db_last_bot_message(tenant_id, chat_id)
+    message_id, at = row if row else (None, None)
+    hit = _LAST_MSG.get(key)
+    if hit is not None:
+        return hit[0]   # пока читали БД, значение уже поставили (set или синк) — оно новее
+    _LAST_MSG[key] = (message_id, at or datetime.min, time.monotonic())
+    return message_id
+
+
+async def sync_last_message_ids() -> int:
+    """
+    Подтягивает в память записи других процессов (пушера): строки user_state, изменённые
+    с прошлого синка. Применяются только к уже загруженным ключам и только если они новее.
+    Заодно выбрасывает из памяти ключи, к которым давно не обращались.
+    """
+    global _LAST_MSG_SYNCED_TO
+    if not _LAST_MSG_WRITE_BEHIND:
+        return 0
+    since = (_LAST_MSG_SYNCED_TO or datetime.utcnow()) - _LAST_MSG_SYNC_OVERLAP
     async with SessionLocal() as s:
         res = await s.execute(
-            select(UserState).where(UserState.tenant_id == tenant_id, UserState.chat_id == chat_id)
+            select(UserState.tenant_id, UserState.chat_id, UserState.last_bot_message_id, UserState.updated_at)
+            .where(UserState.updated_at > since)
         )
-        st = res.scalar_one_or_none()
-        return st.last_bot_message_id if st else None
+        rows = res.all()
+    applied = 0
+    for tid, chat_id, message_id, at in rows:
+        if at is None:
+            continue
+        if _LAST_MSG_SYNCED_TO is None or at > _LAST_MSG_SYNCED_TO:
+            _LAST_MSG_SYNCED_TO = at
+        key = (tid, chat_id)
+        hit = _LAST_MSG.get(key)
+        if hit is None or at <= hit[1]:
+            continue    # не загружен (прочитается лениво) или у нас не старее
+        _LAST_MSG[key] = (message_id, at, hit[2])
+        dirty = _LAST_MSG_DIRTY.get(key)
+        if dirty is not None and dirty[1] < at:
+            _LAST_MSG_DIRTY.pop(key, None)  # наша несброшенная запись устарела
+        applied += 1
+
+    now = time.monotonic()
+    for key in [k for k, (_, _, used) in _LAST_MSG.items()
+                if now - used >= settings.LAST_MSG_CACHE_TTL and k not in _LAST_MSG_DIRTY]:
+        _LAST_MSG.pop(key, None)
+    return applied
+
+
+async def flush_last_message_ids():
+    """Пишет накопленные id в user_state: один SELECT и пачка UPDATE/INSERT."""
+    async with _LAST_MSG_FLUSH_LOCK:
+        if not _LAST_MSG_DIRTY:
+            return
+        # из _LAST_MSG_DIRTY убираем только после коммита: упавший flush повторится со следующим
+        batch = dict(_LAST_MSG_DIRTY)
+        async with SessionLocal() as s:
+            existing: Dict[Tuple[int, int], int] = {}
+            keys = list(batch)
+            for i in range(0, len(keys), 500):
+                res = await s.execute(
+                    select(UserState.id, UserState.tenant_id, UserState.chat_id).where(
+                        tuple_(UserState.tenant_id, UserState.chat_id).in_(keys[i:i + 500])
+                    )
+                )
+                existing.update({(r.tenant_id, r.chat_id): r.id for r in res.all()})
+
+            upd = [
+                {"_id": existing[k], "_ts": ts, "mid": mid}
+                for k, (mid, ts) in batch.items() if k in existing
+            ]
+            ins = [
+                {"tenant_id": k[0], "chat_id": k[1], "last_bot_message_id": mid, "updated_at": ts}
+                for k, (mid, ts) in batch.items() if k not in existing
+            ]
+            if upd:
+                await s.execute(
+                    UserState.__table__.update()
+                    .where(
+                        UserState.id == bindparam("_id"),
+                        or_(UserState.updated_at.is_(None), UserState.updated_at <= bindparam("_ts")),
+                    )
+                    .values(last_bot_message_id=bindparam("mid"), updated_at=bindparam("_ts")),
+                    upd,
+                )
+            if ins:
+                await s.execute(UserState.__table__.insert(), ins)
+            await s.commit()
+        for k, v in batch.items():
+            if _LAST_MSG_DIRTY.get(k) is v:   # не перезаписан, пока шёл flush
+                _LAST_MSG_DIRTY.pop(k, None)
+
+
+async def run_last_message_flusher():
+    next_flush = time.monotonic() + settings.LAST_MSG_FLUSH_SEC
+    while True:
+        await asyncio.sleep(settings.LAST_MSG_SYNC_SEC)
+        try:
+            await sync_last_message_ids()
+        except Exception as e:
+            logger.exception(f"last_bot_message_id sync error: {e}")
+        if time.monotonic() >= next_flush:
+            next_flush = time.monotonic() + settings.LAST_MSG_FLUSH_SEC
+            try:
+                await flush_last_message_ids()
+            except Exception as e:
+                logger.exception(f"last_bot_message_id flush error: {e}")
 
 # -------- content overrides --------
-async def resolve_title(tenant_id: int, lang: str, screen: str) -> str:
+@dataclass(frozen=True)
+class ScreenContent:
+    """Всё, что нужно для отрисовки экрана: кастом из ContentOverride поверх дефолтов."""
+    title: str
+    body: Optional[str]                 # body_html кастома (None = дефолтный текст экрана)
+    buttons: dict                       # провалидированные подписи кнопок
+    primary_btn_text: Optional[str]
+    image: Optional[str]                # file_id / путь кастомной картинки
+
+
+# tenant_id -> (loaded_at, {(lang, screen): snapshot})
+# Грузим все оверрайды тенанта одним запросом; сбрасывается в upsert_override().
+# TTL — чтобы другие процессы (postbacks) увидели правки админа.
+_CONTENT_CACHE: Dict[int, Tuple[float, Dict[Tuple[str, str], dict]]] = {}
+
+
+def invalidate_content(tenant_id: int):
+    _CONTENT_CACHE.pop(tenant_id, None)
+
+
+def _pick_override_image_value(ov: ContentOverride) -> Optional[str]:
+    for name in ("image_path", "image", "photo_id", "photo_file_id"):
+        val = getattr(ov, name, None)
+        if val:
+            return val
+    return None
+
+
+def _parse_buttons(screen: str, raw) -> dict:
+    if not raw:
+        return {}
+    try:
+        data = raw if isinstance(raw, dict) else json.loads(raw)
+    except Exception:
+        return {}
+    clean, _ = validate_buttons(screen, data if isinstance(data, dict) else {})
+    return clean
+
+
+async def _tenant_overrides(tenant_id: int) -> Dict[Tuple[str, str], dict]:
+    now = time.monotonic()
+    hit = _CONTENT_CACHE.get(tenant_id)
+    if hit and now - hit[0] < settings.CONTENT_CACHE_TTL:
+        return hit[1]
     async with SessionLocal() as s:
-        r = await s.execute(
-            select(ContentOverride)
-            .where(ContentOverride.tenant_id == tenant_id,
-                   ContentOverride.lang == lang,
-                   ContentOverride.screen == screen)
-        )
-        ov = r.scalar_one_or_none()
-        if ov and getattr(ov, "title", None):
-            return ov.title
-    # fallback
+        r = await s.execute(select(ContentOverride).where(ContentOverride.tenant_id == tenant_id))
+        rows = r.scalars().all()
+    data = {
+        (ov.lang, ov.screen): {
+            "title": ov.title or None,
+            "body": ov.body_html or None,
+            "buttons": _parse_buttons(ov.screen, ov.buttons_json),
+            "primary_btn_text": ov.primary_btn_text or None,
+            "image": _pick_override_image_value(ov),
+        }
+        for ov in rows
+    }
+    _CONTENT_CACHE[tenant_id] = (now, data)
+    return data
+
+
+def _default_title(lang: str, screen: str) -> str:
     if screen == "menu":
         return t(lang, "menu_title")
     if screen == "howto":
@@ -489,6 +770,29 @@ async def resolve_title(tenant_id: int, lang: str, screen: str) -> str:
         return t(lang, "lang_title")
     return screen
 
+
+def _default_primary_btn_text(lang: str, screen: str) -> Optional[str]:
+    if screen == "menu":
+        return t(lang, "btn_signal")
+    if screen == "howto":
+        return t(lang, "btn_open_app")
+    return None
+
+
+async def resolve_screen(tenant_id: int, lang: str, screen: str) -> ScreenContent:
+    ov = (await _tenant_overrides(tenant_id)).get((lang, screen)) or {}
+    return ScreenContent(
+        title=ov.get("title") or _default_title(lang, screen),
+        body=ov.get("body"),
+        buttons=dict(ov.get("buttons") or {}),
+        primary_btn_text=ov.get("primary_btn_text") or _default_primary_btn_text(lang, screen),
+        image=ov.get("image"),
+    )
+
+
+async def resolve_title(tenant_id: int, lang: str, screen: str) -> str:
+    return (await resolve_screen(tenant_id, lang, screen)).title
+
 def _render_template(src: str, ctx: dict) -> str:
     def repl(m):
         key = m.group(1).strip()
@@ -496,75 +800,17 @@ def _render_template(src: str, ctx: dict) -> str:
     return re.sub(r"\{\{\s*([^}]+)\s*\}\}", repl, src or "")
 
 async def resolve_body(tenant_id: int, lang: str, screen: str) -> Optional[str]:
-    async with SessionLocal() as s:
-        r = await s.execute(
-            select(ContentOverride)
-            .where(ContentOverride.tenant_id == tenant_id,
-                   ContentOverride.lang == lang,
-                   ContentOverride.screen == screen)
-        )
-        ov = r.scalar_one_or_none()
-        if ov and getattr(ov, "body_html", None):
-            return ov.body_html
-    return None
+    return (await resolve_screen(tenant_id, lang, screen)).body
 
 async def resolve_primary_btn_text(tenant_id: int, lang: str, screen: str) -> Optional[str]:
     # текст главной кнопки (legacy)
-    async with SessionLocal() as s:
-        r = await s.execute(
-            select(ContentOverride)
-            .where(ContentOverride.tenant_id == tenant_id,
-                   ContentOverride.lang == lang,
-                   ContentOverride.screen == screen)
-        )
-        ov = r.scalar_one_or_none()
-        if ov and getattr(ov, "primary_btn_text", None):
-            return ov.primary_btn_text
-    if screen == "menu":
-        return t(lang, "btn_signal")
-    if screen == "howto":
-        return t(lang, "btn_open_app")
-    return None
-
-def _pick_override_image_value(ov: ContentOverride) -> Optional[str]:
-    for name in ("image_path", "image", "photo_id", "photo_file_id"):
-        val = getattr(ov, name, None)
-        if val:
-            return val
-    return None
+    return (await resolve_screen(tenant_id, lang, screen)).primary_btn_text
 
 async def resolve_image(tenant_id: int, lang: str, screen: str) -> Optional[str]:
-    async with SessionLocal() as s:
-        r = await s.execute(
-            select(ContentOverride)
-            .where(ContentOverride.tenant_id == tenant_id,
-                   ContentOverride.lang == lang,
-                   ContentOverride.screen == screen)
-        )
-        ov = r.scalar_one_or_none()
-        if ov:
-            return _pick_override_image_value(ov)
-    return None
+    return (await resolve_screen(tenant_id, lang, screen)).image
 
 async def resolve_buttons(tenant_id: int, lang: str, screen: str) -> dict:
-    async with SessionLocal() as s:
-        r = await s.execute(
-            select(ContentOverride)
-            .where(ContentOverride.tenant_id == tenant_id,
-                   ContentOverride.lang == lang,
-                   ContentOverride.screen == screen)
-        )
-        ov = r.scalar_one_or_none()
-        if ov:
-            raw = getattr(ov, "buttons_json", None)
-            if raw:
-                try:
-                    data = raw if isinstance(raw, dict) else json.loads(raw)
-                except Exception:
-                    return {}
-                clean, _ = validate_buttons(screen, data if isinstance(data, dict) else {})
-                return clean
-    return {}
+    return (await resolve_screen(tenant_id, lang, screen)).buttons
 
 def button_text(buttons: dict, key: str, default: str) -> str:
     val = buttons.get(key)
@@ -603,6 +849,7 @@ async def upsert_override(
             if ov:
                 await s.delete(ov)
             await s.commit()
+            invalidate_content(tenant_id)
             return
 
         raw_vals = {}
@@ -653,6 +900,94 @@ async def upsert_override(
             base = {"tenant_id": tenant_id, "lang": lang, "screen": screen}
             await s.execute(table.insert().values(**base, **vals))
         await s.commit()
+    invalidate_content(tenant_id)
+
+
+# -------- file_id cache for local images --------
+# path -> (mtime, size, sha256): хэш пересчитываем, только если файл поменялся
+_ASSET_DIGESTS: Dict[str, Tuple[float, int, str]] = {}
+# (bot_id, path, sha256) -> file_id
+_FILE_IDS: Dict[Tuple[int, str, str], str] = {}
+
+
+def _asset_digest(path: Path) -> str:
+    st = path.stat()
+    key = str(path)
+    hit = _ASSET_DIGESTS.get(key)
+    if hit and hit[0] == st.st_mtime and hit[1] == st.st_size:
+        return hit[2]
+    digest = hashlib.sha256(path.read_bytes()).hexdigest()
+    _ASSET_DIGESTS[key] = (st.st_mtime, st.st_size, digest)
+    return digest
+
+
+async def _get_file_id(bot_id: int, path: str, digest: str) -> Optional[str]:
+    key = (bot_id, path, digest)
+    if key in _FILE_IDS:
+        return _FILE_IDS[key]
+    async with SessionLocal() as s:
+        res = await s.execute(
+            select(AssetFileId.file_id).where(
+                AssetFileId.bot_id == bot_id, AssetFileId.path == path, AssetFileId.sha256 == digest
+            )
+        )
+        file_id = res.scalar_one_or_none()
+    if file_id:
+        _FILE_IDS[key] = file_id
+    return file_id
+
+
+async def _set_file_id(bot_id: int, path: str, digest: str, file_id: Optional[str]):
+    """file_id=None — забыть (Telegram его не принял)."""
+    if file_id:
+        _FILE_IDS[(bot_id, path, digest)] = file_id
+    else:
+        _FILE_IDS.pop((bot_id, path, digest), None)
+    async with SessionLocal() as s:
+        # старые версии файла больше не нужны
+        await s.execute(
+            AssetFileId.__table__.delete().where(AssetFileId.bot_id == bot_id, AssetFileId.path == path)
+        )
+        if file_id:
+            await s.execute(
+                AssetFileId.__table__.insert().values(bot_id=bot_id, path=path, sha256=digest, file_id=file_id)
+            )
+        await s.commit()
+
+
+# Ответы Telegram, по которым закэшированный file_id действительно не годится (остальные BadRequest —
+# длинная подпись, нет чата и т.п. — к файлу отношения не имеют и пробрасываются как есть)
+_STALE_FILE_ID_ERRORS = (
+    "wrong file identifier", "wrong remote file identifier", "file_id_invalid", "invalid file_id",
+    "wrong file_id", "file reference", "can't use file of type",
+)
+
+
+def _is_stale_file_id(exc: TelegramBadRequest) -> bool:
+    msg = str(exc.message or exc).lower()
+    return any(m in msg for m in _STALE_FILE_ID_ERRORS)
+
+
+async def _send_local_photo(bot: Bot, chat_id: int, path: Path, caption: str,
+                            kb: Optional[InlineKeyboardMarkup]):
+    """Шлёт локальный файл по закэшированному file_id, заливает с диска только первый раз."""
+    digest = _asset_digest(path)
+    key = str(path)
+    file_id = await _get_file_id(bot.id, key, digest)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id, photo=file_id, caption=caption, reply_markup=kb)
+        except TelegramBadRequest as e:
+            if not _is_stale_file_id(e):
+                raise
+            await _set_file_id(bot.id, key, digest, None)
+    msg = await bot.send_photo(chat_id, photo=FSInputFile(key), caption=caption, reply_markup=kb)
+    if msg.photo:
+        try:
+            await _set_file_id(bot.id, key, digest, msg.photo[-1].file_id)
+        except Exception:
+            pass
+    return msg
 
 
 # -------- common send --------
@@ -674,19 +1009,25 @@ async def send_screen(
 
     custom = await resolve_image(tenant_id, lang, screen)
     photo = None
+    local = None
     if custom:
         p = Path(custom)
-        photo = FSInputFile(str(p)) if p.exists() else custom
+        if p.exists():
+            local = p
+        else:
+            photo = custom
+    else:
+        p = asset_for(lang, screen)
+        if p and p.exists():
+            local = p
 
     try:
         if photo:
             msg = await bot.send_photo(chat_id, photo=photo, caption=text, reply_markup=kb)
+        elif local:
+            msg = await _send_local_photo(bot, chat_id, local, text, kb)
         else:
-            p = asset_for(lang, screen)
-            if p and p.exists():
-                msg = await bot.send_photo(chat_id, photo=FSInputFile(str(p)), caption=text, reply_markup=kb)
-            else:
-                msg = await bot.send_message(chat_id, text=text, reply_markup=kb, disable_web_page_preview=True)
+            msg = await bot.send_message(chat_id, text=text, reply_markup=kb, disable_web_page_preview=True)
     except TelegramBadRequest:
         msg = await bot.send_message(chat_id, text=text, reply_markup=kb, disable_web_page_preview=True)
 
@@ -694,12 +1035,13 @@ async def send_screen(
 
 # -------- metrics --------
 async def user_deposit_sum(tid: int, click_id: str) -> float:
+    # накопительная сумма на UserAccess (ведётся постбэками), а не SUM по events
     async with SessionLocal() as s:
         val = (await s.execute(
-            select(func.coalesce(func.sum(Event.amount), 0.0)).where(
-                Event.tenant_id == tid, Event.click_id == click_id, Event.kind.in_(("ftd", "rd"))
+            select(UserAccess.deposit_total).where(
+                UserAccess.tenant_id == tid, UserAccess.click_id == click_id
             )
-        )).scalar()
+        )).scalar_one_or_none()
         return float(val or 0.0)
 
 # =========================
@@ -879,8 +1221,7 @@ async def check_membership(bot: Bot, channel_id: Optional[int], user_id: int) ->
     if not channel_id:
         return False
     try:
-        member = await bot.get_chat_member(channel_id, user_id)
-        return getattr(member, "status", None) in {"creator", "administrator", "member"}
+        return await is_member(bot, channel_id, user_id)
     except Exception:
         return False
 
@@ -889,42 +1230,32 @@ async def _auto_check_after_subscribe(bot: Bot, tenant_id: int, user_id: int, ch
     if await check_membership(bot, (await get_tenant(tenant_id)).gate_channel_id, user_id):
         await route_signal(bot, tenant_id, user_id, chat_id, lang)
 
-async def route_signal(bot: Bot, tenant_id: int, user_id: int, chat_id: int, lang: str):
-    async with SessionLocal() as s:
-        t_res = await s.execute(select(Tenant).where(Tenant.id == tenant_id))
-        tenant = t_res.scalar_one()
-        a_res = await s.execute(
-            select(UserAccess).where(UserAccess.tenant_id == tenant_id, UserAccess.user_id == user_id)
-        )
-        access = a_res.scalar_one_or_none()
-        if access is None:
-            await s.execute(
-                UserAccess.__table__.insert().values(
-                    tenant_id=tenant_id,
-                    user_id=user_id,
-                    is_registered=False,
-                    has_deposit=False,
-                    unlocked_shown=False,
-                    is_platinum=False,
-                    platinum_shown=False,
-                )
-            )
-            await s.commit()
-            a_res = await s.execute(
-                select(UserAccess).where(UserAccess.tenant_id == tenant_id, UserAccess.user_id == user_id)
-            )
-            access = a_res.scalar_one()
+async def route_signal(
+    bot: Bot,
+    tenant_id: int,
+    user_id: int,
+    chat_id: int,
+    lang: str,
+    tenant: Optional[TenantConfig] = None,
+    access: Optional[UserAccess] = None,
+):
+    # tenant/access можно передать из UserContext, тогда повторно их не грузим
+    if tenant is None:
+        tenant = await get_tenant(tenant_id)
+    if access is None:
+        access = await get_or_create_access(tenant_id, user_id)
 
     support_url = tenant.support_url or settings.SUPPORT_URL
 
     # 1) Подписка (если включена: None = включено)
     if tenant.check_subscription is not False:
         if not await check_membership(bot, tenant.gate_channel_id, user_id):
-            title = await resolve_title(tenant_id, lang, "subscribe")
-            body = await resolve_body(tenant_id, lang, "subscribe")
+            content = await resolve_screen(tenant_id, lang, "subscribe")
+            title = content.title
+            body = content.body
             default = t(lang, 'gate_sub_text')
             text = f"<b>{title}</b>\n\n{body or default}"
-            btns = await resolve_buttons(tenant_id, lang, "subscribe")
+            btns = content.buttons
             await send_screen(bot, tenant_id, chat_id, lang, "subscribe", text,
                               kb_subscribe(lang, tenant.gate_channel_url, btns))
             asyncio.create_task(_auto_check_after_subscribe(bot, tenant_id, user_id, chat_id, lang))
@@ -932,14 +1263,15 @@ async def route_signal(bot: Bot, tenant_id: int, user_id: int, chat_id: int, lan
 
     # 2) Регистрация
     ref = tenant.ref_link or settings.REF_LINK
-    cid = await ensure_click_id(tenant_id, user_id)
+    cid = access.click_id or await ensure_click_id(tenant_id, user_id)
     ref_url = add_params(ref, click_id=cid, tid=tenant_id)
     if not access.is_registered:
-        title = await resolve_title(tenant_id, lang, "register")
-        body = await resolve_body(tenant_id, lang, "register")
+        content = await resolve_screen(tenant_id, lang, "register")
+        title = content.title
+        body = content.body
         default = t(lang, 'gate_reg_text')
         text = f"<b>{title}</b>\n\n{body or default}"
-        btns = await resolve_buttons(tenant_id, lang, "register")
+        btns = content.buttons
         await send_screen(bot, tenant_id, chat_id, lang, "register", text, kb_register(lang, ref_url, btns))
         return
 
@@ -948,7 +1280,7 @@ async def route_signal(bot: Bot, tenant_id: int, user_id: int, chat_id: int, lan
         dep = tenant.deposit_link or settings.DEPOSIT_LINK
         dep_url = add_params(dep, click_id=cid, tid=tenant_id)
 
-        total = await user_deposit_sum(tenant_id, cid)
+        total = float(access.deposit_total or 0.0)
         need = float(tenant.min_deposit_usd or 0.0)
 
         if total < need:
@@ -957,8 +1289,9 @@ async def route_signal(bot: Bot, tenant_id: int, user_id: int, chat_id: int, lan
 
             remain = max(need - total, 0.0)
 
-            title = await resolve_title(tenant_id, lang, "deposit")
-            body = await resolve_body(tenant_id, lang, "deposit")
+            content = await resolve_screen(tenant_id, lang, "deposit")
+            title = content.title
+            body = content.body
             default = t(lang, 'gate_dep_text')
 
             ctx = {"need": fmt(need), "total": fmt(total), "remain": fmt(remain)}
@@ -990,54 +1323,60 @@ async def route_signal(bot: Bot, tenant_id: int, user_id: int, chat_id: int, lan
                 body_text = default + hints.get(lang, "")
 
             text = f"<b>{title}</b>\n\n{body_text}"
-            btns = await resolve_buttons(tenant_id, lang, "deposit")
+            btns = content.buttons
             await send_screen(bot, tenant_id, chat_id, lang, "deposit", text, kb_deposit(lang, dep_url, btns))
             return
 
     # авто-Platinum
     threshold = float(tenant.platinum_threshold_usd or 500.0)
-    total_now = await user_deposit_sum(tenant_id, cid)
+    total_now = float(access.deposit_total or 0.0)
     if not access.is_platinum and total_now >= threshold:
         async with SessionLocal() as s:
-            await s.execute(
+            res = await s.execute(
                 UserAccess.__table__.update()
                 .where(
                     UserAccess.tenant_id == tenant_id,
                     UserAccess.user_id == user_id,
+                    UserAccess.is_platinum.isnot(True),
                 )
                 .values(is_platinum=True, platinum_shown=False)
             )
+            if res.rowcount:
+                await bump_daily(s, tenant_id, platinum_upgrades=1)
             await s.commit()
         access.is_platinum = True
         access.platinum_shown = False
 
     # Platinum уведомление
     if access.is_platinum and not access.platinum_shown:
-        title = await resolve_title(tenant_id, lang, "platinum")
-        body = await resolve_body(tenant_id, lang, "platinum")
+        content = await resolve_screen(tenant_id, lang, "platinum")
+        title = content.title
+        body = content.body
         default = t(lang, 'platinum_text')
         text = f"<b>{title}</b>\n\n{body or default}"
-        btns = await resolve_buttons(tenant_id, lang, "platinum")
+        btns = content.buttons
         await send_screen(bot, tenant_id, chat_id, lang, "platinum", text, kb_open_platinum(lang, support_url, btns))
         await mark_platinum_shown(tenant_id, user_id)
         return
 
     # “Доступ открыт”
     if not access.unlocked_shown:
-        title = await resolve_title(tenant_id, lang, "unlocked")
-        body = await resolve_body(tenant_id, lang, "unlocked")
+        content = await resolve_screen(tenant_id, lang, "unlocked")
+        title = content.title
+        body = content.body
         default = t(lang, 'unlocked_text')
         text = f"<b>{title}</b>\n\n{body or default}"
-        btns = await resolve_buttons(tenant_id, lang, "unlocked")
+        btns = content.buttons
         await send_screen(bot, tenant_id, chat_id, lang, "unlocked", text, kb_open_app(lang, support_url, btns))
         await mark_unlocked_shown(tenant_id, user_id)
         return
 
     # Меню
-    title = await resolve_title(tenant_id, lang, "menu")
-    body = await resolve_body(tenant_id, lang, "menu")
-    btn_labels = await resolve_buttons(tenant_id, lang, "menu")
-    menu_btn_text = await resolve_primary_btn_text(tenant_id, lang, "menu")
+    content = await resolve_screen(tenant_id, lang, "menu")
+    title = content.title
+    body = content.body
+    btn_labels = content.buttons
+    menu_btn_text = content.primary_btn_text
     text = f"<b>{title}</b>" + (f"\n\n{body}" if body else "")
     await send_screen(
         bot, tenant_id, chat_id, lang, "menu", text,
@@ -1223,6 +1562,7 @@ async def show_links_screen(bot: Bot, tenant_id: int, chat_id: int):
                 .values(pb_secret=new_secret)
             )
             await s.commit()
+            invalidate_tenant(tenant_id)
         tnt = await get_tenant(tenant_id)
 
     text = ("🔗 Ссылки\n\n"
@@ -1236,11 +1576,9 @@ async def show_links_screen(bot: Bot, tenant_id: int, chat_id: int):
     await send_screen(bot, tenant_id, chat_id, "ru", "admin", text, kb_links())
 
 async def show_params_screen(bot: Bot, tenant_id: int, chat_id: int):
-    async with SessionLocal() as s:
-        res = await s.execute(select(Tenant).where(Tenant.id == tenant_id))
-        tnt = res.scalar_one()
+    tnt = await get_tenant(tenant_id)
 
-    def kb_params(tnt_: Tenant) -> InlineKeyboardMarkup:
+    def kb_params(tnt_: TenantConfig) -> InlineKeyboardMarkup:
         mark_sub = "✅" if (tnt_.check_subscription or tnt_.check_subscription is None) else "❌"
         mark_dep = "✅" if (tnt_.check_deposit or tnt_.check_deposit is None) else "❌"
         rows = [
@@ -1262,11 +1600,12 @@ async def show_params_screen(bot: Bot, tenant_id: int, chat_id: int):
     await send_screen(bot, tenant_id, chat_id, "ru", "admin", "⚙️ Параметры", kb_params(tnt))
 
 async def show_content_editor(bot: Bot, tenant_id: int, chat_id: int, lang: str, screen: str):
-    title = await resolve_title(tenant_id, lang, screen)
-    btn_tx = await resolve_primary_btn_text(tenant_id, lang, screen) or "—"
-    img = await resolve_image(tenant_id, lang, screen)
-    body = await resolve_body(tenant_id, lang, screen)
-    btns = await resolve_buttons(tenant_id, lang, screen)
+    content = await resolve_screen(tenant_id, lang, screen)
+    title = content.title
+    btn_tx = content.primary_btn_text or "—"
+    img = content.image
+    body = content.body
+    btns = content.buttons
     text = (
         f"🧩 Редактор — {screen} ({lang.upper()})\n\n"
         f"Заголовок: <b>{title}</b>\n"
@@ -1290,7 +1629,7 @@ async def send_user_card(bot: Bot, tenant_id: int, chat_id: int, uid: int):
     if not ua:
         await bot.send_message(chat_id, "Пользователь не найден")
         return
-    dep_sum = await user_deposit_sum(tenant_id, ua.click_id or "")
+    dep_sum = float(ua.deposit_total or 0.0)
     lang = await get_lang(tenant_id, uid)
     username_line = (
         f'<a href="https://t.me/{ua.username}">@{ua.username}</a>' if ua.username else "—"
@@ -1311,15 +1650,23 @@ async def send_user_card(bot: Bot, tenant_id: int, chat_id: int, uid: int):
     await send_screen(bot, tenant_id, chat_id, "ru", "admin", text, kb_user_card(ua))
 
 # ---- Admin handlers
-def make_child_router(tenant_id: int) -> Router:
+def make_child_router() -> Router:
     router = Router()
+    router.message.outer_middleware(UserContextMiddleware())
+    router.callback_query.outer_middleware(UserContextMiddleware())
 
     # ---- public
     @router.message(Command("start"))
-    async def on_start(m: Message):
+    async def on_start(m: Message, tenant_id: int, ctx: UserContext):
         # Создаём/получаем запись пользователя и сохраним username
-        acc = await get_or_create_access(tenant_id, m.from_user.id)
-        if m.from_user.username:
+        acc = await ctx.ensure_access()
+        vals = {}
+        if m.from_user.username and m.from_user.username != acc.username:
+            vals["username"] = m.from_user.username
+        if acc.blocked_at is not None or acc.fail_count:
+            # пользователь вернулся — снова доставляем ему рассылки и пуши
+            vals.update(blocked_at=None, fail_count=0, last_error=None)
+        if vals:
             async with SessionLocal() as s:
                 await s.execute(
                     UserAccess.__table__.update()
@@ -1327,15 +1674,16 @@ def make_child_router(tenant_id: int) -> Router:
                         UserAccess.tenant_id == tenant_id,
                         UserAccess.user_id == m.from_user.id
                     )
-                    .values(username=m.from_user.username)
+                    .values(**vals)
                 )
                 await s.commit()
 
         # Если язык ещё не выбран — показываем экран выбора языка НА АНГЛИЙСКОМ и выходим
-        if not await has_lang_set(tenant_id, m.from_user.id):
+        if not ctx.lang_set:
             pick_lang = "en"  # <- принудительно английский для экрана выбора
-            title = await resolve_title(tenant_id, pick_lang, "lang")
-            body = await resolve_body(tenant_id, pick_lang, "lang")
+            content = await resolve_screen(tenant_id, pick_lang, "lang")
+            title = content.title
+            body = content.body
             default = t(pick_lang, "lang_text")  # "Choose your language:"
             text = f"<b>{title}</b>\n\n{body or default}"
             await send_screen(
@@ -1344,13 +1692,13 @@ def make_child_router(tenant_id: int) -> Router:
             return
 
         # Язык уже выбран — показываем меню как обычно
-        lang = await get_lang(tenant_id, m.from_user.id)
-        tnt = await get_tenant(tenant_id)
-        sup = tnt.support_url or settings.SUPPORT_URL
-        menu_btn = await resolve_primary_btn_text(tenant_id, lang, "menu")
-        title = await resolve_title(tenant_id, lang, "menu")
-        body = await resolve_body(tenant_id, lang, "menu")
-        btn_labels = await resolve_buttons(tenant_id, lang, "menu")
+        lang = ctx.lang
+        sup = ctx.support_url
+        content = await resolve_screen(tenant_id, lang, "menu")
+        menu_btn = content.primary_btn_text
+        title = content.title
+        body = content.body
+        btn_labels = content.buttons
         text = f"<b>{title}</b>" + (f"\n\n{body}" if body else "")
         await send_screen(
             m.bot, tenant_id, m.chat.id, lang, "menu", text,
@@ -1358,20 +1706,20 @@ def make_child_router(tenant_id: int) -> Router:
         )
 
     @router.message(Command("my_click"))
-    async def my_click(m: Message):
+    async def my_click(m: Message, tenant_id: int):
         cid = await ensure_click_id(tenant_id, m.from_user.id)
         await m.answer(f"Ваш click_id:\n<code>{cid}</code>")
 
     @router.callback_query(F.data == "menu")
-    async def cb_menu(c: CallbackQuery):
-        lang = await get_lang(tenant_id, c.from_user.id)
-        acc = await get_or_create_access(tenant_id, c.from_user.id)
-        tnt = await get_tenant(tenant_id)
-        sup = tnt.support_url or settings.SUPPORT_URL
-        menu_btn = await resolve_primary_btn_text(tenant_id, lang, "menu")
-        title = await resolve_title(tenant_id, lang, "menu")
-        body = await resolve_body(tenant_id, lang, "menu")
-        btn_labels = await resolve_buttons(tenant_id, lang, "menu")
+    async def cb_menu(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        lang = ctx.lang
+        acc = await ctx.ensure_access()
+        sup = ctx.support_url
+        content = await resolve_screen(tenant_id, lang, "menu")
+        menu_btn = content.primary_btn_text
+        title = content.title
+        body = content.body
+        btn_labels = content.buttons
         text = f"<b>{title}</b>" + (f"\n\n{body}" if body else "")
         await send_screen(
             c.bot, tenant_id, c.message.chat.id, lang, "menu", text,
@@ -1380,61 +1728,71 @@ def make_child_router(tenant_id: int) -> Router:
         await c.answer()
 
     @router.callback_query(F.data == "howto")
-    async def cb_howto(c: CallbackQuery):
-        lang = await get_lang(tenant_id, c.from_user.id)
-        tnt = await get_tenant(tenant_id)
-        sup = tnt.support_url or settings.SUPPORT_URL
-
-        ref = tnt.ref_link or settings.REF_LINK
-        title = await resolve_title(tenant_id, lang, "howto")
-        body_override = await resolve_body(tenant_id, lang, "howto")
+    async def cb_howto(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        lang = ctx.lang
+        sup = ctx.support_url
+
+        ref = ctx.tenant.ref_link or settings.REF_LINK
+        content = await resolve_screen(tenant_id, lang, "howto")
+        title = content.title
+        body_override = content.body
         body_default = build_howto_text(lang, ref)
         body = _render_template(body_override or body_default, {"ref": _render_ref_anchor(ref)})
 
         text = f"<b>{title}</b>\n\n{body}"
 
         # НОВОЕ:
-        btns = await resolve_buttons(tenant_id, lang, "howto")
+        btns = content.buttons
 
         await send_screen(c.bot, tenant_id, c.message.chat.id, lang, "howto", text, kb_howto_min(lang, sup, btns))
         await c.answer()
 
     @router.callback_query(F.data == "signal")
-    async def cb_signal(c: CallbackQuery):
-        lang = await get_lang(tenant_id, c.from_user.id)
-        await route_signal(c.bot, tenant_id, c.from_user.id, c.message.chat.id, lang)
+    async def cb_signal(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        await route_signal(
+            c.bot, tenant_id, c.from_user.id, c.message.chat.id, ctx.lang,
+            tenant=ctx.tenant, access=await ctx.ensure_access(),
+        )
         await c.answer()
 
     @router.callback_query(F.data == "check_sub")
-    async def cb_check_sub(c: CallbackQuery):
-        lang = await get_lang(tenant_id, c.from_user.id)
-        await route_signal(c.bot, tenant_id, c.from_user.id, c.message.chat.id, lang)
+    async def cb_check_sub(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        await route_signal(
+            c.bot, tenant_id, c.from_user.id, c.message.chat.id, ctx.lang,
+            tenant=ctx.tenant, access=await ctx.ensure_access(),
+        )
         await c.answer()
 
+    @router.chat_member()
+    async def on_chat_member(ev: ChatMemberUpdated):
+        # бот — админ гейт-канала: вступления/выходы приходят сами, кэш подписки свежий без get_chat_member
+        note_chat_member(ev)
+
     @router.callback_query(F.data == "lang")
-    async def cb_lang(c: CallbackQuery):
-        lang = await get_lang(tenant_id, c.from_user.id)
-        title = await resolve_title(tenant_id, lang, "lang")
-        body = await resolve_body(tenant_id, lang, "lang")
+    async def cb_lang(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        lang = ctx.lang
+        content = await resolve_screen(tenant_id, lang, "lang")
+        title = content.title
+        body = content.body
         default = t(lang, 'lang_text')
         text = f"<b>{title}</b>\n\n{body or default}"
         await send_screen(c.bot, tenant_id, c.message.chat.id, lang, "lang", text, build_lang_kb(lang))
         await c.answer()
 
     @router.callback_query(F.data.startswith("set_lang:"))
-    async def cb_set_lang(c: CallbackQuery):
+    async def cb_set_lang(c: CallbackQuery, tenant_id: int, ctx: UserContext):
         new_lang = c.data.split(":", 1)[1]
         if new_lang not in LANGS:
             await c.answer("Unsupported lang", show_alert=True)
             return
         await set_lang(tenant_id, c.from_user.id, new_lang)
-        acc = await get_or_create_access(tenant_id, c.from_user.id)
-        tnt = await get_tenant(tenant_id)
-        sup = tnt.support_url or settings.SUPPORT_URL
-        title = await resolve_title(tenant_id, new_lang, "menu")
-        body = await resolve_body(tenant_id, new_lang, "menu")
-        btn_labels = await resolve_buttons(tenant_id, new_lang, "menu")
-        menu_btn = await resolve_primary_btn_text(tenant_id, new_lang, "menu")
+        acc = await ctx.ensure_access()
+        sup = ctx.support_url
+        content = await resolve_screen(tenant_id, new_lang, "menu")
+        title = content.title
+        body = content.body
+        btn_labels = content.buttons
+        menu_btn = content.primary_btn_text
         text = f"<b>{title}</b>" + (f"\n\n{body}" if body else "")
         await send_screen(
             c.bot, tenant_id, c.message.chat.id, new_lang, "menu", text,
@@ -1442,30 +1800,26 @@ def make_child_router(tenant_id: int) -> Router:
         )
         await c.answer()
 
-    # ---- admin gate
-    async def is_owner(tenant_id_: int, user_id_: int) -> bool:
-        tnt = await get_tenant(tenant_id_)
-        return tnt.owner_telegram_id == user_id_
-
+    # ---- admin gate: ctx.is_owner
     @router.message(Command("admin"))
-    async def on_admin(m: Message):
-        if not await is_owner(tenant_id, m.from_user.id):
+    async def on_admin(m: Message, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             await m.answer("Доступ запрещён.")
             return
         title = await resolve_title(tenant_id, "ru", "admin")
         await send_screen(m.bot, tenant_id, m.chat.id, "ru", "admin", title, kb_admin_main())
 
     @router.callback_query(F.data == "adm:users:search")
-    async def adm_users_search(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_users_search(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         ADMIN_WAIT[(tenant_id, c.from_user.id)] = "users_search"
         await c.message.answer("Введите TG ID, @username, trader_id или часть click_id.")
         await c.answer()
 
     @router.callback_query(F.data == "adm:menu")
-    async def adm_menu(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_menu(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         title = await resolve_title(tenant_id, "ru", "admin")
         await send_screen(c.bot, tenant_id, c.message.chat.id, "ru", "admin", title, kb_admin_main())
@@ -1486,8 +1840,8 @@ def make_child_router(tenant_id: int) -> Router:
         return items, more, total
 
     @router.callback_query(F.data.startswith("adm:users:"))
-    async def adm_users(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_users(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         tail = c.data.split(":")[2]
         if tail == "search":
@@ -1500,16 +1854,16 @@ def make_child_router(tenant_id: int) -> Router:
         await c.answer()
 
     @router.callback_query(F.data.startswith("adm:user:") & (~F.data.startswith("adm:user:toggle")))
-    async def adm_user_card_cb(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_user_card_cb(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         uid = int(c.data.split(":")[2])
         await send_user_card(c.bot, tenant_id, c.message.chat.id, uid)
         await c.answer()
 
     @router.callback_query(F.data.startswith("adm:user:toggle_reg:"))
-    async def adm_user_toggle_reg(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_user_toggle_reg(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         uid = int(c.data.rsplit(":", 1)[1])
         async with SessionLocal() as s:
@@ -1526,8 +1880,8 @@ def make_child_router(tenant_id: int) -> Router:
         await send_user_card(c.bot, tenant_id, c.message.chat.id, uid)
 
     @router.callback_query(F.data.startswith("adm:user:toggle_dep:"))
-    async def adm_user_toggle_dep(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_user_toggle_dep(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         uid = int(c.data.rsplit(":", 1)[1])
         async with SessionLocal() as s:
@@ -1544,8 +1898,8 @@ def make_child_router(tenant_id: int) -> Router:
         await send_user_card(c.bot, tenant_id, c.message.chat.id, uid)
 
     @router.callback_query(F.data.startswith("adm:user:toggle_plat:"))
-    async def adm_user_toggle_plat(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_user_toggle_plat(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         uid = int(c.data.rsplit(":", 1)[1])
         async with SessionLocal() as s:
@@ -1586,10 +1940,10 @@ def make_child_router(tenant_id: int) -> Router:
         )
 
     @router.callback_query(F.data == "adm:pb")
-    async def adm_postbacks(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_postbacks(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
-        tnt = await get_tenant(tenant_id)
+        tnt = ctx.tenant
         # гарантируем наличие секрета
         if not tnt.pb_secret:
             import secrets as _pysecrets
@@ -1597,6 +1951,7 @@ def make_child_router(tenant_id: int) -> Router:
                 new_secret = _pysecrets.token_urlsafe(20)
                 await s.execute(Tenant.__table__.update().where(Tenant.id == tenant_id).values(pb_secret=new_secret))
                 await s.commit()
+                invalidate_tenant(tenant_id)
             tnt = await get_tenant(tenant_id)
         txt = _postbacks_text(tenant_id, tnt.pb_secret)
         await send_screen(c.bot, tenant_id, c.message.chat.id, "ru", "admin", txt, kb_postbacks(tenant_id))
@@ -1604,15 +1959,15 @@ def make_child_router(tenant_id: int) -> Router:
 
     # ---- Links
     @router.callback_query(F.data == "adm:links")
-    async def adm_links(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_links(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         await show_links_screen(c.bot, tenant_id, c.message.chat.id)
         await c.answer()
 
     @router.callback_query(F.data.startswith("adm:links:set:"))
-    async def adm_links_set(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_links_set(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         action = c.data.split(":")[-1]
         admin_wait_key = (tenant_id, c.from_user.id)
@@ -1632,8 +1987,8 @@ def make_child_router(tenant_id: int) -> Router:
         await c.answer()
 
     @router.callback_query(F.data == "adm:links:regen:pbsec")
-    async def adm_links_regen_pbsec(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_links_regen_pbsec(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         import secrets as _pysecrets
         async with SessionLocal() as s:
@@ -1644,6 +1999,7 @@ def make_child_router(tenant_id: int) -> Router:
                 .values(pb_secret=new_secret)
             )
             await s.commit()
+            invalidate_tenant(tenant_id)
         await c.message.answer("✅ Новый PB Secret сгенерирован.\nНе забудьте обновить URL'ы в партнёрке.")
         await show_links_screen(c.bot, tenant_id, c.message.chat.id)
         await c.answer()
@@ -1652,10 +2008,10 @@ def make_child_router(tenant_id: int) -> Router:
     @router.message(
         StateFilter(None),
         F.text.regexp(r"^https?://\S+$"),
-        lambda m: ADMIN_WAIT.get((tenant_id, m.from_user.id)) in {"/set_channel_url", "/set_ref_link",
+        lambda m, tenant_id: ADMIN_WAIT.get((tenant_id, m.from_user.id)) in {"/set_channel_url", "/set_ref_link",
                                                                   "/set_deposit_link", "/set_support_url"}
     )
-    async def admin_catch_url(m: Message, state: FSMContext):
+    async def admin_catch_url(m: Message, state: FSMContext, tenant_id: int):
         admin_wait_key = (tenant_id, m.from_user.id)
         cmd = ADMIN_WAIT.get(admin_wait_key)
         url = m.text.strip()
@@ -1665,6 +2021,7 @@ def make_child_router(tenant_id: int) -> Router:
                                 .where(Tenant.id == tenant_id)
                                 .values(gate_channel_url=url))
                 await s.commit()
+                invalidate_tenant(tenant_id)
             ADMIN_WAIT.pop(admin_wait_key, None)
             await m.answer("Супер, сохранил ✅")
             await show_links_screen(m.bot, tenant_id, m.chat.id)
@@ -1681,6 +2038,7 @@ def make_child_router(tenant_id: int) -> Router:
         async with SessionLocal() as s:
             await s.execute(Tenant.__table__.update().where(Tenant.id == tenant_id).values(**{col: url}))
             await s.commit()
+            invalidate_tenant(tenant_id)
         ADMIN_WAIT.pop(admin_wait_key, None)
         await m.answer(f"{col} сохранён: {url}")
         await show_links_screen(m.bot, tenant_id, m.chat.id)
@@ -1689,9 +2047,9 @@ def make_child_router(tenant_id: int) -> Router:
     @router.message(
         StateFilter(None),
         F.text.regexp(r"^-?\d{5,}$"),
-        lambda m: ADMIN_WAIT.get((tenant_id, m.from_user.id)) == "/set_channel_id"
+        lambda m, tenant_id: ADMIN_WAIT.get((tenant_id, m.from_user.id)) == "/set_channel_id"
     )
-    async def admin_catch_id(m: Message, state: FSMContext):
+    async def admin_catch_id(m: Message, state: FSMContext, tenant_id: int):
         admin_wait_key = (tenant_id, m.from_user.id)
         ch_id = int(m.text.strip())
         async with SessionLocal() as s:
@@ -1699,13 +2057,14 @@ def make_child_router(tenant_id: int) -> Router:
                             .where(Tenant.id == tenant_id)
                             .values(gate_channel_id=ch_id))
             await s.commit()
+            invalidate_tenant(tenant_id)
 
         ADMIN_WAIT[admin_wait_key] = "/set_channel_url"
         await m.answer(f"gate_channel_id сохранён: {ch_id}\n"
                        "Теперь пришлите публичную ссылку на канал (https://t.me/…)")
 
     @router.message(StateFilter(None), F.text)
-    async def catch_admin_text(m: Message, state: FSMContext):
+    async def catch_admin_text(m: Message, state: FSMContext, tenant_id: int):
         admin_wait_key = (tenant_id, m.from_user.id)
         wait = ADMIN_WAIT.get(admin_wait_key)
         if not wait:
@@ -1827,6 +2186,7 @@ def make_child_router(tenant_id: int) -> Router:
             async with SessionLocal() as s:
                 await s.execute(Tenant.__table__.update().where(Tenant.id == tenant_id).values(**{col: val}))
                 await s.commit()
+                invalidate_tenant(tenant_id)
             ADMIN_WAIT.pop(admin_wait_key, None)
             await m.answer("Сохранено ✅")
             await show_params_screen(m.bot, tenant_id, m.chat.id)
@@ -1834,16 +2194,16 @@ def make_child_router(tenant_id: int) -> Router:
 
     # ---- Content editor callbacks
     @router.callback_query(F.data == "adm:content")
-    async def adm_content(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_content(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         await send_screen(c.bot, tenant_id, c.message.chat.id, "ru", "admin", "🧩 Редактор контента — выберите язык",
                           kb_content_langs())
         await c.answer()
 
     @router.callback_query(F.data.startswith("adm:content:lang:"))
-    async def adm_content_lang(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_content_lang(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         lang = c.data.split(":")[-1]
         await send_screen(c.bot, tenant_id, c.message.chat.id, "ru", "admin", f"Язык: {lang.upper()}\nВыберите экран:",
@@ -1851,8 +2211,8 @@ def make_child_router(tenant_id: int) -> Router:
         await c.answer()
 
     @router.callback_query(F.data.startswith("adm:content:list:"))
-    async def adm_content_list(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_content_list(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         lang = c.data.split(":")[-1]
         await send_screen(c.bot, tenant_id, c.message.chat.id, "ru", "admin", f"Язык: {lang.upper()}\nВыберите экран:",
@@ -1860,16 +2220,16 @@ def make_child_router(tenant_id: int) -> Router:
         await c.answer()
 
     @router.callback_query(F.data.startswith("adm:content:edit:"))
-    async def adm_content_edit(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_content_edit(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         _, _, _, lang, screen = c.data.split(":")
         await show_content_editor(c.bot, tenant_id, c.message.chat.id, lang, screen)
         await c.answer()
 
     @router.callback_query(F.data.startswith("adm:content:title:"))
-    async def adm_content_title(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_content_title(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         _, _, _, lang, screen = c.data.split(":")
         ADMIN_WAIT[(tenant_id, c.from_user.id)] = f"content_title:{lang}:{screen}"
@@ -1877,8 +2237,8 @@ def make_child_router(tenant_id: int) -> Router:
         await c.answer()
 
     @router.callback_query(F.data.startswith("adm:content:btn:"))
-    async def adm_content_btn(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_content_btn(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         _, _, _, lang, screen = c.data.split(":")
         ADMIN_WAIT[(tenant_id, c.from_user.id)] = f"content_btn:{lang}:{screen}"
@@ -1886,8 +2246,8 @@ def make_child_router(tenant_id: int) -> Router:
         await c.answer()
 
     @router.callback_query(F.data.startswith("adm:content:body:"))
-    async def adm_content_body(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_content_body(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         _, _, _, lang, screen = c.data.split(":")
         ADMIN_WAIT[(tenant_id, c.from_user.id)] = f"content_body:{lang}:{screen}"
@@ -1896,8 +2256,8 @@ def make_child_router(tenant_id: int) -> Router:
 
     # Новый мастер подписей
     @router.callback_query(F.data.startswith("adm:content:btns2:"))
-    async def adm_content_btns2(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_content_btns2(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         _, _, _, lang, screen = c.data.split(":")
         cur = await resolve_buttons(tenant_id, lang, screen)
@@ -1906,8 +2266,8 @@ def make_child_router(tenant_id: int) -> Router:
         await c.answer()
 
     @router.callback_query(F.data.startswith("adm:content:btnkey:"))
-    async def adm_content_btnkey(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_content_btnkey(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         _, _, _, lang, screen, key = c.data.split(":")
         if key not in KEYS_MAP.get(screen, []):
@@ -1919,8 +2279,8 @@ def make_child_router(tenant_id: int) -> Router:
         await c.answer()
 
     @router.callback_query(F.data.startswith("adm:content:btnresetall:"))
-    async def adm_content_btnresetall(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_content_btnresetall(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         _, _, _, lang, screen = c.data.split(":")
         # Чистим ТОЛЬКО подписи кнопок
@@ -1935,6 +2295,7 @@ def make_child_router(tenant_id: int) -> Router:
             if ov:
                 await s.execute(ContentOverride.__table__.update().where(ContentOverride.id == ov.id).values(buttons_json=None))
                 await s.commit()
+        invalidate_content(tenant_id)
         await c.message.answer("Все подписи кнопок сброшены к дефолту ✅")
         cur = await resolve_buttons(tenant_id, lang, screen)
         await send_screen(c.bot, tenant_id, c.message.chat.id, "ru", "admin",
@@ -1942,22 +2303,22 @@ def make_child_router(tenant_id: int) -> Router:
         await c.answer()
 
     @router.callback_query(F.data.startswith("adm:content:preview:"))
-    async def adm_content_preview(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_content_preview(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         _, _, _, lang, screen = c.data.split(":")
         # Собираем экран в том же формате, как у юзера
-        title = await resolve_title(tenant_id, lang, screen)
-        body = await resolve_body(tenant_id, lang, screen)
-        btns = await resolve_buttons(tenant_id, lang, screen)
+        content = await resolve_screen(tenant_id, lang, screen)
+        title = content.title
+        body = content.body
+        btns = content.buttons
 
-        tnt = await get_tenant(tenant_id)
-        sup = tnt.support_url or settings.SUPPORT_URL
-        acc = await get_or_create_access(tenant_id, c.from_user.id)  # используем админа как пользователя
+        tnt = ctx.tenant
+        sup = ctx.support_url
+        acc = await ctx.ensure_access()  # используем админа как пользователя
 
         if screen == "menu":
-            menu_btn_text = await resolve_primary_btn_text(tenant_id, lang, "menu")
-            kb = main_kb(lang, acc, sup, btns, menu_btn_text)
+            kb = main_kb(lang, acc, sup, btns, content.primary_btn_text)
         elif screen == "subscribe":
             kb = kb_subscribe(lang, tnt.gate_channel_url, btns)
         elif screen == "register":
@@ -1980,8 +2341,8 @@ def make_child_router(tenant_id: int) -> Router:
         await c.answer("Предпросмотр отправлен")
 
     @router.callback_query(F.data.startswith("adm:content:img:"))
-    async def adm_content_img(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_content_img(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         _, _, _, lang, screen = c.data.split(":")
         ADMIN_WAIT[(tenant_id, c.from_user.id)] = f"content_img:{lang}:{screen}"
@@ -1989,8 +2350,8 @@ def make_child_router(tenant_id: int) -> Router:
         await c.answer()
 
     @router.callback_query(F.data.startswith("adm:content:reset:"))
-    async def adm_content_reset(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_content_reset(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         _, _, _, lang, screen = c.data.split(":")
         await upsert_override(tenant_id, lang, screen, reset=True)
@@ -1999,7 +2360,7 @@ def make_child_router(tenant_id: int) -> Router:
 
     # --- Контент: ловим фото (и уважаем FSM рассылки)
     @router.message(StateFilter(None), F.photo)
-    async def adm_content_catch_image(m: Message, state: FSMContext):
+    async def adm_content_catch_image(m: Message, state: FSMContext, tenant_id: int):
         admin_wait_key = (tenant_id, m.from_user.id)
         wait = ADMIN_WAIT.get(admin_wait_key)
         if not wait or not wait.startswith("content_img:"):
@@ -2016,21 +2377,21 @@ def make_child_router(tenant_id: int) -> Router:
 
     # ---- Params
     @router.callback_query(F.data == "adm:params")
-    async def adm_params(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_params(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         await show_params_screen(c.bot, tenant_id, c.message.chat.id)
         await c.answer()
 
     @router.callback_query(F.data == "adm:param:reg_locked")
-    async def adm_param_reg_locked(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_param_reg_locked(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         await c.answer("Регистрацию отключать нельзя.", show_alert=True)
 
     @router.callback_query(F.data == "adm:param:toggle:sub")
-    async def adm_param_toggle_sub(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_param_toggle_sub(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         async with SessionLocal() as s:
             res = await s.execute(select(Tenant).where(Tenant.id == tenant_id))
@@ -2038,12 +2399,13 @@ def make_child_router(tenant_id: int) -> Router:
             newv = not bool(tnt.check_subscription)
             await s.execute(Tenant.__table__.update().where(Tenant.id == tenant_id).values(check_subscription=newv))
             await s.commit()
+            invalidate_tenant(tenant_id)
         await show_params_screen(c.bot, tenant_id, c.message.chat.id)
         await c.answer()
 
     @router.callback_query(F.data == "adm:param:toggle:dep")
-    async def adm_param_toggle_dep(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_param_toggle_dep(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         async with SessionLocal() as s:
             res = await s.execute(select(Tenant).where(Tenant.id == tenant_id))
@@ -2051,20 +2413,21 @@ def make_child_router(tenant_id: int) -> Router:
             newv = not bool(tnt.check_deposit)
             await s.execute(Tenant.__table__.update().where(Tenant.id == tenant_id).values(check_deposit=newv))
             await s.commit()
+            invalidate_tenant(tenant_id)
         await show_params_screen(c.bot, tenant_id, c.message.chat.id)
         await c.answer()
 
     @router.callback_query(F.data == "adm:param:set:min_dep")
-    async def adm_param_set_min_dep(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_param_set_min_dep(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         ADMIN_WAIT[(tenant_id, c.from_user.id)] = "param:min_dep"
         await c.message.answer("Пришлите новое значение <b>минимального депозита</b> в $ (целое или дробное).", parse_mode="HTML")
         await c.answer()
 
     @router.callback_query(F.data == "adm:param:set:plat")
-    async def adm_param_set_plat(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_param_set_plat(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         ADMIN_WAIT[(tenant_id, c.from_user.id)] = "param:plat"
         await c.message.answer("Пришлите новый <b>порог Platinum</b> в $ (целое или дробное).", parse_mode="HTML")
@@ -2078,6 +2441,9 @@ def make_child_router(tenant_id: int) -> Router:
         WAIT_TEXT = State()
         WAIT_PHOTO = State()
         WAIT_VIDEO = State()
+        WAIT_SCHEDULE = State()
+
+    BC_REPEAT_TITLES = {"once": "однократно", "daily": "каждый день", "weekly": "каждую неделю"}
 
     def kb_bc_segments() -> InlineKeyboardMarkup:
         return InlineKeyboardMarkup(inline_keyboard=[
@@ -2089,6 +2455,7 @@ def make_child_router(tenant_id: int) -> Router:
                 InlineKeyboardButton(text="С депозитом", callback_data="adm:bc:seg:dep"),
                 InlineKeyboardButton(text="Только /start", callback_data="adm:bc:seg:nosteps"),
             ],
+            [InlineKeyboardButton(text="📅 Запланированные", callback_data="adm:bc:list")],
             [InlineKeyboardButton(text="↩️ Отмена", callback_data="adm:bc:cancel")],
         ])
 
@@ -2120,13 +2487,24 @@ def make_child_router(tenant_id: int) -> Router:
                 ),
             ],
             [InlineKeyboardButton(text="🚀 Запустить", callback_data="adm:bc:run_now")],
+            [InlineKeyboardButton(text="🕒 Запланировать", callback_data="adm:bc:schedule")],
             [InlineKeyboardButton(text="↩️ Отмена", callback_data="adm:bc:cancel")],
         ]
         return InlineKeyboardMarkup(inline_keyboard=rows)
 
+    def kb_bc_repeat() -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Один раз", callback_data="adm:bc:rep:once")],
+            [
+                InlineKeyboardButton(text="Каждый день", callback_data="adm:bc:rep:daily"),
+                InlineKeyboardButton(text="Каждую неделю", callback_data="adm:bc:rep:weekly"),
+            ],
+            [InlineKeyboardButton(text="↩️ Отмена", callback_data="adm:bc:cancel")],
+        ])
+
     @router.callback_query(F.data == "adm:bc")
-    async def adm_bc_entry(c: CallbackQuery, state: FSMContext):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_bc_entry(c: CallbackQuery, state: FSMContext, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         await state.clear()
         await state.set_state(BcFSM.WAIT_SEGMENT)
@@ -2134,8 +2512,8 @@ def make_child_router(tenant_id: int) -> Router:
         await c.answer()
 
     @router.callback_query(StateFilter(BcFSM.WAIT_SEGMENT), F.data.startswith("adm:bc:seg:"))
-    async def adm_bc_segment_pick(c: CallbackQuery, state: FSMContext):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_bc_segment_pick(c: CallbackQuery, state: FSMContext, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         seg = c.data.split(":")[-1]
         await state.update_data(segment=seg, text=None, photo_id=None, video_id=None,
@@ -2145,8 +2523,8 @@ def make_child_router(tenant_id: int) -> Router:
         await c.answer()
 
     @router.message(StateFilter(BcFSM.WAIT_TEXT))
-    async def adm_bc_set_text(m: Message, state: FSMContext):
-        if not await is_owner(tenant_id, m.from_user.id):
+    async def adm_bc_set_text(m: Message, state: FSMContext, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         if not (m.text and m.text.strip()):
             await m.answer("Нужен именно текст. Пришлите его одним сообщением.")
@@ -2171,7 +2549,7 @@ def make_child_router(tenant_id: int) -> Router:
         )
 
     @router.callback_query(F.data == "adm:bc:toggle_fmt")
-    async def adm_bc_toggle_fmt(c: CallbackQuery, state: FSMContext):
+    async def adm_bc_toggle_fmt(c: CallbackQuery, state: FSMContext, tenant_id: int):
         data = await state.get_data()
         new_fmt = "MarkdownV2" if data.get("fmt", "HTML") == "HTML" else "HTML"
         await state.update_data(fmt=new_fmt)
@@ -2187,7 +2565,7 @@ def make_child_router(tenant_id: int) -> Router:
         await c.answer(f"Формат: {new_fmt}")
 
     @router.callback_query(F.data == "adm:bc:toggle_preview")
-    async def adm_bc_toggle_prev(c: CallbackQuery, state: FSMContext):
+    async def adm_bc_toggle_prev(c: CallbackQuery, state: FSMContext, tenant_id: int):
         data = await state.get_data()
         new_dp = not bool(data.get("disable_preview", False))
         await state.update_data(disable_preview=new_dp)
@@ -2203,7 +2581,7 @@ def make_child_router(tenant_id: int) -> Router:
         await c.answer("Предпросмотр " + ("выкл" if new_dp else "вкл"))
 
     @router.callback_query(F.data == "adm:bc:preview")
-    async def adm_bc_preview(c: CallbackQuery, state: FSMContext):
+    async def adm_bc_preview(c: CallbackQuery, state: FSMContext, tenant_id: int):
         d = await state.get_data()
         text = (d.get("text") or "").strip()
         if not text:
@@ -2222,8 +2600,8 @@ def make_child_router(tenant_id: int) -> Router:
         await c.answer("Предпросмотр отправлен")
 
     @router.callback_query(F.data == "adm:bc:add_photo")
-    async def adm_bc_ask_photo(c: CallbackQuery, state: FSMContext):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_bc_ask_photo(c: CallbackQuery, state: FSMContext, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         data = await state.get_data()
         if not data.get("text"):
@@ -2234,8 +2612,8 @@ def make_child_router(tenant_id: int) -> Router:
         await c.answer()
 
     @router.message(StateFilter(BcFSM.WAIT_PHOTO))
-    async def adm_bc_set_photo(m: Message, state: FSMContext):
-        if not await is_owner(tenant_id, m.from_user.id):
+    async def adm_bc_set_photo(m: Message, state: FSMContext, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         if not m.photo:
             await m.answer("Нужна именно фотография. Пришлите её одним сообщением.")
@@ -2253,8 +2631,8 @@ def make_child_router(tenant_id: int) -> Router:
         )
 
     @router.callback_query(F.data == "adm:bc:add_video")
-    async def adm_bc_ask_video(c: CallbackQuery, state: FSMContext):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_bc_ask_video(c: CallbackQuery, state: FSMContext, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         data = await state.get_data()
         if not data.get("text"):
@@ -2265,8 +2643,8 @@ def make_child_router(tenant_id: int) -> Router:
         await c.answer()
 
     @router.message(StateFilter(BcFSM.WAIT_VIDEO))
-    async def adm_bc_set_video(m: Message, state: FSMContext):
-        if not await is_owner(tenant_id, m.from_user.id):
+    async def adm_bc_set_video(m: Message, state: FSMContext, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         if not m.video:
             await m.answer("Нужно именно видео (как видео-сообщение), пришлите одним сообщением.")
@@ -2284,8 +2662,8 @@ def make_child_router(tenant_id: int) -> Router:
         )
 
     @router.callback_query(F.data == "adm:bc:run_now")
-    async def adm_bc_run_now(c: CallbackQuery, state: FSMContext):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_bc_run_now(c: CallbackQuery, state: FSMContext, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
 
         data = await state.get_data()
@@ -2304,58 +2682,128 @@ def make_child_router(tenant_id: int) -> Router:
             await c.answer("Нужно отправить текст рассылки.", show_alert=True)
             return
 
-        async with SessionLocal() as s:
-            q = select(UserAccess.user_id).where(UserAccess.tenant_id == tenant_id)
-            if seg == "reg":
-                q = q.where(UserAccess.is_registered == True)
-            elif seg == "dep":
-                q = q.where(UserAccess.has_deposit == True)
-            elif seg == "nosteps":
-                q = q.where((UserAccess.is_registered == False) & (UserAccess.has_deposit == False))
-            rows = (await s.execute(q)).all()
-            ids = [r[0] for r in rows]
-
-        total = len(ids)
+        total = await count_recipients(tenant_id, seg)
         if total == 0:
             await c.answer("Нет получателей под выбранный сегмент.", show_alert=True)
             await state.clear()
             return
 
-        bot = c.bot
-        progress_msg = await c.message.answer(f"Стартую рассылку… Получателей: {total}")
-        ok = 0
-        fail = 0
+        # Рассылка — фоновая задача (broadcast.py): колбэк отвечает сразу
+        bc = await create_broadcast(
+            tenant_id, segment=seg, text=text, photo_id=photo_id, video_id=video_id,
+            fmt=fmt, disable_preview=dp, total=total, admin_chat_id=c.message.chat.id,
+        )
+        progress_msg = await c.message.answer(
+            f"Стартую рассылку… Получателей: {total}", reply_markup=kb_bc_progress(bc.id)
+        )
+        async with SessionLocal() as s:
+            await s.execute(
+                Broadcast.__table__.update().where(Broadcast.id == bc.id)
+                .values(progress_message_id=progress_msg.message_id)
+            )
+            await s.commit()
+        broadcasts.launch(bc.id)
 
-        for i, uid in enumerate(ids, start=1):
-            try:
-                if video_id:
-                    await bot.send_video(uid, video=video_id, caption=text, parse_mode=fmt)
-                elif photo_id:
-                    await bot.send_photo(uid, photo=photo_id, caption=text, parse_mode=fmt)
-                else:
-                    await bot.send_message(uid, text, parse_mode=fmt, disable_web_page_preview=dp)
-                ok += 1
-            except Exception:
-                fail += 1
+        await state.clear()
+        await c.answer()
 
-            if i % 25 == 0 or i == total:
-                try:
-                    await progress_msg.edit_text(f"Рассылка: {i}/{total}\nУспешно: {ok} | Ошибок: {fail}")
-                except Exception:
-                    pass
-            await asyncio.sleep(0.03)
+    @router.callback_query(F.data == "adm:bc:schedule")
+    async def adm_bc_schedule_ask(c: CallbackQuery, state: FSMContext, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
+            return
+        data = await state.get_data()
+        if not data.get("segment") or not (data.get("text") or "").strip():
+            await c.answer("Сначала выберите сегмент и пришлите текст.", show_alert=True)
+            return
+        await state.set_state(BcFSM.WAIT_SCHEDULE)
+        await c.message.answer(
+            f"Когда отправить? Время — в поясе <b>{settings.BC_TZ}</b>:\n"
+            "<code>ЧЧ:ММ</code> — ближайшее такое время\n"
+            "<code>ДД.ММ ЧЧ:ММ</code> или <code>ДД.ММ.ГГГГ ЧЧ:ММ</code>",
+            parse_mode="HTML",
+        )
+        await c.answer()
 
-        try:
-            await progress_msg.edit_text(f"Готово ✅\nОтправлено: {ok} | Ошибок: {fail}")
-        except Exception:
-            pass
+    @router.message(StateFilter(BcFSM.WAIT_SCHEDULE))
+    async def adm_bc_schedule_set(m: Message, state: FSMContext, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
+            return
+        send_at = parse_send_at(m.text or "")
+        if send_at is None:
+            await m.answer("Не понял время. Пример: <code>18:30</code> или <code>25.12 10:00</code>.", parse_mode="HTML")
+            return
+        if send_at <= datetime.utcnow():
+            await m.answer("Это время уже прошло. Пришлите время в будущем.")
+            return
+        await state.update_data(send_at=send_at.isoformat())
+        await m.answer(f"Отправка: <b>{fmt_local(send_at)}</b> ({settings.BC_TZ}). Повторять?",
+                       parse_mode="HTML", reply_markup=kb_bc_repeat())
 
+    @router.callback_query(StateFilter(BcFSM.WAIT_SCHEDULE), F.data.startswith("adm:bc:rep:"))
+    async def adm_bc_schedule_repeat(c: CallbackQuery, state: FSMContext, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
+            return
+        data = await state.get_data()
+        rep = c.data.split(":")[-1]
+        if not data.get("send_at") or rep not in BC_REPEAT_TITLES:
+            await c.answer("Сначала пришлите время отправки.", show_alert=True)
+            return
+        send_at = datetime.fromisoformat(data["send_at"])
+        bc = await create_broadcast(
+            tenant_id, status="scheduled", send_at=send_at,
+            recurrence=rep if rep in RECURRENCE else None,
+            segment=data.get("segment"), text=(data.get("text") or "").strip(),
+            photo_id=data.get("photo_id"), video_id=data.get("video_id"),
+            fmt=data.get("fmt", "HTML"), disable_preview=bool(data.get("disable_preview", False)),
+            admin_chat_id=c.message.chat.id,
+        )
+        scheduler.add(bc.id, send_at)
         await state.clear()
+        await c.message.answer(
+            f"🕒 Рассылка #{bc.id} запланирована на <b>{fmt_local(send_at)}</b> ({settings.BC_TZ}), "
+            f"{BC_REPEAT_TITLES[rep]}.",
+            parse_mode="HTML",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="❌ Снять с расписания", callback_data=f"adm:bc:stop:{bc.id}")],
+            ]),
+        )
+        await c.answer()
+
+    @router.callback_query(F.data == "adm:bc:list")
+    async def adm_bc_list(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
+            return
+        items = await scheduled_broadcasts(tenant_id)
+        if not items:
+            await c.answer("Запланированных рассылок нет.", show_alert=True)
+            return
+        lines, rows = [], []
+        for bc in items:
+            preview = html.escape(html.unescape(re.sub(r"<[^>]+>", "", bc.text or ""))[:40])
+            lines.append(
+                f"#{bc.id} · {fmt_local(bc.send_at)} · {BC_REPEAT_TITLES.get(bc.recurrence or 'once')} · "
+                f"{bc.segment}\n{preview}"
+            )
+            rows.append([InlineKeyboardButton(text=f"❌ Снять #{bc.id}", callback_data=f"adm:bc:stop:{bc.id}")])
+        await c.message.answer(
+            f"📅 Запланированные рассылки ({settings.BC_TZ}):\n\n" + "\n\n".join(lines),
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=rows),
+        )
         await c.answer()
 
+    @router.callback_query(F.data.startswith("adm:bc:stop:"))
+    async def adm_bc_stop(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
+            return
+        bc_id = int(c.data.split(":")[-1])
+        if await cancel_broadcast(tenant_id, bc_id):
+            await c.answer("Останавливаю рассылку…")
+        else:
+            await c.answer("Рассылка уже завершена.", show_alert=True)
+
     @router.callback_query(F.data == "adm:bc:cancel")
-    async def adm_bc_cancel(c: CallbackQuery, state: FSMContext):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_bc_cancel(c: CallbackQuery, state: FSMContext, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
         await state.clear()
         await c.message.answer("Окей, отменил.")
@@ -2363,49 +2811,20 @@ def make_child_router(tenant_id: int) -> Router:
 
     # ---- Stats
     @router.callback_query(F.data == "adm:stats")
-    async def adm_stats(c: CallbackQuery):
-        if not await is_owner(tenant_id, c.from_user.id):
+    async def adm_stats(c: CallbackQuery, tenant_id: int, ctx: UserContext):
+        if not ctx.is_owner:
             return
-        async with SessionLocal() as s:
-            total = (await s.execute(
-                select(func.count()).select_from(UserAccess).where(UserAccess.tenant_id == tenant_id)
-            )).scalar() or 0
-            regs = (await s.execute(
-                select(func.count()).select_from(UserAccess).where(
-                    UserAccess.tenant_id == tenant_id,
-                    UserAccess.is_registered == True
-                )
-            )).scalar() or 0
-            deps = (await s.execute(
-                select(func.count()).select_from(UserAccess).where(
-                    UserAccess.tenant_id == tenant_id,
-                    UserAccess.has_deposit == True
-                )
-            )).scalar() or 0
-            plats = (await s.execute(
-                select(func.count()).select_from(UserAccess).where(
-                    UserAccess.tenant_id == tenant_id,
-                    UserAccess.is_platinum == True
-                )
-            )).scalar() or 0
-
+        st = await user_stats(tenant_id)
+        day, week = await daily_trend(tenant_id)
         txt = (
             f"📊 Статистика\n\n"
-            f"Всего: {total}\n"
-            f"Регистраций: {regs}\n"
-            f"Депозитов: {deps}\n"
-            f"Platinum: {plats}"
+            f"Всего: {st.total}\n"
+            f"Регистраций: {st.regs}\n"
+            f"Депозитов: {st.deps}\n"
+            f"Platinum: {st.plats}\n\n"
+            f"{format_trend(day, week)}"
         )
         await send_screen(c.bot, tenant_id, c.message.chat.id, "ru", "admin", txt, kb_admin_main())
         await c.answer()
 
     return router
-
-# =========================
-#          Runner
-# =========================
-async def run_child_bot(token: str, tenant_id: int):
-    bot = Bot(token, default=DefaultBotProperties(parse_mode="HTML"))
-    dp = Dispatcher(storage=MemoryStorage())
-    dp.include_router(make_child_router(tenant_id))
-    await dp.start_polling(bot)
@@ -0,0 +1,532 @@
+# app/bots/child/broadcast.py
+from __future__ import annotations
+
+import asyncio
+import heapq
+import time
+from contextlib import aclosing
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramNetworkError, TelegramRetryAfter
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from sqlalchemy import select, func
+
+from app.db import SessionLocal
+from app.deliverability import record_delivery
+from app.models import Broadcast, UserAccess
+from app.outbound import PRIORITY_BULK, use_priority
+from app.settings import settings
+from app.utils.logging import logger
+
+
+class TokenBucket:
+    """
+    Лимитер отправок бота: rate токенов в секунду, запас burst.
+    pause() — ответ Telegram RetryAfter: все отправки бота ждут указанное время.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()  # очередь ожидающих — FIFO
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+# =========================
+#   Сегменты и задачи
+# =========================
+def segment_where(segment: str, include_dead: bool = False) -> list:
+    """Условия на UserAccess для сегмента рассылки. Мёртвые чаты (blocked_at) по умолчанию исключены."""
+    cond = [] if include_dead else [UserAccess.blocked_at.is_(None)]
+    if segment == "reg":
+        cond.append(UserAccess.is_registered == True)
+    elif segment == "dep":
+        cond.append(UserAccess.has_deposit == True)
+    elif segment == "nosteps":
+        cond.append((UserAccess.is_registered == False) & (UserAccess.has_deposit == False))
+    return cond
+
+
+async def iter_recipients(
+    tenant_id: int, segment: str, after_id: int = 0, page_size: Optional[int] = None,
+) -> AsyncIterator[Tuple[int, int]]:
+    """
+    Получатели сегмента (UserAccess.id, user_id) по возрастанию id — keyset-пагинацией
+    (id > последний отданный), без OFFSET и без списка всей аудитории в памяти.
+    Каждая страница — на своей короткой сессии; следующая грузится, пока отдаётся текущая.
+    """
+    page_size = page_size or settings.BC_PAGE
+
+    async def load(after: int) -> List[Tuple[int, int]]:
+        async with SessionLocal() as s:
+            res = await s.execute(
+                select(UserAccess.id, UserAccess.user_id)
+                .where(UserAccess.tenant_id == tenant_id, UserAccess.id > after, *segment_where(segment))
+                .order_by(UserAccess.id)
+                .limit(page_size)
+            )
+            return [tuple(r) for r in res.all()]
+
+    rows = await load(after_id)
+    while rows:
+        nxt = asyncio.create_task(load(rows[-1][0])) if len(rows) == page_size else None
+        try:
+            for row in rows:
+                yield row
+        except BaseException:
+            if nxt:
+                nxt.cancel()
+            raise
+        rows = await nxt if nxt else []
+
+
+async def _chunks(it: AsyncIterator, size: int) -> AsyncIterator[list]:
+    chunk = []
+    async for item in it:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def count_recipients(tenant_id: int, segment: str) -> int:
+    async with SessionLocal() as s:
+        res = await s.execute(
+            select(func.count()).select_from(UserAccess)
+            .where(UserAccess.tenant_id == tenant_id, *segment_where(segment))
+        )
+        return int(res.scalar() or 0)
+
+
+async def create_broadcast(tenant_id: int, status: str = "queued", **fields) -> Broadcast:
+    """Новая рассылка (queued или scheduled); fields — колонки Broadcast (segment, text, send_at, ...)."""
+    bc = Broadcast(tenant_id=tenant_id, status=status, **fields)
+    async with SessionLocal() as s:
+        s.add(bc)
+        await s.commit()
+    return bc
+
+
+async def cancel_broadcast(tenant_id: int, bc_id: int) -> bool:
+    """Остановить рассылку (или снять с расписания): раннер увидит статус на границе пачки."""
+    async with SessionLocal() as s:
+        res = await s.execute(
+            Broadcast.__table__.update()
+            .where(Broadcast.id == bc_id, Broadcast.tenant_id == tenant_id,
+                   Broadcast.status.in_(("scheduled", "queued", "running")))
+            .values(status="cancelled", finished_at=datetime.utcnow())
+        )
+        await s.commit()
+        return bool(res.rowcount)
+
+
+async def scheduled_broadcasts(tenant_id: int) -> List[Broadcast]:
+    async with SessionLocal() as s:
+        res = await s.execute(
+            select(Broadcast)
+            .where(Broadcast.tenant_id == tenant_id, Broadcast.status == "scheduled")
+            .order_by(Broadcast.send_at)
+        )
+        return list(res.scalars())
+
+
+RECURRENCE = {"daily": timedelta(days=1), "weekly": timedelta(days=7)}
+
+
+def next_occurrence(due: datetime, recurrence: str, now: datetime) -> datetime:
+    """
+    Следующий срок после now (пропущенные за время простоя сроки не догоняем).
+    Шаг делается по местному времени BC_TZ, поэтому «каждый день в 10:00» остаётся
+    10:00 и после перевода часов; due/now/результат — naive UTC.
+    """
+    tz = ZoneInfo(settings.BC_TZ)
+    step = RECURRENCE[recurrence]
+    wall = due.replace(tzinfo=timezone.utc).astimezone(tz).replace(tzinfo=None)
+    while due <= now:
+        wall += step
+        due = wall.replace(tzinfo=tz).astimezone(timezone.utc).replace(tzinfo=None)
+    return due
+
+
+def parse_send_at(raw: str, now: Optional[datetime] = None) -> Optional[datetime]:
+    """
+    Время от админа в поясе BC_TZ → naive UTC. Форматы: 'ЧЧ:ММ' (ближайшее такое время),
+    'ДД.ММ ЧЧ:ММ' (ближайшая такая дата), 'ДД.ММ.ГГГГ ЧЧ:ММ'. None — не разобрали.
+    """
+    tz = ZoneInfo(settings.BC_TZ)
+    now_local = (now or datetime.utcnow()).replace(tzinfo=timezone.utc).astimezone(tz)
+    raw = " ".join((raw or "").split())
+    for fmt in ("%d.%m.%Y %H:%M", "%H:%M"):
+        try:
+            parsed = datetime.strptime(raw, fmt)
+        except ValueError:
+            continue
+        if fmt == "%H:%M":
+            local = now_local.replace(hour=parsed.hour, minute=parsed.minute, second=0, microsecond=0)
+            if local <= now_local:
+                local += timedelta(days=1)
+        else:
+            local = parsed.replace(tzinfo=tz)
+        return local.astimezone(timezone.utc).replace(tzinfo=None)
+
+    # 'ДД.ММ ЧЧ:ММ': год подставляем до разбора — strptime без года берёт 1900, и 29.02 не проходит.
+    # Ближайший год, где дата есть и ещё не прошла (для 29.02 — следующий високосный).
+    day_month, _, hm = raw.partition(" ")
+    if hm and day_month.count(".") == 1:
+        for year in range(now_local.year, now_local.year + 5):
+            try:
+                local = datetime.strptime(f"{day_month}.{year} {hm}", "%d.%m.%Y %H:%M").replace(tzinfo=tz)
+            except ValueError:
+                continue
+            if local > now_local:
+                return local.astimezone(timezone.utc).replace(tzinfo=None)
+    return None
+
+
+def fmt_local(dt: datetime) -> str:
+    """naive UTC → 'ДД.ММ.ГГГГ ЧЧ:ММ' в поясе BC_TZ."""
+    return dt.replace(tzinfo=timezone.utc).astimezone(ZoneInfo(settings.BC_TZ)).strftime("%d.%m.%Y %H:%M")
+
+
+def kb_bc_progress(bc_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⏹ Остановить", callback_data=f"adm:bc:stop:{bc_id}")],
+    ])
+
+
+async def _send(bot: Bot, bc: Broadcast, chat_id: int) -> None:
+    if bc.video_id:
+        await bot.send_video(chat_id, video=bc.video_id, caption=bc.text, parse_mode=bc.fmt)
+    elif bc.photo_id:
+        await bot.send_photo(chat_id, photo=bc.photo_id, caption=bc.text, parse_mode=bc.fmt)
+    else:
+        await bot.send_message(chat_id, bc.text, parse_mode=bc.fmt,
+                               disable_web_page_preview=bool(bc.disable_preview))
+
+
+# =========================
+#   Раннер
+# =========================
+class BroadcastRunner:
+    """
+    Рассылки процесса детей. Каждая идёт фоновой задачей: получатели читаются потоком
+    (iter_recipients) и режутся на пачки по BC_CHUNK, пачка отправляется параллельно (до BC_CONCURRENCY)
+    через TokenBucket бота (BC_RATE_PER_SEC, RetryAfter ставит бота на паузу),
+    с приоритетом PRIORITY_BULK в общем governor (ответы пользователям идут вперёд),
+    после пачки в БД сохраняются cursor и счётчики.
+
+    run() периодически подбирает queued/running рассылки тенантов, чьи боты запущены
+    в этом процессе, — так рассылка продолжается после рестарта (повторно уйдёт
+    не больше одной пачки).
+    """
+
+    def __init__(self):
+        self._tasks: Dict[int, asyncio.Task] = {}      # broadcast_id -> задача
+        self._buckets: Dict[int, TokenBucket] = {}     # tenant_id -> лимитер бота
+        self._get_bot: Optional[Callable[[int], Optional[Bot]]] = None
+
+    def bot_for(self, tenant_id: int) -> Optional[Bot]:
+        return self._get_bot(tenant_id) if self._get_bot else None
+
+    def bucket(self, tenant_id: int) -> TokenBucket:
+        b = self._buckets.get(tenant_id)
+        if b is None:
+            b = self._buckets[tenant_id] = TokenBucket(settings.BC_RATE_PER_SEC)
+        return b
+
+    def launch(self, bc_id: int) -> bool:
+        if self._get_bot is None or bc_id in self._tasks:
+            return False
+        task = asyncio.create_task(self._run(bc_id))
+        self._tasks[bc_id] = task
+        task.add_done_callback(lambda _t, i=bc_id: self._tasks.pop(i, None))
+        return True
+
+    async def resume(self) -> int:
+        async with SessionLocal() as s:
+            res = await s.execute(
+                select(Broadcast.id, Broadcast.tenant_id)
+                .where(Broadcast.status.in_(("queued", "running")))
+                .order_by(Broadcast.id)
+            )
+            rows = res.all()
+        started = 0
+        for bc_id, tenant_id in rows:
+            if bc_id not in self._tasks and self._get_bot(tenant_id) is not None:
+                started += self.launch(bc_id)
+        return started
+
+    async def run(self, get_bot: Callable[[int], Optional[Bot]]) -> None:
+        self._get_bot = get_bot
+        while True:
+            try:
+                await self.resume()
+            except Exception as e:
+                logger.exception(f"Broadcast resume error: {e}")
+            await asyncio.sleep(settings.BC_POLL_SEC)
+
+    async def stop(self) -> None:
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # ---------- одна рассылка ----------
+    async def _run(self, bc_id: int) -> None:
+        try:
+            with use_priority(PRIORITY_BULK):
+                await self._run_broadcast(bc_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # статус остаётся running — следующий resume() продолжит с курсора
+            logger.exception(f"Broadcast {bc_id} error: {e}")
+
+    async def _run_broadcast(self, bc_id: int) -> None:
+        async with SessionLocal() as s:
+            bc = (await s.execute(select(Broadcast).where(Broadcast.id == bc_id))).scalar_one_or_none()
+            if bc is None or bc.status not in ("queued", "running"):
+                return
+            if bc.status == "queued":
+                await s.execute(
+                    Broadcast.__table__.update().where(Broadcast.id == bc_id)
+                    .values(status="running", started_at=datetime.utcnow())
+                )
+                await s.commit()
+
+        bucket = self.bucket(bc.tenant_id)
+        sem = asyncio.Semaphore(settings.BC_CONCURRENCY)
+        last_progress = 0.0
+        recipients = iter_recipients(bc.tenant_id, bc.segment, after_id=bc.cursor)
+        async with aclosing(recipients):
+            async for rows in _chunks(recipients, settings.BC_CHUNK):
+                bot = self._get_bot(bc.tenant_id)
+                if bot is None:
+                    return  # бот тенанта остановлен — продолжим, когда снова запустится
+
+                async with SessionLocal() as s:
+                    status, bc.progress_message_id = (await s.execute(
+                        select(Broadcast.status, Broadcast.progress_message_id).where(Broadcast.id == bc_id)
+                    )).one()
+                if status != "running":
+                    await self._progress(
+                        bot, bc, f"Рассылка остановлена ⏹\nОтправлено: {bc.sent} | Ошибок: {bc.failed}"
+                    )
+                    return
+
+                errors = await asyncio.gather(*(self._send_one(bot, bc, uid, bucket, sem) for _, uid in rows))
+                ok_ids = [ua_id for (ua_id, _), err in zip(rows, errors) if err is None]
+                failed = {ua_id: err for (ua_id, _), err in zip(rows, errors) if err is not None}
+                await record_delivery(ok_ids, failed)
+                bc.cursor = rows[-1][0]
+                bc.sent += len(ok_ids)
+                bc.failed += len(failed)
+                async with SessionLocal() as s:
+                    await s.execute(
+                        Broadcast.__table__.update().where(Broadcast.id == bc_id)
+                        .values(cursor=bc.cursor, sent=bc.sent, failed=bc.failed)
+                    )
+                    await s.commit()
+
+                if time.monotonic() - last_progress >= settings.BC_PROGRESS_SEC:
+                    last_progress = time.monotonic()
+                    await self._progress(
+                        bot, bc,
+                        f"Рассылка: {bc.sent + bc.failed}/{bc.total}\nУспешно: {bc.sent} | Ошибок: {bc.failed}",
+                        kb_bc_progress(bc_id),
+                    )
+
+        async with SessionLocal() as s:
+            res = await s.execute(
+                Broadcast.__table__.update().where(Broadcast.id == bc_id, Broadcast.status == "running")
+                .values(status="done", finished_at=datetime.utcnow())
+            )
+            await s.commit()
+        bot = self._get_bot(bc.tenant_id)
+        if res.rowcount and bot is not None:
+            await self._progress(bot, bc, f"Готово ✅\nОтправлено: {bc.sent} | Ошибок: {bc.failed}")
+        logger.info(f"Broadcast {bc_id} (tenant {bc.tenant_id}) done: {bc.sent} ok, {bc.failed} failed")
+
+    async def _send_one(self, bot: Bot, bc: Broadcast, chat_id: int,
+                        bucket: TokenBucket, sem: asyncio.Semaphore) -> Optional[TelegramAPIError]:
+        """None — доставлено, иначе последняя ошибка (см. record_delivery)."""
+        last: Optional[TelegramAPIError] = None
+        async with sem:
+            for _ in range(3):
+                await bucket.acquire()
+                try:
+                    await _send(bot, bc, chat_id)
+                    return None
+                except TelegramRetryAfter as e:
+                    logger.warning(f"Broadcast {bc.id}: flood control, pause {e.retry_after}s")
+                    bucket.pause(e.retry_after)
+                    last = e
+                except TelegramNetworkError as e:
+                    await asyncio.sleep(1)
+                    last = e
+                except TelegramAPIError as e:
+                    return e
+            return last
+
+    @staticmethod
+    async def _progress(bot: Bot, bc: Broadcast, text: str, kb: Optional[InlineKeyboardMarkup] = None) -> None:
+        if not (bc.admin_chat_id and bc.progress_message_id):
+            return
+        try:
+            await bot.edit_message_text(text, chat_id=bc.admin_chat_id,
+                                        message_id=bc.progress_message_id, reply_markup=kb)
+        except Exception:
+            pass
+
+
+class BroadcastScheduler:
+    """
+    Отложенные и повторяющиеся рассылки. Сроки лежат в куче (send_at, id); планировщик
+    спит ровно до ближайшего срока — или пока add() не положит более ранний.
+    Источник правды — БД (status = scheduled): куча заполняется при старте и страховочно
+    пересверяется раз в BC_SCHED_RESYNC_SEC; отменённое отбрасывается при срабатывании.
+
+    Срабатывание забирает рассылку условным UPDATE (несколько процессов не запустят её дважды).
+    В куче только рассылки тенантов, чьи боты запущены в этом процессе: чужой шард или
+    тенант на паузе в кучу не попадают (а при срабатывании выбрасываются), и их сроки
+    подгружает resync(tenant_id), когда реконсилер поднимает бота тенанта здесь.
+    """
+
+    def __init__(self, runner: BroadcastRunner):
+        self.runner = runner
+        self._heap: List[Tuple[datetime, int]] = []
+        self._due: Dict[int, datetime] = {}     # bc_id -> актуальный срок (остальные записи кучи устарели)
+        self._wake = asyncio.Event()
+
+    def add(self, bc_id: int, send_at: datetime) -> None:
+        self._due[bc_id] = send_at
+        heapq.heappush(self._heap, (send_at, bc_id))
+        self._wake.set()
+
+    async def resync(self, tenant_id: Optional[int] = None) -> None:
+        """Сверка кучи с БД: все тенанты процесса или один (его бот только что поднят)."""
+        q = select(Broadcast.id, Broadcast.tenant_id, Broadcast.send_at).where(
+            Broadcast.status == "scheduled", Broadcast.send_at.isnot(None)
+        )
+        if tenant_id is not None:
+            q = q.where(Broadcast.tenant_id == tenant_id)
+        async with SessionLocal() as s:
+            rows = (await s.execute(q)).all()
+        for bc_id, tid, send_at in rows:
+            if self.runner.bot_for(tid) is not None and self._due.get(bc_id) != send_at:
+                self.add(bc_id, send_at)
+
+    async def run(self) -> None:
+        next_resync = 0.0
+        while True:
+            if time.monotonic() >= next_resync:
+                next_resync = time.monotonic() + settings.BC_SCHED_RESYNC_SEC
+                try:
+                    await self.resync()
+                except Exception as e:
+                    logger.exception(f"Broadcast schedule resync error: {e}")
+
+            now = datetime.utcnow()
+            while self._heap and self._heap[0][0] <= now:
+                due, bc_id = heapq.heappop(self._heap)
+                if self._due.get(bc_id) != due:
+                    continue  # запись устарела (срок сдвинут)
+                self._due.pop(bc_id, None)
+                try:
+                    await self._fire(bc_id)
+                except Exception as e:
+                    logger.exception(f"Scheduled broadcast {bc_id} error: {e}")
+
+            timeout = max(next_resync - time.monotonic(), 0.0)
+            if self._heap:
+                timeout = min(timeout, max((self._heap[0][0] - datetime.utcnow()).total_seconds(), 0.0))
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, bc_id: int) -> None:
+        async with SessionLocal() as s:
+            tpl = (await s.execute(select(Broadcast).where(Broadcast.id == bc_id))).scalar_one_or_none()
+        if tpl is None or tpl.status != "scheduled" or tpl.send_at is None:
+            return
+        if tpl.send_at > datetime.utcnow():
+            self.add(bc_id, tpl.send_at)  # срок сдвинули
+            return
+        bot = self.runner.bot_for(tpl.tenant_id)
+        if bot is None:
+            # тенант ушёл с этого шарда или на паузе: срок остаётся в БД, вернётся через resync(tenant_id)
+            return
+        due = tpl.send_at
+        total = await count_recipients(tpl.tenant_id, tpl.segment)
+
+        tbl = Broadcast.__table__
+        claim = tbl.update().where(Broadcast.id == bc_id, Broadcast.status == "scheduled", Broadcast.send_at == due)
+        async with SessionLocal() as s:
+            if tpl.recurrence in RECURRENCE:
+                nxt = next_occurrence(due, tpl.recurrence, datetime.utcnow())
+                res = await s.execute(claim.values(send_at=nxt))
+                if not res.rowcount:
+                    return
+                run = Broadcast(
+                    tenant_id=tpl.tenant_id, status="queued", parent_id=tpl.id, total=total,
+                    **{k: getattr(tpl, k) for k in (
+                        "segment", "text", "photo_id", "video_id", "fmt", "disable_preview", "admin_chat_id",
+                    )},
+                )
+                s.add(run)
+                await s.commit()
+                self.add(bc_id, nxt)
+            else:
+                res = await s.execute(claim.values(status="queued", total=total))
+                if not res.rowcount:
+                    return
+                await s.commit()
+                run = tpl
+        run.total = total
+
+        if run.admin_chat_id:
+            try:
+                msg = await bot.send_message(
+                    run.admin_chat_id,
+                    f"🕒 Запланированная рассылка стартовала… Получателей: {total}",
+                    reply_markup=kb_bc_progress(run.id),
+                )
+                async with SessionLocal() as s:
+                    await s.execute(
+                        tbl.update().where(Broadcast.id == run.id).values(progress_message_id=msg.message_id)
+                    )
+                    await s.commit()
+            except Exception:
+                pass
+        self.runner.launch(run.id)
+
+
+broadcasts = BroadcastRunner()
+scheduler = BroadcastScheduler(broadcasts)
@@ -0,0 +1,178 @@
+# app/bots/child/engine.py
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import hmac
+from typing import Dict, Optional, Set
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramUnauthorizedError
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Update
+
+from app.bots.child.bot_instance import make_child_router
+from app.outbound import governor
+from app.settings import settings
+from app.utils.logging import logger
+
+
+def webhook_secret(tenant_id: int, token: str) -> str:
+    """
+    Секрет для X-Telegram-Bot-Api-Secret-Token. Выводится из токена,
+    поэтому ротация токена автоматически меняет и секрет.
+    """
+    raw = f"{tenant_id}:{token}".encode()
+    return hmac.new(settings.CLICK_SALT.encode(), raw, hashlib.sha256).hexdigest()
+
+
+class ChildBotsEngine:
+    """
+    Один Dispatcher и одно дерево роутеров на все детские боты процесса.
+
+    Каждый тенант — это только Bot (на общей aiohttp-сессии) и его источник апдейтов:
+    getUpdates-цикл (polling) или вебхук (webhook, см. app/web/webhooks.py).
+    Апдейт помечается tenant_id при передаче в dp.feed_update(), поэтому хендлеры
+    получают его как обычный аргумент `tenant_id: int`.
+    """
+
+    def __init__(self, mode: Optional[str] = None):
+        self.mode = mode or settings.CHILD_MODE
+        self.session = AiohttpSession(limit=settings.CHILD_HTTP_POOL_LIMIT)
+        self.session.middleware(governor)   # общие лимиты и приоритеты исходящих запросов
+        self.dp = Dispatcher(storage=MemoryStorage())
+        self.dp.include_router(make_child_router())
+
+        self.bots: Dict[int, Bot] = {}                 # tenant_id -> Bot
+        self._pollers: Dict[int, asyncio.Task] = {}    # tenant_id -> polling task
+        self._secrets: Dict[int, str] = {}             # tenant_id -> webhook secret
+        self._handling: Set[asyncio.Task] = set()      # апдейты в обработке
+
+    # ---------- tenants ----------
+    def has(self, tenant_id: int) -> bool:
+        return tenant_id in self.bots
+
+    def get_bot(self, tenant_id: int) -> Optional[Bot]:
+        return self.bots.get(tenant_id)
+
+    def secret_for(self, tenant_id: int) -> Optional[str]:
+        return self._secrets.get(tenant_id)
+
+    async def add(self, tenant_id: int, token: str) -> Bot:
+        if tenant_id in self.bots:
+            await self.remove(tenant_id)
+        bot = Bot(token, session=self.session, default=DefaultBotProperties(parse_mode="HTML"))
+        self.bots[tenant_id] = bot
+        if self.mode == "webhook":
+            self._secrets[tenant_id] = webhook_secret(tenant_id, token)
+            await self._ensure_webhook(tenant_id, bot, force=True)
+        else:
+            self._pollers[tenant_id] = asyncio.create_task(self._poll(tenant_id, bot))
+        return bot
+
+    async def remove(self, tenant_id: int, teardown: bool = False) -> None:
+        """
+        Останавливает источник апдейтов тенанта.
+        teardown=True — тенант выключен/удалён: снимаем и вебхук в Telegram.
+        """
+        task = self._pollers.pop(tenant_id, None)
+        bot = self.bots.pop(tenant_id, None)
+        self._secrets.pop(tenant_id, None)
+        if task:
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        if teardown and bot and self.mode == "webhook":
+            try:
+                await bot.delete_webhook()
+            except Exception as e:
+                logger.warning(f"delete_webhook failed (tenant {tenant_id}): {e}")
+
+    # ---------- webhooks ----------
+    async def _ensure_webhook(self, tenant_id: int, bot: Bot, force: bool = False) -> None:
+        """
+        Ставит вебхук. Без force — только если в Telegram сейчас другой URL
+        (секрет Telegram не отдаёт, поэтому при (пере)запуске бота ставим всегда).
+        """
+        url = settings.webhook_url(tenant_id)
+        try:
+            if not force:
+                info = await bot.get_webhook_info()
+                if info.url == url:
+                    return
+            await bot.set_webhook(
+                url,
+                secret_token=self._secrets[tenant_id],
+                allowed_updates=self.dp.resolve_used_update_types(),
+            )
+            logger.info(f"Webhook set for tenant {tenant_id}: {url}")
+        except TelegramUnauthorizedError:
+            logger.error(f"Tenant {tenant_id}: token rejected by Telegram, webhook not set")
+        except Exception as e:
+            logger.warning(f"set_webhook failed (tenant {tenant_id}): {e}")
+
+    async def reconcile_webhooks(self) -> None:
+        """Сверка: у каждого запущенного тенанта вебхук указывает на нас."""
+        if self.mode != "webhook":
+            return
+        for tid, bot in list(self.bots.items()):
+            await self._ensure_webhook(tid, bot)
+
+    # ---------- updates ----------
+    def feed(self, tenant_id: int, bot: Bot, update: Update) -> None:
+        """Отдаём апдейт общему диспетчеру, не блокируя источник."""
+        task = asyncio.create_task(self._process(tenant_id, bot, update))
+        self._handling.add(task)
+        task.add_done_callback(self._handling.discard)
+
+    async def _process(self, tenant_id: int, bot: Bot, update: Update) -> None:
+        try:
+            await self.dp.feed_update(bot, update, tenant_id=tenant_id)
+        except Exception as e:
+            logger.exception(f"Update error (tenant {tenant_id}): {e}")
+
+    async def _poll(self, tenant_id: int, bot: Bot) -> None:
+        allowed = self.dp.resolve_used_update_types()
+        timeout = settings.CHILD_POLL_TIMEOUT
+        offset: Optional[int] = None
+        backoff = 1.0
+        try:
+            # если раньше бот работал на вебхуке — getUpdates вернёт 409
+            await bot.delete_webhook()
+        except Exception:
+            pass
+        while True:
+            try:
+                updates = await bot.get_updates(
+                    offset=offset,
+                    timeout=timeout,
+                    allowed_updates=allowed,
+                    request_timeout=int(self.session.timeout + timeout),
+                )
+            except asyncio.CancelledError:
+                raise
+            except TelegramUnauthorizedError:
+                logger.error(f"Tenant {tenant_id}: token rejected by Telegram, polling stopped")
+                return
+            except Exception as e:
+                logger.warning(f"Polling error (tenant {tenant_id}): {e}; retry in {backoff:.0f}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+                continue
+
+            backoff = 1.0
+            for upd in updates:
+                offset = upd.update_id + 1
+                self.feed(tenant_id, bot, upd)
+
+    # ---------- shutdown ----------
+    async def close(self) -> None:
+        for tid in list(self._pollers):
+            await self.remove(tid)
+        if self._handling:
+            await asyncio.gather(*self._handling, return_exceptions=True)
+        await self.session.close()
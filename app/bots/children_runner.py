@@ -1,31 +1,228 @@
 import asyncio
+import multiprocessing as mp
+import signal
+import time
 from typing import Dict
 from sqlalchemy import select
 from app.db import SessionLocal
 from app.models import Tenant
-from app.bots.child.bot_instance import run_child_bot
+from app.bots.child.engine import ChildBotsEngine
+from app.bots.child.broadcast import broadcasts, scheduler
+from app.bots.child.bot_instance import (
+    enable_last_message_write_behind, run_last_message_flusher, flush_last_message_ids,
+)
+from app.settings import settings
+from app.tenant_config import note_tenant_version
 from app.utils.logging import logger
 
 class ChildrenManager:
-    def __init__(self):
-        self.tasks: Dict[int, asyncio.Task] = {}
+    """
+    Реконсилер детских ботов шарда: сравнивает желаемое состояние (таблица tenants)
+    с запущенным и трогает только изменившихся тенантов.
+
+    Дёшево: каждый тик читает лишь (id, version); полные строки грузятся только
+    для тенантов, чей version изменился с прошлого тика.
+    """
+
+    def __init__(self, engine: ChildBotsEngine, shard: int = 0):
+        self.engine = engine
+        self.shard = shard
+        self.seen: Dict[int, int] = {}      # tenant_id -> version, уже применённая
+        self.tokens: Dict[int, str] = {}    # tenant_id -> токен запущенного бота
+        self.restarts: Dict[int, int] = {}  # tenant_id -> restart_seq, уже применённый
+        self._last_reconcile = time.monotonic()
+
+    def owns(self, tenant_id: int) -> bool:
+        return settings.child_shard(tenant_id) == self.shard
+
+    async def _stop(self, tid: int, reason: str):
+        if tid in self.tokens or self.engine.has(tid):
+            logger.info(f"[shard {self.shard}] Stopping child bot for tenant {tid} ({reason})")
+            await self.engine.remove(tid, teardown=True)
+        self.tokens.pop(tid, None)
 
     async def tick(self):
         async with SessionLocal() as s:
-            res = await s.execute(select(Tenant).where(Tenant.is_active == True))
-            tenants = res.scalars().all()
-        for t in tenants:
-            if t.id not in self.tasks:
-                logger.info(f"Starting child bot for tenant {t.id} @ {t.bot_username}")
-                self.tasks[t.id] = asyncio.create_task(run_child_bot(t.bot_token, t.id))
-
-        # TODO: detect token changes/deactivation and restart tasks
-
-async def run_children_loop():
-    manager = ChildrenManager()
-    while True:
-        try:
-            await manager.tick()
-        except Exception as e:
-            logger.exception(f"Tick error: {e}")
-        await asyncio.sleep(2)
+            res = await s.execute(select(Tenant.id, Tenant.version))
+            versions = res.all()
+            desired = {tid: ver for tid, ver in versions if self.owns(tid)}
+            changed = [tid for tid, ver in desired.items() if self.seen.get(tid) != ver]
+            rows = []
+            if changed:
+                res = await s.execute(
+                    select(Tenant.id, Tenant.version, Tenant.bot_token, Tenant.bot_username, Tenant.is_active,
+                           Tenant.restart_seq)
+                    .where(Tenant.id.in_(changed))
+                )
+                rows = res.all()
+
+        # version уже прочитан — заодно сбрасываем устаревшие снимки конфига
+        for tid, ver in versions:
+            note_tenant_version(tid, ver)
+
+        # удалённые тенанты
+        for tid in [tid for tid in self.seen if tid not in desired]:
+            await self._stop(tid, "deleted")
+            self.seen.pop(tid, None)
+            self.restarts.pop(tid, None)
+
+        for row in rows:
+            tid = row.id
+            if not (row.is_active and row.bot_token):
+                await self._stop(tid, "paused")
+            elif self.tokens.get(tid) != row.bot_token or self.restarts.get(tid, row.restart_seq) != row.restart_seq:
+                if tid in self.tokens:
+                    # ротация токена: старый бот больше не наш; или админ попросил перезапуск
+                    await self._stop(tid, "token changed" if self.tokens[tid] != row.bot_token else "restart requested")
+                logger.info(f"[shard {self.shard}] Starting child bot for tenant {tid} @ {row.bot_username}")
+                await self.engine.add(tid, row.bot_token)
+                self.tokens[tid] = row.bot_token
+                try:
+                    await scheduler.resync(tid)   # отложенные рассылки тенанта теперь ведёт этот шард
+                except Exception as e:
+                    # не страшно: подхватит периодическая пересверка планировщика
+                    logger.warning(f"[shard {self.shard}] schedule resync for tenant {tid} failed: {e}")
+            self.seen[tid] = row.version
+            self.restarts[tid] = row.restart_seq or 0
+
+        # вебхуки: периодически сверяем, что Telegram шлёт апдейты к нам
+        if time.monotonic() - self._last_reconcile >= settings.WEBHOOK_RECONCILE_SEC:
+            self._last_reconcile = time.monotonic()
+            await self.engine.reconcile_webhooks()
+
+
+async def _serve_webhooks(engine: ChildBotsEngine, shard: int):
+    import uvicorn
+    from app.web.webhooks import make_webhook_app
+
+    config = uvicorn.Config(
+        make_webhook_app(engine, shard),
+        host=settings.WEBHOOK_HOST,
+        port=settings.WEBHOOK_PORT + shard,
+        log_level="warning",
+    )
+    await uvicorn.Server(config).serve()
+
+
+async def run_children_loop(shard: int = 0):
+    engine = ChildBotsEngine()
+    manager = ChildrenManager(engine, shard)
+    enable_last_message_write_behind()
+    background = [
+        asyncio.create_task(run_last_message_flusher()),
+        # рассылки тенантов этого шарда: новые и прерванные рестартом
+        asyncio.create_task(broadcasts.run(engine.get_bot)),
+        asyncio.create_task(scheduler.run()),      # отложенные/повторяющиеся рассылки
+    ]
+    if engine.mode == "webhook":
+        background.append(asyncio.create_task(_serve_webhooks(engine, shard)))
+    try:
+        while True:
+            try:
+                await manager.tick()
+            except Exception as e:
+                logger.exception(f"Tick error: {e}")
+            await asyncio.sleep(2)
+    finally:
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        await broadcasts.stop()
+        await engine.close()
+        await flush_last_message_ids()
+
+
+async def run_until_signal(coro) -> None:
+    """
+    Выполняет coro, пока не придёт SIGTERM/SIGINT, затем отменяет её — так finally
+    run_children_loop (сброс last_bot_message_id, остановка рассылок, закрытие сессии)
+    успевает отработать и при systemctl stop, и при остановке шарда супервизором.
+    """
+    loop = asyncio.get_running_loop()
+    task = asyncio.ensure_future(coro)
+    stopping = False
+
+    def _cancel():
+        nonlocal stopping
+        if not stopping:        # повторный сигнал не должен прервать уже идущую очистку
+            stopping = True
+            task.cancel()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, _cancel)
+    try:
+        await task
+    except asyncio.CancelledError:
+        if not stopping:
+            raise
+    finally:
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(sig)
+
+
+# =========================
+#   Supervisor (CHILD_SHARDS > 1)
+# =========================
+def _shard_main(shard: int):
+    asyncio.run(run_until_signal(run_children_loop(shard)))
+
+
+def run_children_supervisor():
+    """
+    Поднимает CHILD_SHARDS процессов, каждый обслуживает тенантов своего шарда
+    (settings.child_shard). Упавший шард перезапускается, остальные не трогаются.
+    Добавленные/удалённые тенанты подхватываются тиком своего шарда.
+    """
+    ctx = mp.get_context("spawn")
+    shards = settings.CHILD_SHARDS
+    procs: Dict[int, mp.Process] = {}
+    started_at: Dict[int, float] = {}
+    restart_at: Dict[int, float] = {}
+    backoff: Dict[int, float] = {}
+    stopping = False
+
+    def _stop(*_):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    def _spawn(i: int):
+        p = ctx.Process(target=_shard_main, args=(i,), name=f"children-shard-{i}", daemon=False)
+        p.start()
+        procs[i] = p
+        started_at[i] = time.monotonic()
+        logger.info(f"Shard {i}/{shards} started (pid {p.pid})")
+
+    for i in range(shards):
+        _spawn(i)
+
+    while not stopping:
+        now = time.monotonic()
+        for i, p in list(procs.items()):
+            if p.is_alive():
+                continue
+            if i not in restart_at:
+                # растущая задержка, если шард падает сразу после старта
+                delay = backoff.get(i, 0.0)
+                backoff[i] = min(max(delay * 2, 1.0), 60.0)
+                restart_at[i] = now + delay
+                logger.error(f"Shard {i} exited with code {p.exitcode}; restart in {delay:.0f}s")
+            elif now >= restart_at[i]:
+                restart_at.pop(i)
+                _spawn(i)
+        for i in list(backoff):
+            # шард проработал минуту — сбрасываем backoff
+            if i not in restart_at and procs[i].is_alive() and now - started_at[i] > 60:
+                backoff.pop(i, None)
+        time.sleep(1)
+
+    for p in procs.values():
+        if p.is_alive():
+            p.terminate()
+    for p in procs.values():
+        p.join(timeout=15)
+        if p.is_alive():
+            logger.error(f"{p.name} did not stop in 15s, killing")
+            p.kill()
@@ -8,17 +8,21 @@ from datetime import datetime
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.client.default import DefaultBotProperties
 from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import Message, CallbackQuery, ChatMemberUpdated, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.exceptions import TelegramForbiddenError
 
 from sqlalchemy import select, func
 
 from app.settings import settings
 from app.db import SessionLocal
+from app.membership import is_member, note_chat_member
 from app.models import (
     Tenant, UserAccess, Event,
-    ContentOverride, UserLang, UserState,
+    ContentOverride, UserLang, UserState, TenantDailyStats, Broadcast,
+    PushJob, PostbackDedup, AssetFileId,
 )
+from app.stats import UserStats, daily_trend, format_trend, user_stats, user_stats_by_tenant
+from app.tenant_config import invalidate_tenant
 
 router = Router()
 
@@ -69,9 +73,7 @@ WELCOME_NO_RU = (
 async def on_start(m: Message):
     user_id = m.from_user.id
     try:
-        member = await m.bot.get_chat_member(settings.PRIVATE_CHANNEL_ID, user_id)
-        status = getattr(member, "status", None)
-        if status in {"creator", "administrator", "member"}:
+        if await is_member(m.bot, settings.PRIVATE_CHANNEL_ID, user_id):
             await m.answer(WELCOME_OK_RU)
         else:
             await m.answer(WELCOME_NO_RU)
@@ -94,6 +96,12 @@ async def on_start(m: Message):
             )
 
 
+@router.chat_member(F.chat.id == settings.PRIVATE_CHANNEL_ID)
+async def on_private_member(ev: ChatMemberUpdated):
+    # вступил/вышел из приватки — /start увидит это без запроса к Telegram
+    note_chat_member(ev)
+
+
 @router.message(F.text.regexp(r"^\d{6,}:[A-Za-z0-9_-]{20,}$"))
 async def on_token(m: Message):
     token = (m.text or "").strip()
@@ -126,6 +134,7 @@ async def on_token(m: Message):
             tenant.bot_username = username
             tenant.is_active = True
         await s.commit()
+    invalidate_tenant(tenant.id)
 
     link = f"https://t.me/{username}" if username else "https://t.me/"
     await m.answer(
@@ -135,18 +144,20 @@ async def on_token(m: Message):
 
 
 # ----------------- Сверх-админка /ga -----------------
-def _kb_ga_home(tenants, page: int, more: bool) -> InlineKeyboardMarkup:
+def _kb_ga_home(tenants, page: int, more: bool, stats: dict | None = None) -> InlineKeyboardMarkup:
     rows: list[list[InlineKeyboardButton]] = []
     # верхний ряд: Деплой / Рестарт
     rows.append([
         InlineKeyboardButton(text="🚀 Деплой", callback_data="ga:deploy"),
-        InlineKeyboardButton(text="🔄 Рестарт детей", callback_data="ga:restart_children"),
+        InlineKeyboardButton(text="🔄 Рестарт всех детей", callback_data="ga:restart_children"),
     ])
     # список тенантов
     for t in tenants:
         name = f"@{t.bot_username}" if t.bot_username else f"id={t.id}"
         badge = "🟢" if t.is_active else "⏸"
-        rows.append([InlineKeyboardButton(text=f"{badge} Тенант #{t.id} {name}", callback_data=f"ga:t:{t.id}")])
+        users = (stats or {}).get(t.id, UserStats()).total
+        rows.append([InlineKeyboardButton(text=f"{badge} Тенант #{t.id} {name} · 👤{users}",
+                                          callback_data=f"ga:t:{t.id}")])
     # навигация
     nav = []
     if page > 0:
@@ -164,7 +175,7 @@ def _kb_tenant_card(t: Tenant) -> InlineKeyboardMarkup:
         rows.append([InlineKeyboardButton(text="⏸ Пауза", callback_data=f"ga:t:pause:{t.id}")])
     else:
         rows.append([InlineKeyboardButton(text="▶️ Старт", callback_data=f"ga:t:start:{t.id}")])
-    rows.append([InlineKeyboardButton(text="🔁 Рестарт детей", callback_data=f"ga:t:restart:{t.id}")])
+    rows.append([InlineKeyboardButton(text="🔁 Перезапустить бота", callback_data=f"ga:t:restart:{t.id}")])
     # вспомогательные
     rows.append([InlineKeyboardButton(text="🧹 Удалить", callback_data=f"ga:t:delete_confirm:{t.id}")])
     rows.append([InlineKeyboardButton(text="🏠 Меню", callback_data="ga:home:0")])
@@ -179,23 +190,12 @@ async def ga_entry(m: Message):
 
 
 async def _ga_home(m_or_c: Message | CallbackQuery, page: int = 0):
-    # суммарная статистика
+    # суммарная статистика: один проход по user_access, сгруппированный по тенантам
+    by_tenant = await user_stats_by_tenant()
+    total = sum(by_tenant.values(), UserStats())
+    day, week = await daily_trend()
     async with SessionLocal() as s:
         t_count = (await s.execute(select(func.count()).select_from(Tenant))).scalar() or 0
-        u_total = (await s.execute(select(func.count()).select_from(UserAccess))).scalar() or 0
-        u_reg = (await s.execute(
-            select(func.count()).select_from(UserAccess).where(UserAccess.is_registered == True)
-        )).scalar() or 0
-        u_dep = (await s.execute(
-            select(func.count()).select_from(UserAccess).where(UserAccess.has_deposit == True)
-        )).scalar() or 0
-        u_vip = (await s.execute(
-            select(func.count()).select_from(UserAccess).where(UserAccess.is_platinum == True)
-        )).scalar() or 0
-        dep_sum = (await s.execute(
-            select(func.coalesce(func.sum(Event.amount), 0.0)).where(Event.kind.in_(("ftd", "rd")))
-        )).scalar() or 0.0
-
         res = await s.execute(
             select(Tenant).order_by(Tenant.id.asc()).offset(page * PAGE_SIZE).limit(PAGE_SIZE)
         )
@@ -205,14 +205,15 @@ async def _ga_home(m_or_c: Message | CallbackQuery, page: int = 0):
     txt = (
         "📊 <b>Глобальная статистика</b>\n"
         f"Тенантов: {t_count}\n"
-        f"Пользователей: {u_total}\n"
-        f"Регистраций: {u_reg}\n"
-        f"С депозитом: {u_dep}\n"
-        f"Platinum: {u_vip}\n"
-        f"Сумма депозитов: {_fmt_money(dep_sum)}\n\n"
+        f"Пользователей: {total.total}\n"
+        f"Регистраций: {total.regs}\n"
+        f"С депозитом: {total.deps}\n"
+        f"Platinum: {total.plats}\n"
+        f"Сумма депозитов: {_fmt_money(total.dep_sum)}\n\n"
+        f"{format_trend(day, week)}\n\n"
         "Выберите тенанта:"
     )
-    kb = _kb_ga_home(tenants, page, more)
+    kb = _kb_ga_home(tenants, page, more, by_tenant)
 
     if isinstance(m_or_c, CallbackQuery):
         await m_or_c.message.edit_text(txt, reply_markup=kb)
@@ -249,7 +250,8 @@ async def ga_deploy(c: CallbackQuery):
 async def ga_restart_children(c: CallbackQuery):
     if not _is_ga(c.from_user.id):
         return
-    await c.answer("Перезапускаю детей…")
+    # явный «рестарт всех»: перезапускает весь сервис (все шарды); одного тенанта — ga:t:restart
+    await c.answer("Перезапускаю всех детей…")
     code, out = await _run(f"systemctl restart {CHILD_SERVICE}")
     if code == 0:
         await c.message.answer("✅ Дети перезапущены.")
@@ -260,15 +262,10 @@ async def ga_restart_children(c: CallbackQuery):
 
 # ---- Карточка тенанта ----
 async def _tenant_stats(tid: int) -> dict:
-    async with SessionLocal() as s:
-        total = (await s.execute(select(func.count()).select_from(UserAccess).where(UserAccess.tenant_id == tid))).scalar() or 0
-        regs = (await s.execute(select(func.count()).select_from(UserAccess).where(UserAccess.tenant_id == tid, UserAccess.is_registered == True))).scalar() or 0
-        deps = (await s.execute(select(func.count()).select_from(UserAccess).where(UserAccess.tenant_id == tid, UserAccess.has_deposit == True))).scalar() or 0
-        plats = (await s.execute(select(func.count()).select_from(UserAccess).where(UserAccess.tenant_id == tid, UserAccess.is_platinum == True))).scalar() or 0
-        dep_sum = (await s.execute(
-            select(func.coalesce(func.sum(Event.amount), 0.0)).where(Event.tenant_id == tid, Event.kind.in_(("ftd", "rd")))
-        )).scalar() or 0.0
-    return {"total": total, "regs": regs, "deps": deps, "plats": plats, "sum": dep_sum}
+    st = await user_stats(tid)
+    day, week = await daily_trend(tid)
+    return {"total": st.total, "regs": st.regs, "deps": st.deps, "plats": st.plats, "sum": st.dep_sum,
+            "trend": format_trend(day, week)}
 
 
 def _format_tenant_card(t: Tenant, st: dict) -> str:
@@ -287,6 +284,8 @@ def _format_tenant_card(t: Tenant, st: dict) -> str:
         f"С депозитом: {st['deps']}",
         f"Platinum: {st['plats']}",
         f"Сумма депозитов: {_fmt_money(st['sum'])}",
+        "",
+        st["trend"],
     ]
     return "\n".join(lines)
 
@@ -326,8 +325,9 @@ async def ga_tenant_start(c: CallbackQuery):
     async with SessionLocal() as s:
         await s.execute(Tenant.__table__.update().where(Tenant.id == tid).values(is_active=True))
         await s.commit()
-    await _run(f"systemctl restart {CHILD_SERVICE}")
-    await c.answer("Включен и перезапущены дети")
+    invalidate_tenant(tid)
+    # раннер детей сам поднимет бота по изменению tenants.version
+    await c.answer("Включен")
     await _show_tenant_card(c, tid)
 
 
@@ -339,7 +339,8 @@ async def ga_tenant_pause(c: CallbackQuery):
     async with SessionLocal() as s:
         await s.execute(Tenant.__table__.update().where(Tenant.id == tid).values(is_active=False))
         await s.commit()
-    await _run(f"systemctl restart {CHILD_SERVICE}")
+    invalidate_tenant(tid)
+    # раннер детей сам остановит только этого бота
     await c.answer("Поставлен на паузу")
     await _show_tenant_card(c, tid)
 
@@ -349,8 +350,15 @@ async def ga_tenant_restart(c: CallbackQuery):
     if not _is_ga(c.from_user.id):
         return
     tid = int(c.data.split(":")[3])
-    await c.answer("Перезапускаю детей…")
-    await _run(f"systemctl restart {CHILD_SERVICE}")
+    async with SessionLocal() as s:
+        await s.execute(
+            Tenant.__table__.update().where(Tenant.id == tid)
+            .values(restart_seq=func.coalesce(Tenant.restart_seq, 0) + 1)
+        )
+        await s.commit()
+    invalidate_tenant(tid)
+    # раннер детей перезапустит только этого бота (остальные тенанты и шарды не трогаются)
+    await c.answer("Бот будет перезапущен в течение пары секунд")
     await _show_tenant_card(c, tid)
 
 
@@ -378,16 +386,25 @@ async def ga_tenant_delete(c: CallbackQuery):
 
     # Полная очистка данных тенанта
     async with SessionLocal() as s:
+        token = (await s.execute(select(Tenant.bot_token).where(Tenant.id == tid))).scalar_one_or_none()
         await s.execute(UserState.__table__.delete().where(UserState.tenant_id == tid))
         await s.execute(UserLang.__table__.delete().where(UserLang.tenant_id == tid))
         await s.execute(Event.__table__.delete().where(Event.tenant_id == tid))
         await s.execute(UserAccess.__table__.delete().where(UserAccess.tenant_id == tid))
         await s.execute(ContentOverride.__table__.delete().where(ContentOverride.tenant_id == tid))
+        await s.execute(TenantDailyStats.__table__.delete().where(TenantDailyStats.tenant_id == tid))
+        await s.execute(Broadcast.__table__.delete().where(Broadcast.tenant_id == tid))
+        await s.execute(PushJob.__table__.delete().where(PushJob.tenant_id == tid))
+        await s.execute(PostbackDedup.__table__.delete().where(PostbackDedup.tenant_id == tid))
+        if token and token.split(":", 1)[0].isdigit():
+            # file_id картинок привязаны к боту (id = число до ":" в токене)
+            await s.execute(AssetFileId.__table__.delete().where(AssetFileId.bot_id == int(token.split(":", 1)[0])))
         await s.execute(Tenant.__table__.delete().where(Tenant.id == tid))
         await s.commit()
+    invalidate_tenant(tid)
 
-    await _run(f"systemctl restart {CHILD_SERVICE}")
-    await c.message.edit_text("🗑 Тенант и все его данные удалены. Дети перезапущены.")
+    # бот тенанта остановится на ближайшем тике раннера детей
+    await c.message.edit_text("🗑 Тенант и все его данные удалены. Бот остановлен.")
     await c.answer()
 
 
@@ -44,6 +44,15 @@ class Base(DeclarativeBase):
     pass
 
 
+def dialect_insert(table):
+    """INSERT текущего диалекта (sqlite/postgresql) — с поддержкой on_conflict_do_*."""
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+
 # -----------------------------------------------------------------------------
 # SQLite PRAGMAs (если используем SQLite)
 # -----------------------------------------------------------------------------
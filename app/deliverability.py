@@ -0,0 +1,72 @@
+# app/deliverability.py
+from __future__ import annotations
+
+from datetime import datetime
+from typing import Dict, Iterable
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from sqlalchemy import bindparam, func
+
+from app.db import SessionLocal
+from app.models import UserAccess
+
+# Ответы Telegram, после которых писать в чат бессмысленно, пока пользователь сам не вернётся
+_DEAD_BAD_REQUESTS = ("chat not found", "user is deactivated", "peer_id_invalid", "bot was blocked")
+
+
+class ChatUnreachable(Exception):
+    """Чат пользователя мёртв (бот заблокирован, чата нет) — повторять отправку не нужно."""
+
+
+def is_dead_chat_error(exc: BaseException) -> bool:
+    if isinstance(exc, TelegramForbiddenError):
+        return True
+    if isinstance(exc, TelegramBadRequest):
+        msg = str(exc.message or exc).lower()
+        return any(m in msg for m in _DEAD_BAD_REQUESTS)
+    return False
+
+
+def _err_text(exc: BaseException) -> str:
+    return (f"{type(exc).__name__}: {exc}")[:255]
+
+
+async def record_delivery(ok_ids: Iterable[int] = (), failed: Dict[int, BaseException] | None = None) -> None:
+    """
+    Итоги отправок по UserAccess.id — пачкой, одной транзакцией:
+    успех сбрасывает счётчик ошибок (UPDATE только тем, у кого он не 0),
+    мёртвый чат ставит blocked_at, любая ошибка — fail_count + 1 и last_error.
+    """
+    ok_ids = list(ok_ids)
+    failed = failed or {}
+    if not ok_ids and not failed:
+        return
+    tbl = UserAccess.__table__
+    now = datetime.utcnow()
+    dead = [{"_id": i, "_err": _err_text(e)} for i, e in failed.items() if is_dead_chat_error(e)]
+    soft = [{"_id": i, "_err": _err_text(e)} for i, e in failed.items() if not is_dead_chat_error(e)]
+    async with SessionLocal() as s:
+        if ok_ids:
+            await s.execute(
+                tbl.update().where(UserAccess.id.in_(ok_ids), UserAccess.fail_count > 0)
+                .values(fail_count=0, last_error=None)
+            )
+        if dead:
+            await s.execute(
+                tbl.update().where(UserAccess.id == bindparam("_id")).values(
+                    blocked_at=func.coalesce(UserAccess.blocked_at, now),
+                    fail_count=func.coalesce(UserAccess.fail_count, 0) + 1,
+                    last_error=bindparam("_err"),
+                ),
+                dead,
+            )
+        if soft:
+            await s.execute(
+                tbl.update().where(UserAccess.id == bindparam("_id")).values(
+                    fail_count=func.coalesce(UserAccess.fail_count, 0) + 1,
+                    last_error=bindparam("_err"),
+                ),
+                soft,
+            )
+        await s.commit()
+
@@ -0,0 +1,107 @@
+# app/event_log.py
+from __future__ import annotations
+
+import asyncio
+from typing import List, Optional
+
+from sqlalchemy.exc import DataError, IntegrityError
+
+from app.db import SessionLocal
+from app.models import Event
+from app.settings import settings
+from app.utils.logging import logger
+
+
+class EventWriter:
+    """
+    Буферизованная запись в events. log() кладёт строку в память, фоновая задача
+    сбрасывает буфер одним executemany каждые EVENT_FLUSH_MS или при EVENT_FLUSH_ROWS строк.
+    Так диагностические события (push_sent, push_error, ...) не стоят транзакции каждое.
+
+    - log(..., sync=True) — строка пишется сразу (вместе с накопленным буфером), для событий,
+      от которых зависит доступ. То же самое, пока writer не запущен (скрипты) или EVENT_WRITER_SYNC=1.
+    - stop() сбрасывает остаток — вызывать при остановке процесса.
+    - Упавший flush возвращает строки в буфер (не больше EVENT_BUFFER_MAX, старые отбрасываются).
+      Кривая строка (IntegrityError/DataError) пачку не блокирует: пачка пишется поштучно,
+      а такие строки отбрасываются с предупреждением.
+    """
+
+    def __init__(self, max_rows: Optional[int] = None, max_delay_ms: Optional[float] = None,
+                 sync: Optional[bool] = None):
+        self.max_rows = max_rows or settings.EVENT_FLUSH_ROWS
+        self.max_delay = (max_delay_ms if max_delay_ms is not None else settings.EVENT_FLUSH_MS) / 1000
+        self.sync = settings.EVENT_WRITER_SYNC if sync is None else sync
+        self._buf: List[dict] = []
+        self._lock = asyncio.Lock()
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def log(self, values: dict, *, sync: bool = False) -> None:
+        self._buf.append(values)
+        if sync or self.sync or self._task is None:
+            await self.flush()
+        elif len(self._buf) >= self.max_rows:
+            self._full.set()
+
+    async def flush(self) -> int:
+        async with self._lock:
+            if not self._buf:
+                return 0
+            batch, self._buf = self._buf, []
+            try:
+                await self._insert(batch)
+            except (IntegrityError, DataError):
+                return await self._insert_each(batch)
+            except Exception:
+                self._buf[:0] = batch
+                overflow = len(self._buf) - settings.EVENT_BUFFER_MAX
+                if overflow > 0:
+                    del self._buf[:overflow]
+                    logger.warning(f"Event buffer overflow: dropped {overflow} rows")
+                raise
+            return len(batch)
+
+    @staticmethod
+    async def _insert(rows: List[dict]) -> None:
+        async with SessionLocal() as s:
+            await s.execute(Event.__table__.insert(), rows)
+            await s.commit()
+
+    async def _insert_each(self, rows: List[dict]) -> int:
+        ok = 0
+        for row in rows:
+            try:
+                await self._insert([row])
+                ok += 1
+            except (IntegrityError, DataError) as e:
+                logger.warning(f"Event dropped ({row.get('kind')}): {e}")
+        return ok
+
+    async def _flush_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.warning(f"Event flush failed ({len(self._buf)} rows kept): {e}")
+
+    def start(self) -> None:
+        if self._task is None and not self.sync:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+event_writer = EventWriter()
@@ -0,0 +1,60 @@
+# app/membership.py
+from __future__ import annotations
+
+import time
+from typing import Dict, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.types import ChatMemberUpdated
+
+from app.settings import settings
+
+MEMBER_STATUSES = {"creator", "administrator", "member"}
+
+# (channel_id, user_id) -> (monotonic истечения, состоит ли)
+_CACHE: Dict[Tuple[int, int], Tuple[float, bool]] = {}
+
+
+def _put(channel_id: int, user_id: int, member: bool) -> None:
+    if len(_CACHE) >= settings.MEMBER_CACHE_MAX:
+        now = time.monotonic()
+        for key in [k for k, (exp, _) in _CACHE.items() if exp <= now]:
+            del _CACHE[key]
+        if len(_CACHE) >= settings.MEMBER_CACHE_MAX:
+            _CACHE.clear()
+    ttl = settings.MEMBER_CACHE_TTL if member else settings.MEMBER_CACHE_NEG_TTL
+    _CACHE[(channel_id, user_id)] = (time.monotonic() + ttl, member)
+
+
+def cached_membership(channel_id: int, user_id: int) -> Optional[bool]:
+    hit = _CACHE.get((channel_id, user_id))
+    if hit and hit[0] > time.monotonic():
+        return hit[1]
+    return None
+
+
+async def is_member(bot: Bot, channel_id: int, user_id: int) -> bool:
+    """
+    Состоит ли пользователь в канале. Положительный ответ кэшируется на MEMBER_CACHE_TTL,
+    отрицательный — на MEMBER_CACHE_NEG_TTL. Ошибки get_chat_member пробрасываются и не кэшируются.
+    """
+    hit = cached_membership(channel_id, user_id)
+    if hit is not None:
+        return hit
+    member = await bot.get_chat_member(channel_id, user_id)
+    ok = getattr(member, "status", None) in MEMBER_STATUSES
+    _put(channel_id, user_id, ok)
+    return ok
+
+
+def note_chat_member(event: ChatMemberUpdated) -> None:
+    """Апдейт chat_member (приходит, если бот — админ канала): вступил/вышел — обновляем кэш сразу."""
+    status = getattr(event.new_chat_member, "status", None)
+    _put(event.chat.id, event.new_chat_member.user.id, status in MEMBER_STATUSES)
+
+
+def invalidate_membership(channel_id: Optional[int] = None, user_id: Optional[int] = None) -> None:
+    if channel_id is None:
+        _CACHE.clear()
+    else:
+        _CACHE.pop((channel_id, user_id), None)
@@ -1,14 +1,18 @@
 # app/models.py
-from datetime import datetime
+from datetime import date, datetime
 from sqlalchemy import (
     BigInteger,
     String,
     Boolean,
     DateTime,
+    Date,
     Integer,
     UniqueConstraint,
     Text,
     Float,
+    Index,
+    literal_column,
+    text,
 )
 from sqlalchemy.orm import Mapped, mapped_column
 from app.db import Base
@@ -45,6 +49,17 @@ class Tenant(Base):
     min_deposit_usd = mapped_column(Float, default=10.0)  # Минимальный суммарный деп
     platinum_threshold_usd = mapped_column(Float, default=500.0)
 
+    # Маркер изменений: растёт при любом UPDATE строки (ORM и Core update()),
+    # по нему раннер детей и кэши видят, что конфиг тенанта поменялся.
+    updated_at: Mapped[datetime | None] = mapped_column(
+        DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=True
+    )
+    version: Mapped[int] = mapped_column(
+        Integer, default=1, server_default="1", onupdate=literal_column("version + 1")
+    )
+    # +1 = перезапустить бота только этого тенанта (раннер детей сравнивает с увиденным)
+    restart_seq: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+
 class UserLang(Base):
     __tablename__ = "user_lang"
     __table_args__ = (UniqueConstraint("tenant_id", "user_id", name="uq_user_lang"),)
@@ -63,14 +78,26 @@ class UserState(Base):
     tenant_id: Mapped[int] = mapped_column(Integer, index=True)
     chat_id: Mapped[int] = mapped_column(BigInteger, index=True)
     last_bot_message_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    # индекс: процесс детей раз в секунду читает «что изменилось» (sync_last_message_ids)
     updated_at: Mapped[datetime] = mapped_column(
-        DateTime, default=datetime.utcnow, onupdate=datetime.utcnow
+        DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True
     )
 
 
 class UserAccess(Base):
     __tablename__ = "user_access"
-    __table_args__ = (UniqueConstraint("tenant_id", "user_id", name="uq_user_access"),)
+    __table_args__ = (
+        UniqueConstraint("tenant_id", "user_id", name="uq_user_access"),
+        # покрывающий под статистику тенанта (SUM(CASE …) по флагам, сумма депозитов)
+        # и подсчёт получателей рассылки — таблицу не читаем вовсе
+        Index("ix_user_access_tenant_stats", "tenant_id", "is_registered", "has_deposit",
+              "is_platinum", "deposit_total", "blocked_at"),
+        # частичные под страницы рассылки по сегментам reg/dep (keyset по id только среди своих)
+        Index("ix_user_access_tenant_registered", "tenant_id",
+              sqlite_where=text("is_registered = 1"), postgresql_where=text("is_registered")),
+        Index("ix_user_access_tenant_deposit", "tenant_id",
+              sqlite_where=text("has_deposit = 1"), postgresql_where=text("has_deposit")),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     tenant_id: Mapped[int] = mapped_column(Integer, index=True)
@@ -83,7 +110,16 @@ class UserAccess(Base):
     click_id: Mapped[str | None] = mapped_column(String(64), unique=True, index=True)
     trader_id: Mapped[str | None] = mapped_column(String(64), nullable=True)
     total_deposits: Mapped[int] = mapped_column(Integer, default=0)
+    # Накопительные суммы депозитов (ftd+rd); пишутся в одной транзакции с событием,
+    # пересобираются из events скриптом scripts/rebuild_deposit_totals.py
+    deposit_total: Mapped[float] = mapped_column(Float, default=0.0, server_default="0")
+    deposit_count: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
     username: Mapped[str | None] = mapped_column(String(64), nullable=True)
+    # Доставляемость: blocked_at — бот заблокирован / чата нет (рассылки и пуши пропускают),
+    # fail_count — ошибок отправки подряд, last_error — текст последней. Сбрасывается на /start.
+    blocked_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    fail_count: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    last_error: Mapped[str | None] = mapped_column(String(255), nullable=True)
 
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     updated_at: Mapped[datetime] = mapped_column(
@@ -94,6 +130,10 @@ class UserAccess(Base):
 
 class Event(Base):
     __tablename__ = "events"
+    __table_args__ = (
+        # покрывающий под join событий к пользователю (поиск в админке, в т.ч. по trader_id)
+        Index("ix_events_tenant_click", "tenant_id", "click_id", "trader_id"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     tenant_id: Mapped[int] = mapped_column(Integer, index=True)
@@ -102,7 +142,7 @@ class Event(Base):
     # ➕ добавляем trader_id
     trader_id: Mapped[str | None] = mapped_column(String(64), index=True, nullable=True)
 
-    kind: Mapped[str] = mapped_column(String(16))  # "reg" | "ftd" | "rd"
+    kind: Mapped[str] = mapped_column(String(16))  # "reg" | "ftd" | "rd" (+ "*_bad" — отклонённые)
     amount: Mapped[float | None] = mapped_column(Float, nullable=True)
     raw_qs: Mapped[str | None] = mapped_column(Text, nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
@@ -131,4 +171,123 @@ class ContentOverride(Base):
     body_html: Mapped[str | None] = mapped_column(Text, nullable=True)
     buttons_json: Mapped[dict | None] = mapped_column(
         MutableDict.as_mutable(SA_JSON), nullable=True
-    )
\ No newline at end of file
+    )
+
+class AssetFileId(Base):
+    """
+    file_id, который Telegram выдал боту после первой загрузки локального файла
+    (assets/<lang>/<screen>.jpg). sha256 — содержимое файла: поменяли картинку → новая строка.
+    """
+    __tablename__ = "asset_file_ids"
+    __table_args__ = (UniqueConstraint("bot_id", "path", "sha256", name="uq_asset_file_id"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    bot_id: Mapped[int] = mapped_column(BigInteger, index=True)
+    path: Mapped[str] = mapped_column(String(255))
+    sha256: Mapped[str] = mapped_column(String(64))
+    file_id: Mapped[str] = mapped_column(String(256))
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class TenantDailyStats(Base):
+    """
+    Дневной роллап по тенанту (UTC-день). Ведётся инкрементально (app.stats.bump_daily)
+    из постбэков и при создании пользователя; пересборка — scripts/rebuild_daily_stats.py.
+    """
+    __tablename__ = "tenant_daily_stats"
+    __table_args__ = (UniqueConstraint("tenant_id", "day", name="uq_tenant_daily_stats"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    tenant_id: Mapped[int] = mapped_column(Integer)
+    day: Mapped[date] = mapped_column(Date, index=True)
+
+    new_users: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    registrations: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    ftds: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    redeposits: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    deposit_sum: Mapped[float] = mapped_column(Float, default=0.0, server_default="0")
+    platinum_upgrades: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+
+
+class PushJob(Base):
+    """
+    Очередь пушей «следующего экрана» после постбэка. Строка живёт, пока пуш не доставлен;
+    status: queued → running → (удалена) | failed.
+    """
+    __tablename__ = "push_jobs"
+    __table_args__ = (
+        Index("ix_push_jobs_status_run_after", "status", "run_after"),
+        Index("ix_push_jobs_chat", "tenant_id", "chat_id", "status"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    tenant_id: Mapped[int] = mapped_column(Integer)
+    chat_id: Mapped[int] = mapped_column(BigInteger)
+    ua_id: Mapped[int] = mapped_column(Integer, index=True)
+
+    status: Mapped[str] = mapped_column(String(16), default="queued")
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    run_after: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    # аренда running-задачи: чей воркер держит и до какого момента (продлевается, пока идёт пуш)
+    locked_by: Mapped[str | None] = mapped_column(String(64), nullable=True)
+    locked_until: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    last_error: Mapped[str | None] = mapped_column(Text, nullable=True)
+
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class PostbackDedup(Base):
+    """
+    Ключи идемпотентности постбэков: sha256 от (kind, click_id, trader_id, сумма, id транзакции).
+    Повтор с тем же ключом в окне PP_DEDUP_WINDOW_SEC получает сохранённый ответ без записей и пушей.
+    """
+    __tablename__ = "postback_dedup"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    key: Mapped[str] = mapped_column(String(64), unique=True)
+    tenant_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    kind: Mapped[str] = mapped_column(String(16))
+    response: Mapped[dict | None] = mapped_column(SA_JSON, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+
+class Broadcast(Base):
+    """
+    Рассылка тенанта как фоновая задача. cursor — UserAccess.id последнего обработанного
+    получателя (сохраняется пачками), по нему рассылка продолжается после рестарта.
+    status: [scheduled →] queued → running → done | cancelled.
+
+    Отложенная (send_at) ждёт в статусе scheduled. С recurrence (daily | weekly) строка —
+    шаблон: в каждый срок создаётся отдельный запуск (parent_id = шаблон), а send_at сдвигается.
+    """
+    __tablename__ = "broadcasts"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    tenant_id: Mapped[int] = mapped_column(Integer, index=True)
+    status: Mapped[str] = mapped_column(String(16), default="queued", index=True)
+
+    segment: Mapped[str] = mapped_column(String(16), default="all")   # all | reg | dep | nosteps
+    text: Mapped[str] = mapped_column(Text)
+    photo_id: Mapped[str | None] = mapped_column(String(256), nullable=True)
+    video_id: Mapped[str | None] = mapped_column(String(256), nullable=True)
+    fmt: Mapped[str] = mapped_column(String(16), default="HTML")
+    disable_preview: Mapped[bool] = mapped_column(Boolean, default=False)
+
+    send_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)   # UTC
+    recurrence: Mapped[str | None] = mapped_column(String(16), nullable=True)
+    parent_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+
+    cursor: Mapped[int] = mapped_column(Integer, default=0)
+    total: Mapped[int] = mapped_column(Integer, default=0)
+    sent: Mapped[int] = mapped_column(Integer, default=0)
+    failed: Mapped[int] = mapped_column(Integer, default=0)
+
+    # куда рисовать прогресс (сообщение админу)
+    admin_chat_id: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
+    progress_message_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    started_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    finished_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
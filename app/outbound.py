@@ -0,0 +1,242 @@
+# app/outbound.py
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import GetUpdates, TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+
+from app.settings import settings
+from app.utils.logging import logger
+
+# Приоритеты исходящих запросов: меньше — раньше
+PRIORITY_INTERACTIVE = 0   # ответы на действия пользователя (по умолчанию)
+PRIORITY_PUSH = 1          # пуши из постбэков
+PRIORITY_BULK = 2          # рассылки
+
+_priority: ContextVar[int] = ContextVar("outbound_priority", default=PRIORITY_INTERACTIVE)
+
+# Методы, которые пишут в чат: на них действует лимит чата (Telegram ~1 сообщение/сек в чат)
+_CHAT_WRITE_PREFIXES = ("Send", "Copy", "Forward")
+
+
+@contextmanager
+def use_priority(priority: int) -> Iterator[None]:
+    """Все запросы к Telegram внутри блока (и в задачах, созданных из него) идут с этим приоритетом."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class _Waiters:
+    """Очередь ожидающих по (приоритет, порядок прихода); отменённые выкидываются лениво."""
+
+    def __init__(self):
+        self._heap: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+
+    def push(self, priority: int) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), fut))
+        return fut
+
+    def pop(self) -> Optional[asyncio.Future]:
+        while self._heap:
+            fut = heapq.heappop(self._heap)[2]
+            if not fut.done():
+                return fut
+        return None
+
+    def __bool__(self) -> bool:
+        while self._heap and self._heap[0][2].done():
+            heapq.heappop(self._heap)
+        return bool(self._heap)
+
+
+class PriorityBucket:
+    """
+    Токен-бакет (rate в секунду, запас burst), свободный токен достаётся ожидающему
+    с наименьшим приоритетом. pause() — ответ RetryAfter: бакет пуст до истечения паузы.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._waiters = _Waiters()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE) -> None:
+        now = time.monotonic()
+        self._refill(now)
+        if not self._waiters and now >= self.blocked_until and self.tokens >= 1:
+            self.tokens -= 1
+            return
+        fut = self._waiters.push(priority)
+        self._dispatch()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.tokens += 1   # токен выдан, но уже не нужен
+                self._dispatch()
+            raise
+
+    def _dispatch(self) -> None:
+        now = time.monotonic()
+        self._refill(now)
+        if now >= self.blocked_until:
+            while self.tokens >= 1:
+                fut = self._waiters.pop()
+                if fut is None:
+                    break
+                self.tokens -= 1
+                fut.set_result(None)
+        if self._waiters and self._timer is None:
+            delay = max(self.blocked_until - now, (1 - self.tokens) / self.rate, 0.001)
+            self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._dispatch()
+
+    def pause(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    def idle(self) -> bool:
+        """Полон и никого не ждёт — можно выбросить, новый будет таким же."""
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity and not self._waiters and self._timer is None
+
+
+class PrioritySemaphore:
+    """Семафор, освободившийся слот получает ожидающий с наименьшим приоритетом."""
+
+    def __init__(self, value: int):
+        self.free = value
+        self._waiters = _Waiters()
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE) -> None:
+        if self.free > 0 and not self._waiters:
+            self.free -= 1
+            return
+        fut = self._waiters.push(priority)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        fut = self._waiters.pop()
+        if fut is None:
+            self.free += 1
+        else:
+            fut.set_result(None)   # слот переходит ожидающему
+
+
+class OutboundGovernor(BaseRequestMiddleware):
+    """
+    Общий диспетчер исходящих запросов к Bot API для всех ботов процесса
+    (request-middleware aiohttp-сессии). Каждый запрос проходит:
+
+    1) бакет чата (OUT_CHAT_RATE/сек, запас OUT_CHAT_BURST) — только для отправок в чат;
+    2) бакет токена (bot_rate/сек на бота, RetryAfter ставит на паузу весь трафик бота);
+    3) общий лимит одновременных запросов процесса (OUT_CONCURRENCY).
+
+    Чат — первым: токен бота берётся только под запрос, который уже может уйти, и не сгорает,
+    пока запрос ждёт свой чат.
+
+    Везде ожидающие обслуживаются по приоритету из use_priority(): рассылка (PRIORITY_BULK)
+    не задерживает ответ на нажатие пользователя. getUpdates (long-poll) идёт мимо.
+
+    Лимиты живут в памяти процесса. Бот обслуживают два процесса — шард children (ответы,
+    рассылки) и постбэки (пуши), поэтому лимит бота поделён: governor и push_governor ниже.
+    Бакет чата у процессов свой: пуш и ответ в один чат в одну секунду друг друга не видят.
+    """
+
+    def __init__(self, bot_rate: Optional[float] = None, chat_rate: Optional[float] = None,
+                 chat_burst: Optional[float] = None, concurrency: Optional[int] = None):
+        self.bot_rate = bot_rate or settings.OUT_BOT_RATE
+        self.chat_rate = chat_rate or settings.OUT_CHAT_RATE
+        self.chat_burst = chat_burst or settings.OUT_CHAT_BURST
+        self._slots = PrioritySemaphore(concurrency or settings.OUT_CONCURRENCY)
+        self._bots: Dict[int, PriorityBucket] = {}                 # bot.id -> бакет токена
+        self._chats: Dict[Tuple[int, int], PriorityBucket] = {}    # (bot.id, chat_id) -> бакет чата
+        self._calls = 0
+
+    def bot_bucket(self, bot_id: int) -> PriorityBucket:
+        b = self._bots.get(bot_id)
+        if b is None:
+            b = self._bots[bot_id] = PriorityBucket(self.bot_rate)
+        return b
+
+    def _chat_bucket(self, bot_id: int, method: TelegramMethod) -> Optional[PriorityBucket]:
+        chat_id = getattr(method, "chat_id", None)
+        if not isinstance(chat_id, int) or not type(method).__name__.startswith(_CHAT_WRITE_PREFIXES):
+            return None
+        key = (bot_id, chat_id)
+        b = self._chats.get(key)
+        if b is None:
+            b = self._chats[key] = PriorityBucket(self.chat_rate, self.chat_burst)
+        return b
+
+    def _evict_idle(self) -> None:
+        for d in (self._chats, self._bots):
+            for key in [k for k, b in d.items() if b.idle()]:
+                del d[key]
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method)
+
+        self._calls += 1
+        if self._calls % 1000 == 0:
+            self._evict_idle()
+
+        priority = _priority.get()
+        chat = self._chat_bucket(bot.id, method)
+        if chat is not None:
+            await chat.acquire(priority)
+        bucket = self.bot_bucket(bot.id)
+        await bucket.acquire(priority)
+
+        await self._slots.acquire(priority)
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            logger.warning(f"Bot {bot.id}: flood control on {type(method).__name__}, pause {e.retry_after}s")
+            bucket.pause(e.retry_after)
+            raise
+        finally:
+            self._slots.release()
+
+
+# по одному на процесс: все Bot-клиенты процесса делят лимиты.
+# Лимит бота OUT_BOT_RATE делится между процессами: OUT_PUSH_BOT_RATE — постбэкам, остальное — children.
+governor = OutboundGovernor(bot_rate=max(settings.OUT_BOT_RATE - settings.OUT_PUSH_BOT_RATE, 1))
+push_governor = OutboundGovernor(bot_rate=settings.OUT_PUSH_BOT_RATE)
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import os
+import zlib
 from typing import List, Optional
 from urllib.parse import urlencode
 
@@ -62,6 +63,82 @@ class Settings(BaseModel):
     LANG_DEFAULT: str = os.getenv("LANG_DEFAULT", "ru")
     CLICK_SALT: str = os.getenv("CLICK_SALT", "dev_salt_change_me")
 
+    # Кэши (сек): как долго процесс доверяет закэшированному контенту экранов
+    CONTENT_CACHE_TTL: float = float(os.getenv("CONTENT_CACHE_TTL", "60"))
+    # подписка на канал (get_chat_member): сколько верить «состоит» и «не состоит», потолок записей
+    MEMBER_CACHE_TTL: float = float(os.getenv("MEMBER_CACHE_TTL", "600"))
+    MEMBER_CACHE_NEG_TTL: float = float(os.getenv("MEMBER_CACHE_NEG_TTL", "10"))
+    MEMBER_CACHE_MAX: int = int(os.getenv("MEMBER_CACHE_MAX", "100000"))
+    # как часто снимок конфига тенанта сверяется с tenants.version
+    TENANT_CONFIG_CHECK_SEC: float = float(os.getenv("TENANT_CONFIG_CHECK_SEC", "5"))
+    # id последнего сообщения бота (write-behind в процессе детей): сколько держать в памяти
+    # без обращений, как часто подтягивать записи пушера, как часто и какими пачками сбрасывать в БД
+    LAST_MSG_CACHE_TTL: float = float(os.getenv("LAST_MSG_CACHE_TTL", "600"))
+    LAST_MSG_SYNC_SEC: float = float(os.getenv("LAST_MSG_SYNC_SEC", "1"))
+    LAST_MSG_FLUSH_SEC: float = float(os.getenv("LAST_MSG_FLUSH_SEC", "2"))
+    LAST_MSG_FLUSH_BATCH: int = int(os.getenv("LAST_MSG_FLUSH_BATCH", "500"))
+
+    # Очередь пушей после постбэков (воркеры в процессе постбэков)
+    PUSH_WORKERS: int = int(os.getenv("PUSH_WORKERS", "4"))
+    PUSH_MAX_ATTEMPTS: int = int(os.getenv("PUSH_MAX_ATTEMPTS", "5"))
+    PUSH_POLL_SEC: float = float(os.getenv("PUSH_POLL_SEC", "1"))
+    # аренда running-задачи, сек: продлевается, пока воркер жив; истёкшую забирает другой процесс
+    PUSH_LEASE_SEC: float = float(os.getenv("PUSH_LEASE_SEC", "60"))
+    # сколько хранить задачи status=failed (для разбора), сек; старше — удаляются
+    PUSH_FAILED_KEEP_SEC: float = float(os.getenv("PUSH_FAILED_KEEP_SEC", str(7 * 86400)))
+    # Окно идемпотентности постбэков, сек: повтор с тем же ключом внутри окна не применяется.
+    # Без txn_id два настоящих RD на одинаковую сумму внутри окна тоже склеятся — окно не раздувать.
+    PP_DEDUP_WINDOW_SEC: float = float(os.getenv("PP_DEDUP_WINDOW_SEC", "3600"))
+    # Максимум элементов в одном POST /pp/batch
+    PP_BATCH_MAX: int = int(os.getenv("PP_BATCH_MAX", "5000"))
+    # Буфер записи events: сброс каждые EVENT_FLUSH_MS или при EVENT_FLUSH_ROWS строк
+    EVENT_FLUSH_ROWS: int = int(os.getenv("EVENT_FLUSH_ROWS", "200"))
+    EVENT_FLUSH_MS: float = float(os.getenv("EVENT_FLUSH_MS", "500"))
+    EVENT_BUFFER_MAX: int = int(os.getenv("EVENT_BUFFER_MAX", "20000"))   # потолок при недоступной БД
+    EVENT_WRITER_SYNC: bool = os.getenv("EVENT_WRITER_SYNC", "0") == "1"  # 1 = писать сразу, без буфера
+    # Bot-клиенты тенантов в процессе постбэков: сколько держать неиспользуемый, сек
+    BOT_POOL_IDLE_SEC: float = float(os.getenv("BOT_POOL_IDLE_SEC", "600"))
+
+    # Рассылки: лимит бота (Telegram ~30 сообщений/сек), параллельные отправки,
+    # размер пачки между сохранениями курсора, как часто обновлять прогресс у админа
+    BC_RATE_PER_SEC: float = float(os.getenv("BC_RATE_PER_SEC", "25"))
+    BC_CONCURRENCY: int = int(os.getenv("BC_CONCURRENCY", "10"))
+    BC_CHUNK: int = int(os.getenv("BC_CHUNK", "200"))
+    BC_PAGE: int = int(os.getenv("BC_PAGE", "1000"))   # получателей на запрос (keyset по UserAccess.id)
+    BC_PROGRESS_SEC: float = float(os.getenv("BC_PROGRESS_SEC", "5"))
+    BC_POLL_SEC: float = float(os.getenv("BC_POLL_SEC", "5"))
+    # Отложенные рассылки: часовой пояс для ввода времени админом и шага повторов, страховочная пересверка с БД
+    BC_TZ: str = os.getenv("BC_TZ", "UTC")
+    BC_SCHED_RESYNC_SEC: float = float(os.getenv("BC_SCHED_RESYNC_SEC", "300"))
+
+    # Исходящие запросы к Bot API (app/outbound.py): лимит бота в секунду, лимит чата
+    # (Telegram ~1 сообщение/сек в один чат) с запасом на короткую серию, одновременных запросов на процесс.
+    # Лимиты считаются в памяти процесса: OUT_BOT_RATE — на бота всего, из него OUT_PUSH_BOT_RATE
+    # отдаётся процессу постбэков (пуши), остальное — процессу children
+    OUT_BOT_RATE: float = float(os.getenv("OUT_BOT_RATE", "30"))
+    OUT_PUSH_BOT_RATE: float = float(os.getenv("OUT_PUSH_BOT_RATE", "5"))
+    OUT_CHAT_RATE: float = float(os.getenv("OUT_CHAT_RATE", "1"))
+    OUT_CHAT_BURST: float = float(os.getenv("OUT_CHAT_BURST", "3"))
+    OUT_CONCURRENCY: int = int(os.getenv("OUT_CONCURRENCY", "50"))
+
+    # Детские боты (общий диспетчер)
+    CHILD_POLL_TIMEOUT: int = int(os.getenv("CHILD_POLL_TIMEOUT", "30"))        # long-poll, сек
+    CHILD_HTTP_POOL_LIMIT: int = int(os.getenv("CHILD_HTTP_POOL_LIMIT", "0"))   # 0 = без лимита
+
+    # Режим приёма апдейтов детских ботов: "polling" | "webhook"
+    CHILD_MODE: str = os.getenv("CHILD_MODE", "polling").strip().lower()
+    # Вебхуки: публичная база (https), путь и локальный адрес сервера в процессе детей
+    WEBHOOK_BASE: str = _normalize_base(os.getenv("WEBHOOK_BASE", os.getenv("POSTBACK_BASE", "https://YOUR-DOMAIN")))
+    WEBHOOK_PATH: str = _normalize_base(os.getenv("WEBHOOK_PATH", "/tg"))
+    WEBHOOK_HOST: str = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+    WEBHOOK_PORT: int = int(os.getenv("WEBHOOK_PORT", "8081"))
+    WEBHOOK_RECONCILE_SEC: int = int(os.getenv("WEBHOOK_RECONCILE_SEC", "300"))
+
+    # Шардирование детей по процессам (1 = всё в одном процессе).
+    # В webhook-режиме шард N слушает WEBHOOK_PORT+N и путь {WEBHOOK_PATH}/sN/… —
+    # прокси должен раскидать /tg/s0/, /tg/s1/, … по портам.
+    CHILD_SHARDS: int = max(1, int(os.getenv("CHILD_SHARDS", "1")))
+
     # -------------------------
     # Удобные хелперы для ПП
     # -------------------------
@@ -95,6 +172,18 @@ class Settings(BaseModel):
                     qs[k] = v
         return f"{self.POSTBACK_BASE}{path}?{urlencode(qs)}"
 
+    def child_shard(self, tenant_id: int) -> int:
+        """Стабильный шард тенанта (не зависит от PYTHONHASHSEED и рестартов)."""
+        if self.CHILD_SHARDS <= 1:
+            return 0
+        return zlib.crc32(str(tenant_id).encode()) % self.CHILD_SHARDS
+
+    def webhook_prefix(self, shard: int) -> str:
+        return f"{self.WEBHOOK_PATH}/s{shard}" if self.CHILD_SHARDS > 1 else self.WEBHOOK_PATH
+
+    def webhook_url(self, tenant_id: int) -> str:
+        return f"{self.WEBHOOK_BASE}{self.webhook_prefix(self.child_shard(tenant_id))}/{tenant_id}"
+
     def pp_reg_url(self, *, click_id: str, tid: int, secret: str, trader_id: Optional[str] = None) -> str:
         return self.make_pp_url("/pp/reg", click_id=click_id, tid=tid, secret=secret, trader_id=trader_id)
 
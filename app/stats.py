@@ -0,0 +1,134 @@
+# app/stats.py
+from __future__ import annotations
+
+from dataclasses import dataclass, fields
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import select, func, case
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import SessionLocal, dialect_insert
+from app.models import UserAccess, TenantDailyStats
+
+
+@dataclass(frozen=True)
+class UserStats:
+    total: int = 0       # пользователей
+    regs: int = 0        # с регистрацией
+    deps: int = 0        # с депозитом
+    plats: int = 0       # platinum
+    dep_sum: float = 0.0 # сумма депозитов (UserAccess.deposit_total)
+
+    def __add__(self, other: "UserStats") -> "UserStats":
+        return UserStats(
+            self.total + other.total,
+            self.regs + other.regs,
+            self.deps + other.deps,
+            self.plats + other.plats,
+            self.dep_sum + other.dep_sum,
+        )
+
+
+def _flag(col):
+    return func.coalesce(func.sum(case((col == True, 1), else_=0)), 0)
+
+
+# Все счётчики — одним проходом по user_access (условная агрегация)
+_AGG = (
+    func.count().label("total"),
+    _flag(UserAccess.is_registered).label("regs"),
+    _flag(UserAccess.has_deposit).label("deps"),
+    _flag(UserAccess.is_platinum).label("plats"),
+    func.coalesce(func.sum(UserAccess.deposit_total), 0.0).label("dep_sum"),
+)
+
+
+def _row_stats(row) -> UserStats:
+    return UserStats(int(row.total), int(row.regs), int(row.deps), int(row.plats), float(row.dep_sum))
+
+
+async def user_stats_by_tenant(tenant_ids: Optional[Iterable[int]] = None) -> Dict[int, UserStats]:
+    """Статистика по тенантам (все или указанные) одним запросом с GROUP BY tenant_id."""
+    q = select(UserAccess.tenant_id, *_AGG).group_by(UserAccess.tenant_id)
+    if tenant_ids is not None:
+        q = q.where(UserAccess.tenant_id.in_(list(tenant_ids)))
+    async with SessionLocal() as s:
+        res = await s.execute(q)
+        return {row.tenant_id: _row_stats(row) for row in res.all()}
+
+
+async def user_stats(tenant_id: int) -> UserStats:
+    """Статистика одного тенанта — один запрос."""
+    async with SessionLocal() as s:
+        res = await s.execute(select(*_AGG).where(UserAccess.tenant_id == tenant_id))
+        return _row_stats(res.one())
+
+
+# =========================
+#   Дневной роллап (tenant_daily_stats)
+# =========================
+@dataclass(frozen=True)
+class DailyStats:
+    new_users: int = 0
+    registrations: int = 0
+    ftds: int = 0
+    redeposits: int = 0
+    deposit_sum: float = 0.0
+    platinum_upgrades: int = 0
+
+    def __add__(self, other: "DailyStats") -> "DailyStats":
+        return DailyStats(*(getattr(self, f.name) + getattr(other, f.name) for f in fields(self)))
+
+
+DAILY_COUNTERS = tuple(f.name for f in fields(DailyStats))
+
+
+def utc_day(ts: Optional[datetime] = None) -> date:
+    return (ts or datetime.utcnow()).date()
+
+
+async def bump_daily(s: AsyncSession, tenant_id: Optional[int], day: Optional[date] = None, **deltas) -> None:
+    """
+    Инкремент счётчиков дня тенанта (upsert). Выполняется в сессии вызывающего —
+    коммит вместе с его записью, так что роллап не расходится с данными.
+    """
+    deltas = {k: v for k, v in deltas.items() if v}
+    if tenant_id is None or not deltas:
+        return
+    tbl = TenantDailyStats.__table__
+    ins = dialect_insert(tbl).values(tenant_id=tenant_id, day=day or utc_day(), **deltas)
+    await s.execute(ins.on_conflict_do_update(
+        index_elements=[tbl.c.tenant_id, tbl.c.day],
+        set_={k: tbl.c[k] + ins.excluded[k] for k in deltas},
+    ))
+
+
+async def daily_trend(tenant_id: Optional[int] = None, days: int = 7) -> Tuple[DailyStats, DailyStats]:
+    """(сегодня, последние `days` дней) — один запрос по нескольким строкам роллапа. None — все тенанты."""
+    today = utc_day()
+    tbl = TenantDailyStats.__table__
+    cols = []
+    for name in DAILY_COUNTERS:
+        col = tbl.c[name]
+        cols.append(func.coalesce(func.sum(case((tbl.c.day == today, col), else_=0)), 0).label(f"d_{name}"))
+        cols.append(func.coalesce(func.sum(col), 0).label(f"w_{name}"))
+    q = select(*cols).where(tbl.c.day >= today - timedelta(days=days - 1))
+    if tenant_id is not None:
+        q = q.where(tbl.c.tenant_id == tenant_id)
+    async with SessionLocal() as s:
+        row = (await s.execute(q)).one()
+    day = DailyStats(*(row._mapping[f"d_{n}"] for n in DAILY_COUNTERS))
+    week = DailyStats(*(row._mapping[f"w_{n}"] for n in DAILY_COUNTERS))
+    return day, week
+
+
+def _money(x: float) -> str:
+    return f"{int(x)}" if abs(x - int(x)) < 1e-9 else f"{x:.2f}"
+
+
+def format_trend(day: DailyStats, week: DailyStats, days: int = 7) -> str:
+    def line(d: DailyStats) -> str:
+        return (f"+{d.new_users} польз. · {d.registrations} рег. · {d.ftds} FTD · {d.redeposits} RD · "
+                f"{_money(d.deposit_sum)}$ · 💠{d.platinum_upgrades}")
+    return f"Сегодня: {line(day)}\n{days} дн.: {line(week)}"
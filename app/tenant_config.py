@@ -0,0 +1,106 @@
+# app/tenant_config.py
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass, fields
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import SessionLocal
+from app.models import Tenant
+from app.settings import settings
+
+
+@dataclass(frozen=True)
+class TenantConfig:
+    """
+    Неизменяемый снимок строки tenants. Горячие пути читают настройки тенанта
+    отсюда, а не из БД. Поля совпадают с колонками Tenant.
+    """
+    id: int
+    owner_telegram_id: int
+    bot_token: Optional[str]
+    bot_username: Optional[str]
+    gate_channel_id: Optional[int]
+    gate_channel_url: Optional[str]
+    ref_link: Optional[str]
+    deposit_link: Optional[str]
+    is_active: bool
+    created_at: Optional[datetime]
+    pb_secret: Optional[str]
+    support_url: Optional[str]
+    check_subscription: Optional[bool]
+    check_deposit: Optional[bool]
+    min_deposit_usd: Optional[float]
+    platinum_threshold_usd: Optional[float]
+    updated_at: Optional[datetime]
+    version: int
+    restart_seq: int
+
+    @classmethod
+    def from_row(cls, row: Tenant) -> "TenantConfig":
+        return cls(**{f.name: getattr(row, f.name) for f in fields(cls)})
+
+
+# tenant_id -> (monotonic время последней сверки version, снимок)
+_CACHE: Dict[int, Tuple[float, TenantConfig]] = {}
+
+
+def invalidate_tenant(tenant_id: Optional[int] = None) -> None:
+    """
+    Сбросить снимок после записи в tenants (None — все тенанты).
+    Другие процессы увидят изменение по tenants.version не позже TENANT_CONFIG_CHECK_SEC.
+    """
+    if tenant_id is None:
+        _CACHE.clear()
+    else:
+        _CACHE.pop(tenant_id, None)
+
+
+def note_tenant_version(tenant_id: int, version: int) -> None:
+    """Уведомление от того, кто уже прочитал tenants.version (раннер детей): снимок устарел?"""
+    hit = _CACHE.get(tenant_id)
+    if hit and hit[1].version != version:
+        _CACHE.pop(tenant_id, None)
+
+
+async def get_tenant_config(tenant_id: int, s: Optional[AsyncSession] = None) -> Optional[TenantConfig]:
+    """
+    Снимок конфига тенанта. s — уже открытая сессия вызывающего (чтобы не брать
+    из пула второе соединение внутри чужой транзакции).
+    """
+    now = time.monotonic()
+    hit = _CACHE.get(tenant_id)
+    if hit and now - hit[0] < settings.TENANT_CONFIG_CHECK_SEC:
+        return hit[1]
+    if s is None:
+        async with SessionLocal() as own:
+            return await _load(own, tenant_id, hit, now)
+    return await _load(s, tenant_id, hit, now)
+
+
+async def _load(
+    s: AsyncSession, tenant_id: int, hit: Optional[Tuple[float, TenantConfig]], now: float
+) -> Optional[TenantConfig]:
+    if hit:
+        # дешёвая сверка: читаем только version
+        res = await s.execute(select(Tenant.version).where(Tenant.id == tenant_id))
+        version = res.scalar_one_or_none()
+        if version is None:
+            _CACHE.pop(tenant_id, None)
+            return None
+        if version == hit[1].version:
+            _CACHE[tenant_id] = (now, hit[1])
+            return hit[1]
+    res = await s.execute(select(Tenant).where(Tenant.id == tenant_id))
+    row = res.scalar_one_or_none()
+
+    if row is None:
+        _CACHE.pop(tenant_id, None)
+        return None
+    cfg = TenantConfig.from_row(row)
+    _CACHE[tenant_id] = (now, cfg)
+    return cfg
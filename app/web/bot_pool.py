@@ -0,0 +1,73 @@
+# app/web/bot_pool.py
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Dict, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+
+from app.outbound import push_governor
+from app.settings import settings
+
+
+class BotPool:
+    """
+    Bot на тенанта, переиспользуемые между пушами. Все боты сидят на одной aiohttp-сессии,
+    поэтому соединения к api.telegram.org (TCP+TLS) живут между запросами,
+    а запросы проходят через push_governor (app/outbound.py) — долю лимита бота для пушей.
+
+    Токен сверяется при каждом get(): сменился токен — создаётся новый Bot.
+    Давно не использованные боты выкидываются (evict_idle); сессию закрывает close().
+    """
+
+    def __init__(self, idle_sec: Optional[float] = None):
+        self.idle_sec = idle_sec if idle_sec is not None else settings.BOT_POOL_IDLE_SEC
+        self.session = AiohttpSession(limit=settings.CHILD_HTTP_POOL_LIMIT)
+        self.session.middleware(push_governor)
+        self._bots: Dict[int, Tuple[str, Bot]] = {}   # tenant_id -> (token, bot)
+        self._used: Dict[int, float] = {}             # tenant_id -> monotonic последнего get()
+        self._evictor: Optional[asyncio.Task] = None
+
+    def get(self, tenant_id: int, token: str) -> Bot:
+        self._used[tenant_id] = time.monotonic()
+        entry = self._bots.get(tenant_id)
+        if entry and entry[0] == token:
+            return entry[1]
+        bot = Bot(token, session=self.session, default=DefaultBotProperties(parse_mode="HTML"))
+        self._bots[tenant_id] = (token, bot)
+        return bot
+
+    def invalidate(self, tenant_id: int) -> None:
+        self._bots.pop(tenant_id, None)
+        self._used.pop(tenant_id, None)
+
+    def evict_idle(self) -> int:
+        deadline = time.monotonic() - self.idle_sec
+        stale = [tid for tid, ts in self._used.items() if ts < deadline]
+        for tid in stale:
+            self.invalidate(tid)
+        return len(stale)
+
+    async def _evict_loop(self) -> None:
+        while True:
+            await asyncio.sleep(max(self.idle_sec / 4, 1.0))
+            self.evict_idle()
+
+    def start(self) -> None:
+        if self._evictor is None:
+            self._evictor = asyncio.create_task(self._evict_loop())
+
+    async def close(self) -> None:
+        if self._evictor:
+            self._evictor.cancel()
+            try:
+                await self._evictor
+            except asyncio.CancelledError:
+                pass
+            self._evictor = None
+        self._bots.clear()
+        self._used.clear()
+        await self.session.close()
@@ -1,28 +1,57 @@
 from __future__ import annotations
 
 import re
+import hmac
+import json
 import asyncio
+import hashlib
 import secrets as _pysecrets
-from datetime import datetime
-from typing import Optional
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 from urllib.parse import urlencode
 
-from fastapi import FastAPI, Query
+from fastapi import FastAPI, Query, Request
 from aiogram import Bot
-from aiogram.client.default import DefaultBotProperties
 
-from sqlalchemy import select, func, case
+from sqlalchemy import select, func, case, or_, bindparam
 
-from app.db import SessionLocal
-from app.models import UserAccess, Event, Tenant
+from app.db import SessionLocal, init_db, dialect_insert
+from app.deliverability import ChatUnreachable, is_dead_chat_error, record_delivery
+from app.event_log import event_writer
+from app.models import UserAccess, Event, Tenant, PostbackDedup
 from app.settings import settings
+from app.stats import bump_daily, DAILY_COUNTERS
+from app.utils.logging import logger
+from app.web.bot_pool import BotPool
+from app.web.push_queue import PushQueue
+from app.tenant_config import TenantConfig, get_tenant_config, invalidate_tenant
 from app.bots.child.bot_instance import (
     t, add_params, get_lang, mark_unlocked_shown, mark_platinum_shown,
     send_screen, kb_register, kb_deposit, kb_open_app, kb_open_platinum,
-    user_deposit_sum,
 )
 
-app = FastAPI(title="Local Postbacks")
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    await init_db()  # push_jobs / postback_dedup могли ещё не существовать
+    bot_pool.start()
+    event_writer.start()
+    await push_queue.start()
+    dedup_janitor = asyncio.create_task(_dedup_janitor_loop())
+    try:
+        yield
+    finally:
+        dedup_janitor.cancel()
+        await push_queue.stop()
+        await event_writer.stop()  # дописать буфер событий
+        await bot_pool.close()
+
+
+app = FastAPI(title="Local Postbacks", lifespan=lifespan)
+
+# Bot-клиенты тенантов на общей сессии (см. BotPool)
+bot_pool = BotPool()
 
 
 # =========================
@@ -79,34 +108,13 @@ async def _load_by_click(click_id: str) -> Optional[UserAccess]:
         return res.scalar_one_or_none()
 
 
-async def _get_tenant(tid: int) -> Optional[Tenant]:
-    async with SessionLocal() as s:
-        r = await s.execute(select(Tenant).where(Tenant.id == tid))
-        return r.scalar_one_or_none()
-
-
-async def _ensure_pb_secret(tenant_id: int) -> str:
-    """
-    Лениво генерируем pb_secret, если пустой. Возвращаем актуальный секрет.
-    """
-    async with SessionLocal() as s:
-        r = await s.execute(select(Tenant).where(Tenant.id == tenant_id))
-        tnt = r.scalar_one()
-        if not tnt.pb_secret:
-            new_secret = _pysecrets.token_urlsafe(20)  # ~27 символов, URL-safe
-            await s.execute(
-                Tenant.__table__.update()
-                .where(Tenant.id == tenant_id)
-                .values(pb_secret=new_secret)
-            )
-            await s.commit()
-            return new_secret
-        return tnt.pb_secret
+async def _get_tenant(tid: int, s=None) -> Optional[TenantConfig]:
+    return await get_tenant_config(tid, s)
 
 
-async def _log_event(kind: str, ua: Optional[UserAccess], params: dict):
+def _event_values(kind: str, ua: Optional[UserAccess], params: dict) -> dict:
     """
-    Сохраняем сырое событие. Пишем trader_id (если колонка есть) и корректно парсим сумму.
+    Строка для events. Пишем trader_id (если колонка есть) и корректно парсим сумму.
     """
     raw = urlencode({k: "" if v is None else v for k, v in params.items()})
     amt = _parse_amount(params.get("sumdep"))
@@ -124,39 +132,63 @@ async def _log_event(kind: str, ua: Optional[UserAccess], params: dict):
     }
     if "trader_id" in cols:
         values["trader_id"] = params.get("trader_id")
+    return values
 
-    async with SessionLocal() as s:
-        await s.execute(Event.__table__.insert().values(**values))
-        await s.commit()
+
+async def _log_event(
+    kind: str, ua: Optional[UserAccess], params: dict, *,
+    tenant_id: Optional[int] = None, user_id: Optional[int] = None, sync: bool = False,
+):
+    """
+    Сохраняем сырое событие (через буфер event_writer; sync=True — сразу).
+    tenant_id/user_id — для событий без UserAccess (диагностика пушей).
+    """
+    values = _event_values(kind, ua, params)
+    if tenant_id is not None:
+        values["tenant_id"] = tenant_id
+    if user_id is not None:
+        values["user_id"] = user_id
+    await event_writer.log(values, sync=sync)
 
 
 # Надёжная отправка экрана с ретраем и логами
 async def _safe_send_screen(
     *, screen: str, bot: Bot, tenant_id: int, chat_id: int,
-    click_id: str | None, lang: str, text: str, kb
+    click_id: str | None, lang: str, text: str, kb, ua: Optional[UserAccess] = None
 ):
+    """
+    Мёртвый чат (бот заблокирован / чата нет) не ретраим: помечаем ua и бросаем ChatUnreachable.
+    """
     last_exc = None
     for _ in range(2):  # две попытки
         try:
             await send_screen(bot, tenant_id, chat_id, lang, screen, text, kb)
+            if ua is not None and ua.fail_count:
+                await record_delivery(ok_ids=[ua.id])
             try:
                 await _log_event("push_sent", None, {
                     "click_id": click_id or str(chat_id),
                     "screen": screen, "ok": "1"
-                })
+                }, tenant_id=tenant_id, user_id=chat_id)
             except Exception:
                 pass
             return
         except Exception as e:
             last_exc = e
+            if is_dead_chat_error(e):
+                break
             await asyncio.sleep(0.6)
     try:
         await _log_event("push_error", None, {
             "click_id": click_id or str(chat_id),
             "screen": screen, "err": str(last_exc)
-        })
+        }, tenant_id=tenant_id, user_id=chat_id)
     except Exception:
         pass
+    if ua is not None:
+        await record_delivery(failed={ua.id: last_exc})
+    if is_dead_chat_error(last_exc):
+        raise ChatUnreachable(str(last_exc)) from last_exc
     raise last_exc
 
 
@@ -167,11 +199,16 @@ async def _push_next_screen(ua_id: int):
     """
     async with SessionLocal() as s:
         res = await s.execute(select(UserAccess).where(UserAccess.id == ua_id))
-        ua = res.scalar_one()
-        t_res = await s.execute(select(Tenant).where(Tenant.id == ua.tenant_id))
-        tenant = t_res.scalar_one()
-
-    bot = Bot(tenant.bot_token, default=DefaultBotProperties(parse_mode="HTML"))
+        ua = res.scalar_one_or_none()
+    if ua is None:
+        return  # пользователь/тенант удалён после постановки задачи — повторять нечего
+    if ua.blocked_at is not None:
+        return  # чат помечен мёртвым после постановки задачи
+    tenant = await _get_tenant(ua.tenant_id)
+    if tenant is None:
+        return
+
+    bot = bot_pool.get(tenant.id, tenant.bot_token)
     chat_id = ua.user_id
     lang = await get_lang(ua.tenant_id, ua.user_id)
     support_url = tenant.support_url or settings.SUPPORT_URL
@@ -182,7 +219,7 @@ async def _push_next_screen(ua_id: int):
             ref_url = add_params(tenant.ref_link or settings.REF_LINK, click_id=ua.click_id, tid=ua.tenant_id)
             await _safe_send_screen(
                 screen="register", bot=bot, tenant_id=ua.tenant_id, chat_id=chat_id,
-                click_id=ua.click_id, lang=lang,
+                click_id=ua.click_id, lang=lang, ua=ua,
                 text=f"<b>{t(lang,'gate_reg_title')}</b>\n\n{t(lang,'gate_reg_text')}",
                 kb=kb_register(lang, ref_url)
             )
@@ -190,7 +227,7 @@ async def _push_next_screen(ua_id: int):
 
         # если проверка депозита включена — проверим минимум (None = включено)
         if tenant.check_deposit is not False:
-            total = await user_deposit_sum(ua.tenant_id, ua.click_id)
+            total = float(ua.deposit_total or 0.0)
             need = float(tenant.min_deposit_usd or 0.0)
             if total < need:
                 def fmt(x: float) -> str:
@@ -218,7 +255,7 @@ async def _push_next_screen(ua_id: int):
                         f"{t(lang, 'gate_dep_text')}{hints.get(lang, hints['en'])}")
                 await _safe_send_screen(
                     screen="deposit", bot=bot, tenant_id=ua.tenant_id, chat_id=chat_id,
-                    click_id=ua.click_id, lang=lang, text=text, kb=kb_deposit(lang, dep_url)
+                    click_id=ua.click_id, lang=lang, text=text, kb=kb_deposit(lang, dep_url), ua=ua
                 )
                 return
 
@@ -226,7 +263,7 @@ async def _push_next_screen(ua_id: int):
         if ua.is_platinum and not ua.platinum_shown:
             await _safe_send_screen(
                 screen="platinum", bot=bot, tenant_id=ua.tenant_id, chat_id=chat_id,
-                click_id=ua.click_id, lang=lang,
+                click_id=ua.click_id, lang=lang, ua=ua,
                 text=f"<b>{t(lang,'platinum_title')}</b>\n\n{t(lang,'platinum_text')}",
                 kb=kb_open_platinum(lang, support_url)
             )
@@ -237,13 +274,15 @@ async def _push_next_screen(ua_id: int):
         if not ua.unlocked_shown:
             await _safe_send_screen(
                 screen="unlocked", bot=bot, tenant_id=ua.tenant_id, chat_id=chat_id,
-                click_id=ua.click_id, lang=lang,
+                click_id=ua.click_id, lang=lang, ua=ua,
                 text=f"<b>{t(lang,'unlocked_title')}</b>\n\n{t(lang,'unlocked_text')}",
                 kb=kb_open_app(lang, support_url)
             )
             await mark_unlocked_shown(ua.tenant_id, ua.user_id)
             return
 
+    except ChatUnreachable:
+        return  # уже помечен в user_access; задачу не ретраим
     except Exception as e:
         # На всякий случай продублируем лог ошибки
         try:
@@ -251,19 +290,107 @@ async def _push_next_screen(ua_id: int):
         except Exception:
             pass
         raise
-    finally:
-        await bot.session.close()
 
 
-async def _check_secret(tenant_id: int, secret: Optional[str]) -> bool:
+# Пуш уходит из фоновой очереди — ответ партнёрке не ждёт Telegram
+push_queue = PushQueue(_push_next_screen)
+
+
+# =========================
+#      Idempotency
+# =========================
+def _dedup_key(kind: str, params: dict) -> str:
+    """Ключ повтора: kind, click_id, trader_id, сумма (после парсинга) и id транзакции партнёрки."""
+    amt = _parse_amount(params.get("sumdep"))
+    parts = (
+        kind,
+        params["click_id"],
+        params.get("trader_id") or "",
+        "" if amt is None else repr(amt),
+        params.get("txn_id") or "",
+    )
+    return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
+
+
+async def _claim_dedup(s, rows: Iterable[Tuple[str, int, str]]) -> Set[str]:
+    """
+    Занять ключи (key, tenant_id, kind) в транзакции постбэка одним INSERT ... ON CONFLICT.
+    Возвращает занятые ключи; не вошедшие — уже применены в пределах окна.
+    Уникальный индекс по key сериализует параллельные повторы: второй ждёт коммита первого
+    и видит конфликт. Просроченный ключ перезанимается тем же upsert'ом.
+    Ключи в rows должны быть уникальны.
+    """
+    rows = [{"key": k, "tenant_id": tid, "kind": kind, "response": None} for k, tid, kind in rows]
+    if not rows:
+        return set()
+    now = datetime.utcnow()
+    tbl = PostbackDedup.__table__
+    ins = dialect_insert(tbl).values([{**r, "created_at": now} for r in rows])
+    res = await s.execute(ins.on_conflict_do_update(
+        index_elements=[tbl.c.key],
+        set_={"tenant_id": ins.excluded.tenant_id, "kind": ins.excluded.kind,
+              "response": None, "created_at": now},
+        where=tbl.c.created_at < now - timedelta(seconds=settings.PP_DEDUP_WINDOW_SEC),
+    ).returning(tbl.c.key))
+    return set(res.scalars())
+
+
+async def _dedup_responses(s, keys: Iterable[str]) -> Dict[str, dict]:
+    """Сохранённые ответы для повторов (с пометкой duplicate)."""
+    res = await s.execute(
+        select(PostbackDedup.key, PostbackDedup.response).where(PostbackDedup.key.in_(list(keys)))
+    )
+    return {k: {**(resp or _ok()), "duplicate": True} for k, resp in res.all()}
+
+
+async def _save_responses(s, responses: Dict[str, dict]) -> None:
+    if responses:
+        await s.execute(
+            PostbackDedup.__table__.update()
+            .where(PostbackDedup.key == bindparam("_key"))
+            .values(response=bindparam("_resp")),
+            [{"_key": k, "_resp": r} for k, r in responses.items()],
+        )
+
+
+async def _purge_dedup() -> int:
+    cutoff = datetime.utcnow() - timedelta(seconds=settings.PP_DEDUP_WINDOW_SEC)
+    async with SessionLocal() as s:
+        res = await s.execute(PostbackDedup.__table__.delete().where(PostbackDedup.created_at < cutoff))
+        await s.commit()
+        return res.rowcount or 0
+
+
+async def _dedup_janitor_loop():
+    while True:
+        try:
+            await _purge_dedup()
+        except Exception as e:
+            logger.warning(f"postback_dedup purge failed: {e}")
+        await asyncio.sleep(max(settings.PP_DEDUP_WINDOW_SEC / 4, 60.0))
+
+
+async def _secret_ok(s, tenant: TenantConfig, secret: Optional[str]) -> bool:
     """
-    Секрет обязателен у всех: если пуст — генерим, затем сравниваем строго.
+    Секрет обязателен у всех: если пуст — генерим (в транзакции постбэка), затем сравниваем строго.
     """
-    tnt = await _get_tenant(tenant_id)
-    if not tnt:
-        return False
-    must = tnt.pb_secret or await _ensure_pb_secret(tenant_id)
-    return secret == must
+    must = tenant.pb_secret
+    if not must:
+        must = _pysecrets.token_urlsafe(20)  # ~27 символов, URL-safe
+        await s.execute(
+            Tenant.__table__.update()
+            .where(Tenant.id == tenant.id, or_(Tenant.pb_secret.is_(None), Tenant.pb_secret == ""))
+            .values(pb_secret=must)
+        )
+    # байты: compare_digest на str падает TypeError на не-ASCII символах (был бы 500 вместо bad_secret)
+    return secret is not None and hmac.compare_digest(secret.encode(), must.encode())
+
+
+# Состояние пользователя, которое возвращаем партнёрке после постбэка
+_STATE_COLS = (
+    UserAccess.is_registered, UserAccess.has_deposit, UserAccess.is_platinum,
+    UserAccess.total_deposits, UserAccess.deposit_total, UserAccess.deposit_count,
+)
 
 
 def _tid_matches(ua: UserAccess, tid_param: Optional[int]) -> bool:
@@ -271,6 +398,94 @@ def _tid_matches(ua: UserAccess, tid_param: Optional[int]) -> bool:
     return tid_param is None or tid_param == ua.tenant_id
 
 
+async def _apply_postback(kind: str, params: dict, tid: Optional[int], secret: Optional[str], **extra) -> dict:
+    """
+    Весь переход состояния по постбэку (reg/ftd/rd) — одна сессия и одна транзакция:
+    проверка секрета, апдейт UserAccess, событие, накопительная сумма, Platinum,
+    дневной роллап и задача на пуш. Инкременты считаются в SQL, поэтому параллельные
+    постбэки по одному click_id не теряют друг друга. Повтор того же постбэка
+    (см. _dedup_key) получает сохранённый ответ без записей. Возвращает ответ эндпоинта.
+    """
+    click_id = params["click_id"]
+    trader_id = params.get("trader_id")
+    amt = _parse_amount(params.get("sumdep"))
+
+    async with SessionLocal() as s:
+        ua = (await s.execute(select(UserAccess).where(UserAccess.click_id == click_id))).scalar_one_or_none()
+        if not ua:
+            return _nf(click_id=click_id)
+
+        # Полностью доверяем tenant_id из UA; tid подменён — не выдаём подробностей
+        tenant_id = ua.tenant_id
+        tenant = await _get_tenant(tenant_id, s)
+        if tenant is None or not _tid_matches(ua, tid) or not await _secret_ok(s, tenant, secret):
+            await s.execute(Event.__table__.insert().values(**_event_values(f"{kind}_bad", ua, params)))
+            await s.commit()
+            if tenant is not None and not tenant.pb_secret:
+                invalidate_tenant(tenant_id)
+            return _err("bad_secret")
+
+        key = _dedup_key(kind, params)
+        if not await _claim_dedup(s, [(key, tenant_id, kind)]):
+            await s.rollback()
+            return (await _dedup_responses(s, [key])).get(key) or _ok(duplicate=True)
+
+        upd = UserAccess.__table__.update().where(UserAccess.id == ua.id)
+        vals = {}
+        if trader_id and not ua.trader_id:
+            vals["trader_id"] = trader_id
+        daily = {}
+
+        if kind == "reg":
+            res = await s.execute(
+                upd.where(UserAccess.is_registered.isnot(True)).values(is_registered=True, **vals)
+            )
+            if res.rowcount:
+                daily["registrations"] = 1
+            elif vals:
+                await s.execute(upd.values(**vals))
+        else:
+            if kind == "ftd":
+                # FTD: has_deposit=1, total_deposits минимум 1, но не уменьшаем существующее
+                vals["total_deposits"] = case(
+                    (func.coalesce(UserAccess.total_deposits, 0) == 0, 1),
+                    else_=UserAccess.total_deposits
+                )
+            else:
+                # RD: атомарный инкремент total_deposits
+                vals["total_deposits"] = func.coalesce(UserAccess.total_deposits, 0) + 1
+            total = (await s.execute(
+                upd.values(
+                    has_deposit=True,
+                    deposit_total=func.coalesce(UserAccess.deposit_total, 0.0) + (amt or 0.0),
+                    deposit_count=func.coalesce(UserAccess.deposit_count, 0) + 1,
+                    **vals,
+                ).returning(UserAccess.deposit_total)
+            )).scalar_one()
+            daily.update(ftds=int(kind == "ftd"), redeposits=int(kind == "rd"), deposit_sum=amt or 0.0)
+
+            # platinum check
+            if float(total or 0.0) >= float(tenant.platinum_threshold_usd or 500.0):
+                res = await s.execute(
+                    upd.where(UserAccess.is_platinum.isnot(True))
+                    .values(is_platinum=True, platinum_shown=False)  # сбрасываем, чтобы экран показался
+                )
+                if res.rowcount:
+                    daily["platinum_upgrades"] = 1
+
+        await s.execute(Event.__table__.insert().values(**_event_values(kind, ua, params)))
+        await bump_daily(s, tenant_id, **daily)
+        await push_queue.enqueue(ua, s)
+
+        state = (await s.execute(select(*_STATE_COLS).where(UserAccess.id == ua.id))).one()
+        resp = _ok(**extra, state=dict(state._mapping))
+        await _save_responses(s, {key: resp})
+        await s.commit()
+
+    push_queue.wake()
+    return resp
+
+
 # =========================
 #         Endpoints
 # =========================
@@ -281,30 +496,8 @@ async def pp_reg(
     tid: Optional[int] = None,
     secret: Optional[str] = None,
 ):
-    ua = await _load_by_click(click_id)
-    if not ua:
-        return _nf(click_id=click_id)
-
-    # Полностью доверяем tenant_id из UA
-    tenant_id = ua.tenant_id
-    if not _tid_matches(ua, tid):
-        # tid подменён — не выдаём подробностей
-        await _log_event("reg", ua, {"click_id": click_id, "trader_id": trader_id, "tid": tid})
-        return _err("bad_secret")
-    if not await _check_secret(tenant_id, secret):
-        await _log_event("reg", ua, {"click_id": click_id, "trader_id": trader_id, "tid": tenant_id})
-        return _err("bad_secret")
-
-    async with SessionLocal() as s:
-        vals = {"is_registered": True}
-        if trader_id and not ua.trader_id:
-            vals["trader_id"] = trader_id
-        await s.execute(UserAccess.__table__.update().where(UserAccess.id == ua.id).values(**vals))
-        await s.commit()
-
-    await _log_event("reg", ua, {"click_id": click_id, "trader_id": trader_id, "tid": tenant_id})
-    await _push_next_screen(ua.id)
-    return _ok()
+    params = {"click_id": click_id, "trader_id": trader_id, "tid": tid}
+    return await _apply_postback("reg", params, tid, secret)
 
 
 @app.get("/pp/ftd")
@@ -314,61 +507,15 @@ async def pp_ftd(
     sum_alt: Optional[str] = Query(None, alias="sum"), # алиас, если партнёрка шлёт ?sum=
     amount_alt: Optional[str] = Query(None, alias="amount"),  # алиас ?amount=
     trader_id: Optional[str] = None,
+    txn_id: Optional[str] = None,                      # id транзакции партнёрки (для идемпотентности)
+    txn_alt: Optional[str] = Query(None, alias="transaction_id"),
     tid: Optional[int] = None,
     secret: Optional[str] = None,
 ):
-    ua = await _load_by_click(click_id)
-    if not ua:
-        return _nf(click_id=click_id)
-
-    tenant_id = ua.tenant_id
-    if not _tid_matches(ua, tid):
-        await _log_event("ftd", ua, {"click_id": click_id, "sumdep": sumdep or sum_alt or amount_alt, "tid": tid})
-        return _err("bad_secret")
-    if not await _check_secret(tenant_id, secret):
-        eff_sum = sumdep or sum_alt or amount_alt
-        await _log_event("ftd", ua, {"click_id": click_id, "sumdep": eff_sum, "tid": tenant_id})
-        return _err("bad_secret")
-
     eff_sum = sumdep or sum_alt or amount_alt
-
-    # FTD: has_deposit=1, total_deposits минимум 1, но не уменьшаем существующее
-    async with SessionLocal() as s:
-        vals = {
-            "has_deposit": True,
-            "total_deposits": case(
-                (func.coalesce(UserAccess.total_deposits, 0) == 0, 1),
-                else_=UserAccess.total_deposits
-            ),
-        }
-        if trader_id and not ua.trader_id:
-            vals["trader_id"] = trader_id
-
-        await s.execute(
-            UserAccess.__table__.update()
-            .where(UserAccess.id == ua.id)
-            .values(**vals)
-        )
-        await s.commit()
-
-    await _log_event("ftd", ua, {"click_id": click_id, "sumdep": eff_sum, "tid": tenant_id, "trader_id": trader_id})
-
-    # platinum check
-    tnt = await _get_tenant(tenant_id)
-    thr = float((tnt.platinum_threshold_usd or 500.0))
-    total = await user_deposit_sum(tenant_id, ua.click_id)
-    if (not ua.is_platinum) and total >= thr:
-        async with SessionLocal() as s:
-            await s.execute(
-                UserAccess.__table__
-                .update()
-                .where(UserAccess.id == ua.id)
-                .values(is_platinum=True, platinum_shown=False)  # сбрасываем, чтобы экран показался
-            )
-            await s.commit()
-
-    await _push_next_screen(ua.id)
-    return _ok(first_time=True, amount=_parse_amount(eff_sum))
+    params = {"click_id": click_id, "sumdep": eff_sum, "tid": tid, "trader_id": trader_id,
+              "txn_id": txn_id or txn_alt}
+    return await _apply_postback("ftd", params, tid, secret, first_time=True, amount=_parse_amount(eff_sum))
 
 
 @app.get("/pp/rd")
@@ -378,59 +525,241 @@ async def pp_rd(
     sum_alt: Optional[str] = Query(None, alias="sum"),
     amount_alt: Optional[str] = Query(None, alias="amount"),
     trader_id: Optional[str] = None,
+    txn_id: Optional[str] = None,
+    txn_alt: Optional[str] = Query(None, alias="transaction_id"),
     tid: Optional[int] = None,
     secret: Optional[str] = None,
 ):
-    ua = await _load_by_click(click_id)
-    if not ua:
-        return _nf(click_id=click_id)
+    eff_sum = sumdep or sum_alt or amount_alt
+    params = {"click_id": click_id, "sumdep": eff_sum, "tid": tid, "trader_id": trader_id,
+              "txn_id": txn_id or txn_alt}
+    return await _apply_postback("rd", params, tid, secret, amount=_parse_amount(eff_sum))
 
-    tenant_id = ua.tenant_id
-    if not _tid_matches(ua, tid):
-        await _log_event("rd", ua, {"click_id": click_id, "sumdep": sumdep or sum_alt or amount_alt, "tid": tid})
-        return _err("bad_secret")
-    if not await _check_secret(tenant_id, secret):
-        eff_sum = sumdep or sum_alt or amount_alt
-        await _log_event("rd", ua, {"click_id": click_id, "sumdep": eff_sum, "tid": tenant_id})
-        return _err("bad_secret")
 
-    eff_sum = sumdep or sum_alt or amount_alt
+# =========================
+#          Batch
+# =========================
+def _parse_batch(body: bytes) -> List[Any]:
+    """
+    Тело /pp/batch: JSON-массив, {"items": [...]} или NDJSON (объект на строку).
+    Битая строка NDJSON даёт None на своём месте (ошибка только у этого элемента).
+    """
+    raw = body.decode("utf-8-sig", errors="replace").strip()
+    if not raw:
+        return []
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        items: List[Any] = []
+        for line in raw.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)
+        return items
+    if isinstance(data, dict):
+        data = data.get("items", [data])
+    if not isinstance(data, list):
+        raise ValueError("batch must be a list")
+    return data
+
+
+def _batch_item(raw: Any) -> Optional[Tuple[str, dict, Optional[str]]]:
+    """Элемент батча → (kind, params как у GET-эндпоинта, secret) или None, если элемент кривой."""
+    if not isinstance(raw, dict):
+        return None
+    kind = str(raw.get("kind") or "").lower()
+    click_id = raw.get("click_id")
+    if kind not in ("reg", "ftd", "rd") or not click_id:
+        return None
+    try:
+        tid = int(raw["tid"]) if raw.get("tid") not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
 
-    # RD: атомарный инкремент total_deposits, ставим has_deposit=1
-    async with SessionLocal() as s:
-        vals = {
-            "has_deposit": True,
-            "total_deposits": func.coalesce(UserAccess.total_deposits, 0) + 1,
-        }
-        if trader_id and not ua.trader_id:
-            vals["trader_id"] = trader_id
+    def opt(*names):
+        for n in names:
+            if raw.get(n) not in (None, ""):
+                return str(raw[n])
+        return None
 
-        await s.execute(
-            UserAccess.__table__.update()
-            .where(UserAccess.id == ua.id)
-            .values(**vals)
-        )
+    params = {"click_id": str(click_id), "trader_id": opt("trader_id"), "tid": tid}
+    if kind != "reg":
+        params["sumdep"] = opt("sumdep", "sum", "amount")
+        params["txn_id"] = opt("txn_id", "transaction_id")
+    return kind, params, opt("secret")
+
+
+def _total_deposits_expr(kinds: List[str]):
+    """
+    total_deposits после серии ftd/rd пользователя (в порядке прихода) — одним выражением.
+    Как у одиночных постбэков: ftd поднимает 0 до 1, rd добавляет 1. После первого
+    депозита значение уже ≥ 1, так что важен только ftd, пришедший первым.
+    """
+    expr = func.coalesce(UserAccess.total_deposits, 0)
+    if kinds[0] == "ftd":
+        expr = case((expr == 0, 1), else_=expr)
+    rds = kinds.count("rd")
+    return expr + rds if rds else expr
+
+
+async def _apply_batch(items: List[Tuple[int, str, dict, Optional[str]]], results: List[Optional[dict]]) -> None:
+    """
+    Применить элементы батча (idx, kind, params, secret) одной транзакцией; ответы — в results[idx].
+    Пользователи и тенанты грузятся по разу, секрет проверяется по разу на (тенант, secret),
+    ключи идемпотентности занимаются одним upsert'ом, события пишутся одним executemany,
+    а постбэки одного пользователя схлопываются в один UPDATE и один пуш итогового экрана.
+    """
+    generated: Set[int] = set()
+    async with SessionLocal() as s:
+        clicks = {p["click_id"] for _, _, p, _ in items}
+        res = await s.execute(select(UserAccess).where(UserAccess.click_id.in_(clicks)))
+        uas = {ua.click_id: ua for ua in res.scalars()}
+
+        tenants: Dict[int, Optional[TenantConfig]] = {}
+        secret_ok: Dict[Tuple[int, Optional[str]], bool] = {}
+        events: List[dict] = []
+        accepted = []   # (idx, kind, params, ua, key)
+        for idx, kind, params, secret in items:
+            ua = uas.get(params["click_id"])
+            if ua is None:
+                results[idx] = _nf(click_id=params["click_id"])
+                continue
+            tenant_id = ua.tenant_id
+            if tenant_id not in tenants:
+                tenants[tenant_id] = await _get_tenant(tenant_id, s)
+            tenant = tenants[tenant_id]
+            ok = False
+            if tenant is not None and _tid_matches(ua, params["tid"]):
+                if (tenant_id, secret) not in secret_ok:
+                    secret_ok[(tenant_id, secret)] = await _secret_ok(s, tenant, secret)
+                    if not tenant.pb_secret:
+                        generated.add(tenant_id)
+                ok = secret_ok[(tenant_id, secret)]
+            if not ok:
+                events.append(_event_values(f"{kind}_bad", ua, params))
+                results[idx] = _err("bad_secret", click_id=params["click_id"])
+                continue
+            accepted.append((idx, kind, params, ua, _dedup_key(kind, params)))
+
+        # идемпотентность: повторы внутри батча и уже применённые раньше
+        first: Dict[str, int] = {}
+        in_batch_dups: List[Tuple[int, str]] = []
+        for idx, kind, params, ua, key in accepted:
+            if key in first:
+                in_batch_dups.append((idx, key))
+            else:
+                first[key] = idx
+        claimed = await _claim_dedup(s, [(key, ua.tenant_id, kind) for idx, kind, params, ua, key in accepted
+                                         if first[key] == idx])
+        cached = await _dedup_responses(s, [k for k in first if k not in claimed])
+        for key, resp in cached.items():
+            results[first[key]] = resp
+        fresh = [it for it in accepted if it[4] in claimed and first[it[4]] == it[0]]
+
+        # по пользователю: один UPDATE со всеми инкрементами (в SQL)
+        by_ua: Dict[int, list] = {}
+        for it in fresh:
+            by_ua.setdefault(it[3].id, []).append(it)
+        daily: Dict[int, Dict[str, float]] = {}
+        for ua_id, its in by_ua.items():
+            ua = its[0][3]
+            tenant = tenants[ua.tenant_id]
+            d = daily.setdefault(ua.tenant_id, dict.fromkeys(DAILY_COUNTERS, 0))
+            upd = UserAccess.__table__.update().where(UserAccess.id == ua_id)
+            vals = {}
+            trader_id = next((p["trader_id"] for _, _, p, _, _ in its if p.get("trader_id")), None)
+            if trader_id and not ua.trader_id:
+                vals["trader_id"] = trader_id
+
+            if any(kind == "reg" for _, kind, _, _, _ in its):
+                res = await s.execute(upd.where(UserAccess.is_registered.isnot(True)).values(is_registered=True))
+                if res.rowcount:
+                    d["registrations"] += 1
+
+            kinds = [kind for _, kind, _, _, _ in its if kind != "reg"]
+            if kinds:
+                amounts = [_parse_amount(p.get("sumdep")) or 0.0 for _, kind, p, _, _ in its if kind != "reg"]
+                total = (await s.execute(
+                    upd.values(
+                        has_deposit=True,
+                        deposit_total=func.coalesce(UserAccess.deposit_total, 0.0) + sum(amounts),
+                        deposit_count=func.coalesce(UserAccess.deposit_count, 0) + len(kinds),
+                        total_deposits=_total_deposits_expr(kinds),
+                        **vals,
+                    ).returning(UserAccess.deposit_total)
+                )).scalar_one()
+                d["ftds"] += kinds.count("ftd")
+                d["redeposits"] += kinds.count("rd")
+                d["deposit_sum"] += sum(amounts)
+
+                if float(total or 0.0) >= float(tenant.platinum_threshold_usd or 500.0):
+                    res = await s.execute(
+                        upd.where(UserAccess.is_platinum.isnot(True))
+                        .values(is_platinum=True, platinum_shown=False)
+                    )
+                    if res.rowcount:
+                        d["platinum_upgrades"] += 1
+            elif vals:
+                await s.execute(upd.values(**vals))
+
+            # один пуш на пользователя — экран строится по итоговому состоянию
+            await push_queue.enqueue(ua, s)
+
+        events.extend(_event_values(kind, ua, params) for _, kind, params, ua, _ in fresh)
+        if events:
+            await s.execute(Event.__table__.insert(), events)
+        for tenant_id, d in daily.items():
+            await bump_daily(s, tenant_id, **d)
+
+        states = {}
+        if by_ua:
+            res = await s.execute(select(UserAccess.id, *_STATE_COLS).where(UserAccess.id.in_(list(by_ua))))
+            states = {row.id: {c.key: row._mapping[c.key] for c in _STATE_COLS} for row in res.all()}
+        responses = {}
+        for idx, kind, params, ua, key in fresh:
+            extra = {} if kind == "reg" else {"amount": _parse_amount(params.get("sumdep"))}
+            results[idx] = responses[key] = _ok(kind=kind, click_id=params["click_id"], **extra,
+                                                state=states[ua.id])
+        await _save_responses(s, responses)
         await s.commit()
 
-    # лог с пробросом trader_id
-    await _log_event("rd", ua, {"click_id": click_id, "sumdep": eff_sum, "tid": tenant_id, "trader_id": trader_id})
-
-    # platinum check
-    tnt = await _get_tenant(tenant_id)
-    thr = float((tnt.platinum_threshold_usd or 500.0))
-    total = await user_deposit_sum(tenant_id, ua.click_id)
-    if (not ua.is_platinum) and total >= thr:
-        async with SessionLocal() as s:
-            await s.execute(
-                UserAccess.__table__
-                .update()
-                .where(UserAccess.id == ua.id)
-                .values(is_platinum=True, platinum_shown=False)
-            )
-            await s.commit()
+    for tenant_id in generated:
+        invalidate_tenant(tenant_id)
+    for idx, key in in_batch_dups:
+        results[idx] = {**results[first[key]], "duplicate": True}
+    if by_ua:
+        push_queue.wake()
+
 
-    await _push_next_screen(ua.id)
-    return _ok(total_deposits=None, amount=_parse_amount(eff_sum))  # total_deposits можно не возвращать
+@app.post("/pp/batch")
+async def pp_batch(request: Request):
+    """
+    Пачка постбэков (сверка с партнёркой после простоя). Тело — JSON-массив или NDJSON
+    из объектов {kind: reg|ftd|rd, click_id, secret, tid?, trader_id?, sumdep|sum|amount?, txn_id?}.
+    Ответ — results в порядке элементов, каждый как у соответствующего GET-эндпоинта.
+    """
+    try:
+        raw_items = _parse_batch(await request.body())
+    except ValueError:
+        return _err("bad_json")
+    if len(raw_items) > settings.PP_BATCH_MAX:
+        return _err("too_many", max=settings.PP_BATCH_MAX)
+
+    results: List[Optional[dict]] = [None] * len(raw_items)
+    items = []
+    for idx, raw in enumerate(raw_items):
+        parsed = _batch_item(raw)
+        if parsed is None:
+            results[idx] = _err("bad_item")
+        else:
+            items.append((idx, *parsed))
+    if items:
+        await _apply_batch(items, results)
+    return _ok(count=len(results), results=results)
 
 
 @app.get("/pp/debug")
@@ -438,7 +767,7 @@ async def pp_debug(click_id: str = Query(...)):
     ua = await _load_by_click(click_id)
     if not ua:
         return _nf(click_id=click_id)
-    total = await user_deposit_sum(ua.tenant_id, ua.click_id)
+    total = float(ua.deposit_total or 0.0)
     return _ok(
         tenant_id=ua.tenant_id, user_id=ua.user_id,
         is_registered=ua.is_registered, has_deposit=ua.has_deposit,
@@ -0,0 +1,237 @@
+# app/web/push_queue.py
+from __future__ import annotations
+
+import asyncio
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, List, Optional
+
+from sqlalchemy import exists, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from app.db import SessionLocal
+from app.models import PushJob, UserAccess
+from app.outbound import PRIORITY_PUSH, use_priority
+from app.settings import settings
+from app.utils.logging import logger
+
+
+class PushQueue:
+    """
+    Очередь пушей на таблице push_jobs. Постбэк только ставит задачу и сразу отвечает,
+    а пул воркеров вызывает handler(ua_id).
+
+    - На пользователя не больше одной ждущей задачи: пуш всё равно строит экран
+      по актуальному состоянию, так что повторные постбэки схлопываются.
+    - Порядок в чате: задача не берётся, пока у того же (tenant_id, chat_id) есть running
+      (проверка в БД, поэтому работает и при нескольких процессах).
+    - running-задача арендована воркером (locked_by/locked_until, аренда PUSH_LEASE_SEC
+      продлевается, пока идёт пуш). В очередь возвращаются только задачи с истёкшей арендой —
+      живой соседний процесс свою работу не теряет.
+    - Ошибка → повтор с экспоненциальной паузой, после PUSH_MAX_ATTEMPTS — status=failed.
+      failed-задачи хранятся PUSH_FAILED_KEEP_SEC, потом их удаляет фоновая чистка.
+    """
+
+    def __init__(self, handler: Callable[[int], Awaitable[None]], workers: Optional[int] = None):
+        self.handler = handler
+        self.workers = workers or settings.PUSH_WORKERS
+        self._wake = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        # владелец аренды: процесс + экземпляр очереди
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"[:64]
+
+    # ---------- producer ----------
+    async def enqueue(self, ua: UserAccess, s: Optional[AsyncSession] = None) -> None:
+        """
+        Поставить пуш пользователю. С сессией s — в транзакции вызывающего
+        (коммит и wake() — на нём), без неё — отдельной транзакцией.
+        """
+        if s is None:
+            async with SessionLocal() as own:
+                await self._insert(own, ua)
+                await own.commit()
+            self.wake()
+        else:
+            await self._insert(s, ua)
+
+    async def _insert(self, s: AsyncSession, ua: UserAccess) -> None:
+        if ua.blocked_at is not None:
+            return  # мёртвый чат — пушить некуда (снимается, когда пользователь нажмёт /start)
+        pending = (await s.execute(
+            select(PushJob.id).where(PushJob.ua_id == ua.id, PushJob.status == "queued").limit(1)
+        )).first()
+        if pending is None:
+            await s.execute(PushJob.__table__.insert().values(
+                tenant_id=ua.tenant_id, chat_id=ua.user_id, ua_id=ua.id,
+                status="queued", attempts=0, run_after=datetime.utcnow(),
+            ))
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    # ---------- lifecycle ----------
+    async def start(self) -> None:
+        # задачи упавших процессов (аренда истекла) возвращаем в очередь
+        n = await self.reclaim_expired()
+        if n:
+            logger.info(f"Push queue: re-queued {n} jobs with expired lease")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._janitor()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @staticmethod
+    async def purge_failed() -> int:
+        cutoff = datetime.utcnow() - timedelta(seconds=settings.PUSH_FAILED_KEEP_SEC)
+        async with SessionLocal() as s:
+            res = await s.execute(
+                PushJob.__table__.delete().where(PushJob.status == "failed", PushJob.updated_at < cutoff)
+            )
+            await s.commit()
+            return res.rowcount or 0
+
+    @staticmethod
+    async def reclaim_expired() -> int:
+        """running-задачи, чья аренда истекла (воркер умер или завис), — снова в очередь."""
+        now = datetime.utcnow()
+        async with SessionLocal() as s:
+            res = await s.execute(
+                PushJob.__table__.update()
+                .where(
+                    PushJob.status == "running",
+                    or_(PushJob.locked_until.is_(None), PushJob.locked_until < now),
+                )
+                .values(status="queued", locked_by=None, locked_until=None)
+            )
+            await s.commit()
+            return res.rowcount or 0
+
+    async def _janitor(self) -> None:
+        purged_at = 0.0
+        while True:
+            try:
+                n = await self.reclaim_expired()
+                if n:
+                    logger.warning(f"Push queue: re-queued {n} jobs with expired lease")
+                if time.monotonic() - purged_at >= 3600:
+                    purged_at = time.monotonic()
+                    n = await self.purge_failed()
+                    if n:
+                        logger.info(f"Push queue: purged {n} failed jobs")
+            except Exception as e:
+                logger.warning(f"push_jobs janitor failed: {e}")
+            await asyncio.sleep(settings.PUSH_LEASE_SEC)
+
+    # ---------- consumer ----------
+    async def _claim(self) -> Optional[PushJob]:
+        now = datetime.utcnow()
+        busy = aliased(PushJob)
+        async with SessionLocal() as s:
+            while True:
+                job = (await s.execute(
+                    select(PushJob)
+                    .where(
+                        PushJob.status == "queued",
+                        PushJob.run_after <= now,
+                        ~exists().where(
+                            busy.tenant_id == PushJob.tenant_id,
+                            busy.chat_id == PushJob.chat_id,
+                            busy.status == "running",
+                            busy.locked_until >= now,
+                        ),
+                    )
+                    .order_by(PushJob.id)
+                    .limit(1)
+                )).scalar_one_or_none()
+                if job is None:
+                    return None
+                res = await s.execute(
+                    PushJob.__table__.update()
+                    .where(PushJob.id == job.id, PushJob.status == "queued")
+                    .values(
+                        status="running", attempts=PushJob.attempts + 1,
+                        locked_by=self.owner,
+                        locked_until=now + timedelta(seconds=settings.PUSH_LEASE_SEC),
+                    )
+                )
+                await s.commit()
+                if res.rowcount:
+                    job.attempts += 1
+                    return job
+                # задачу забрал другой воркер — пробуем следующую
+
+    async def _worker(self) -> None:
+        while True:
+            try:
+                job = await self._claim()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Push queue claim error: {e}")
+                job = None
+            if job is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), settings.PUSH_POLL_SEC)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            with use_priority(PRIORITY_PUSH):
+                await self._run(job)
+
+    async def _heartbeat(self, job_id: int) -> None:
+        """Продлевает аренду, пока идёт пуш (ожидание лимитов Telegram может быть долгим)."""
+        while True:
+            await asyncio.sleep(settings.PUSH_LEASE_SEC / 3)
+            try:
+                async with SessionLocal() as s:
+                    await s.execute(
+                        PushJob.__table__.update()
+                        .where(PushJob.id == job_id, PushJob.locked_by == self.owner)
+                        .values(locked_until=datetime.utcnow() + timedelta(seconds=settings.PUSH_LEASE_SEC))
+                    )
+                    await s.commit()
+            except Exception as e:
+                logger.warning(f"Push job {job_id}: lease renew failed: {e}")
+
+    async def _run(self, job: PushJob) -> None:
+        heartbeat = asyncio.create_task(self._heartbeat(job.id))
+        try:
+            await self.handler(job.ua_id)
+        except asyncio.CancelledError:
+            # остановка процесса: задачу вернёт в очередь чистка, когда истечёт аренда
+            raise
+        except Exception as e:
+            failed = job.attempts >= settings.PUSH_MAX_ATTEMPTS
+            delay = min(2 ** job.attempts, 300)
+            logger.warning(
+                f"Push job {job.id} (ua {job.ua_id}) attempt {job.attempts} failed: {e}"
+                + ("; giving up" if failed else f"; retry in {delay}s")
+            )
+            async with SessionLocal() as s:
+                await s.execute(
+                    PushJob.__table__.update()
+                    # аренду уже забрали (истекла) — задача не наша, не трогаем
+                    .where(PushJob.id == job.id, PushJob.locked_by == self.owner)
+                    .values(
+                        status="failed" if failed else "queued",
+                        run_after=datetime.utcnow() + timedelta(seconds=delay),
+                        last_error=str(e)[:1000],
+                        locked_by=None, locked_until=None,
+                    )
+                )
+                await s.commit()
+            return
+        finally:
+            heartbeat.cancel()
+        async with SessionLocal() as s:
+            await s.execute(PushJob.__table__.delete().where(PushJob.id == job.id))
+            await s.commit()
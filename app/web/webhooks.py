@@ -0,0 +1,45 @@
+from __future__ import annotations
+
+import hmac
+from typing import Optional
+
+from fastapi import FastAPI, Header, Request, Response
+from aiogram.types import Update
+
+from app.bots.child.engine import ChildBotsEngine
+from app.settings import settings
+from app.utils.logging import logger
+
+
+def make_webhook_app(engine: ChildBotsEngine, shard: int = 0) -> FastAPI:
+    """
+    Приём апдейтов детских ботов: POST {webhook_prefix(shard)}/{tenant_id}.
+    Запускается внутри процесса детей (шарда), апдейт уходит в общий диспетчер движка.
+    """
+    app = FastAPI(title="Child webhooks")
+
+    @app.post(settings.webhook_prefix(shard) + "/{tenant_id}")
+    async def tg_webhook(
+        tenant_id: int,
+        request: Request,
+        secret: Optional[str] = Header(None, alias="X-Telegram-Bot-Api-Secret-Token"),
+    ):
+        bot = engine.get_bot(tenant_id)
+        must = engine.secret_for(tenant_id)
+        if bot is None or not must:
+            return Response(status_code=404)
+        # байты: compare_digest на str падает TypeError на не-ASCII символах
+        if not secret or not hmac.compare_digest(secret.encode(), must.encode()):
+            return Response(status_code=403)
+
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": bot})
+        except Exception as e:
+            logger.warning(f"Bad webhook payload (tenant {tenant_id}): {e}")
+            return Response(status_code=400)
+
+        # отвечаем Telegram сразу, обработка идёт в фоне
+        engine.feed(tenant_id, bot, update)
+        return {"ok": True}
+
+    return app
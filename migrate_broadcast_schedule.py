@@ -0,0 +1,32 @@
+# migrate_broadcast_schedule.py
+import os, sqlite3
+
+db = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./saas.db")
+path = db.split("///")[-1] if "///" in db else "saas.db"
+
+con = sqlite3.connect(path)
+cur = con.cursor()
+
+def has_table(table):
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    return cur.fetchone() is not None
+
+def has_col(table, col):
+    cur.execute(f"PRAGMA table_info({table})")
+    return any(r[1] == col for r in cur.fetchall())
+
+added = []
+# таблицы ещё нет — её целиком создаст init_db()
+if has_table("broadcasts"):
+    if not has_col("broadcasts", "send_at"):
+        cur.execute("ALTER TABLE broadcasts ADD COLUMN send_at DATETIME")
+        added.append("send_at")
+    if not has_col("broadcasts", "recurrence"):
+        cur.execute("ALTER TABLE broadcasts ADD COLUMN recurrence VARCHAR(16)")
+        added.append("recurrence")
+    if not has_col("broadcasts", "parent_id"):
+        cur.execute("ALTER TABLE broadcasts ADD COLUMN parent_id INTEGER")
+        added.append("parent_id")
+
+con.commit(); con.close()
+print(f"OK: broadcasts.{'/'.join(added)}" if added else "No changes")
@@ -0,0 +1,26 @@
+# migrate_deliverability.py
+import os, sqlite3
+
+db = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./saas.db")
+path = db.split("///")[-1] if "///" in db else "saas.db"
+
+con = sqlite3.connect(path)
+cur = con.cursor()
+
+def has_col(table, col):
+    cur.execute(f"PRAGMA table_info({table})")
+    return any(r[1] == col for r in cur.fetchall())
+
+added = []
+if not has_col("user_access", "blocked_at"):
+    cur.execute("ALTER TABLE user_access ADD COLUMN blocked_at DATETIME")
+    added.append("blocked_at")
+if not has_col("user_access", "fail_count"):
+    cur.execute("ALTER TABLE user_access ADD COLUMN fail_count INTEGER NOT NULL DEFAULT 0")
+    added.append("fail_count")
+if not has_col("user_access", "last_error"):
+    cur.execute("ALTER TABLE user_access ADD COLUMN last_error VARCHAR(255)")
+    added.append("last_error")
+
+con.commit(); con.close()
+print(f"OK: user_access.{'/'.join(added)}" if added else "No changes")
@@ -0,0 +1,38 @@
+# migrate_deposit_totals.py
+import os, sqlite3
+
+db = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./saas.db")
+path = db.split("///")[-1] if "///" in db else "saas.db"
+
+con = sqlite3.connect(path)
+cur = con.cursor()
+
+def has_col(table, col):
+    cur.execute(f"PRAGMA table_info({table})")
+    return any(r[1] == col for r in cur.fetchall())
+
+added = False
+if not has_col("user_access", "deposit_total"):
+    cur.execute("ALTER TABLE user_access ADD COLUMN deposit_total FLOAT NOT NULL DEFAULT 0")
+    added = True
+if not has_col("user_access", "deposit_count"):
+    cur.execute("ALTER TABLE user_access ADD COLUMN deposit_count INTEGER NOT NULL DEFAULT 0")
+    added = True
+
+if added:
+    # первичное заполнение из events (потом — scripts/rebuild_deposit_totals.py)
+    cur.execute("""
+        UPDATE user_access SET
+          deposit_total = COALESCE((
+            SELECT SUM(e.amount) FROM events e
+            WHERE e.tenant_id = user_access.tenant_id AND e.click_id = user_access.click_id
+              AND e.kind IN ('ftd', 'rd')), 0),
+          deposit_count = (
+            SELECT COUNT(*) FROM events e
+            WHERE e.tenant_id = user_access.tenant_id AND e.click_id = user_access.click_id
+              AND e.kind IN ('ftd', 'rd'))
+        WHERE click_id IS NOT NULL
+    """)
+
+con.commit(); con.close()
+print("OK: user_access.deposit_total/deposit_count" if added else "No changes")
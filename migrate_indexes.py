@@ -0,0 +1,124 @@
+# migrate_indexes.py
+import os, sqlite3
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects import sqlite
+
+from app.models import ContentOverride, Event, UserAccess, UserLang, UserState
+from app.stats import _AGG
+from app.bots.child.broadcast import segment_where
+
+db = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./saas.db")
+path = db.split("///")[-1] if "///" in db else "saas.db"
+
+con = sqlite3.connect(path)
+cur = con.cursor()
+
+# Индексы под горячие запросы (зеркало __table_args__ в app/models.py)
+INDEXES = {
+    "ix_user_access_tenant_stats":
+        "CREATE INDEX IF NOT EXISTS ix_user_access_tenant_stats ON user_access "
+        "(tenant_id, is_registered, has_deposit, is_platinum, deposit_total, blocked_at)",
+    "ix_user_access_tenant_registered":
+        "CREATE INDEX IF NOT EXISTS ix_user_access_tenant_registered ON user_access (tenant_id) WHERE is_registered = 1",
+    "ix_user_access_tenant_deposit":
+        "CREATE INDEX IF NOT EXISTS ix_user_access_tenant_deposit ON user_access (tenant_id) WHERE has_deposit = 1",
+    "ix_events_tenant_click":
+        "CREATE INDEX IF NOT EXISTS ix_events_tenant_click ON events (tenant_id, click_id, trader_id)",
+}
+
+
+def sql(stmt) -> str:
+    """SQL ровно в том виде, как его строит приложение (литералы вместо параметров)."""
+    return str(stmt.compile(dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True}))
+
+
+# Горячие запросы (те же условия, что в коде) и индексы, которые они должны использовать.
+# Там, где приложение грузит строку целиком, берём только id: выбор индекса зависит от WHERE,
+# а список колонок на не до конца смигрированной базе упал бы раньше проверки.
+# (tenant_id, user_id) / (tenant_id, chat_id) / (tenant_id, lang, screen) покрыты уникальными ограничениями.
+CHECKS = [
+    ("lang по пользователю (bot_instance)",
+     sql(select(UserLang.id).where(UserLang.tenant_id == 1, UserLang.user_id == 1)),
+     ("uq_user_lang", "sqlite_autoindex_user_lang")),
+    ("UserAccess по пользователю (bot_instance, postbacks)",
+     sql(select(UserAccess.id).where(UserAccess.tenant_id == 1, UserAccess.user_id == 1)),
+     ("uq_user_access", "sqlite_autoindex_user_access")),
+    ("UserState по чату (last_bot_message_id)",
+     sql(select(UserState.last_bot_message_id, UserState.updated_at)
+         .where(UserState.tenant_id == 1, UserState.chat_id == 1)),
+     ("uq_user_state_chat", "sqlite_autoindex_user_state")),
+    ("ContentOverride тенанта",
+     sql(select(ContentOverride.id).where(ContentOverride.tenant_id == 1)),
+     ("uq_content_override", "sqlite_autoindex_content_override", "ix_content_override_tenant_id")),
+    ("статистика тенанта (app.stats.user_stats)",
+     sql(select(*_AGG).where(UserAccess.tenant_id == 1)),
+     ("COVERING INDEX ix_user_access_tenant_stats",)),
+    ("статистика по всем тенантам (app.stats.user_stats_by_tenant)",
+     sql(select(UserAccess.tenant_id, *_AGG).group_by(UserAccess.tenant_id)),
+     ("COVERING INDEX ix_user_access_tenant_stats",)),
+    ("получатели сегмента (count_recipients)",
+     sql(select(func.count()).select_from(UserAccess).where(UserAccess.tenant_id == 1, *segment_where("reg"))),
+     ("COVERING INDEX ix_user_access_tenant_stats",)),
+    ("страница рассылки, все (keyset по id, iter_recipients)",
+     sql(select(UserAccess.id, UserAccess.user_id)
+         .where(UserAccess.tenant_id == 1, UserAccess.id > 0, *segment_where("all"))
+         .order_by(UserAccess.id).limit(1000)),
+     ("ix_user_access_tenant_id (tenant_id=? AND rowid>?)",)),
+    ("страница рассылки, reg",
+     sql(select(UserAccess.id, UserAccess.user_id)
+         .where(UserAccess.tenant_id == 1, UserAccess.id > 0, *segment_where("reg"))
+         .order_by(UserAccess.id).limit(1000)),
+     ("ix_user_access_tenant_registered (tenant_id=? AND rowid>?)",)),
+    ("страница рассылки, dep",
+     sql(select(UserAccess.id, UserAccess.user_id)
+         .where(UserAccess.tenant_id == 1, UserAccess.id > 0, *segment_where("dep"))
+         .order_by(UserAccess.id).limit(1000)),
+     ("ix_user_access_tenant_deposit (tenant_id=? AND rowid>?)",)),
+    ("поиск пользователя в админке (join events)",
+     sql(select(UserAccess.id)
+         .join(Event, (Event.tenant_id == UserAccess.tenant_id) & (Event.click_id == UserAccess.click_id),
+               isouter=True)
+         .where(UserAccess.tenant_id == 1, (UserAccess.trader_id == "x") | (Event.trader_id == "x"))
+         .order_by(UserAccess.id.desc()).limit(50)),
+     ("COVERING INDEX ix_events_tenant_click",)),
+]
+
+
+def existing_indexes():
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+    return {r[0] for r in cur.fetchall()}
+
+
+before = existing_indexes()
+for name, ddl in INDEXES.items():
+    cur.execute(ddl)
+added = [n for n in INDEXES if n not in before]
+# без статистики планировщик выбирает между индексами по tenant_id наугад
+if added or "sqlite_stat1" not in {r[0] for r in cur.execute("SELECT name FROM sqlite_master")}:
+    cur.execute("ANALYZE")
+con.commit()
+
+print("OK: added " + ", ".join(added) if added else "No changes")
+
+# EXPLAIN QUERY PLAN: каждый горячий запрос должен идти по ожидаемому индексу
+# (на пустой таблице ANALYZE статистики не даёт — выбор индекса там не показателен)
+cur.execute("SELECT DISTINCT tbl FROM sqlite_stat1")
+with_stats = {r[0] for r in cur.fetchall()}
+failed = 0
+for title, q, expect in CHECKS:
+    cur.execute("EXPLAIN QUERY PLAN " + q)
+    plan = " | ".join(r[-1] for r in cur.fetchall())
+    table = q.split("\nFROM ", 1)[1].split()[0]
+    if any(ix in plan for ix in expect):
+        status = "OK"
+    elif table not in with_stats:
+        status = "SKIP"
+    else:
+        status = "MISS"
+        failed += 1
+    print(f"[{status}] {title}: {plan}")
+
+con.close()
+if failed:
+    raise SystemExit(f"{failed} hot queries do not use the expected index")
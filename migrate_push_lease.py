@@ -0,0 +1,29 @@
+# migrate_push_lease.py
+import os, sqlite3
+
+db = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./saas.db")
+path = db.split("///")[-1] if "///" in db else "saas.db"
+
+con = sqlite3.connect(path)
+cur = con.cursor()
+
+def has_table(table):
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    return cur.fetchone() is not None
+
+def has_col(table, col):
+    cur.execute(f"PRAGMA table_info({table})")
+    return any(r[1] == col for r in cur.fetchall())
+
+added = []
+# таблицу без колонок создаст init_db() — тогда менять нечего
+if has_table("push_jobs"):
+    if not has_col("push_jobs", "locked_by"):
+        cur.execute("ALTER TABLE push_jobs ADD COLUMN locked_by VARCHAR(64)")
+        added.append("locked_by")
+    if not has_col("push_jobs", "locked_until"):
+        cur.execute("ALTER TABLE push_jobs ADD COLUMN locked_until DATETIME")
+        added.append("locked_until")
+
+con.commit(); con.close()
+print("OK: push_jobs." + ", push_jobs.".join(added) if added else "No changes")
@@ -0,0 +1,20 @@
+# migrate_tenant_restart.py
+import os, sqlite3
+
+db = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./saas.db")
+path = db.split("///")[-1] if "///" in db else "saas.db"
+
+con = sqlite3.connect(path)
+cur = con.cursor()
+
+def has_col(table, col):
+    cur.execute(f"PRAGMA table_info({table})")
+    return any(r[1] == col for r in cur.fetchall())
+
+added = False
+if not has_col("tenants", "restart_seq"):
+    cur.execute("ALTER TABLE tenants ADD COLUMN restart_seq INTEGER NOT NULL DEFAULT 0")
+    added = True
+
+con.commit(); con.close()
+print("OK: tenants.restart_seq" if added else "No changes")
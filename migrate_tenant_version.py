@@ -0,0 +1,24 @@
+# migrate_tenant_version.py
+import os, sqlite3
+
+db = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./saas.db")
+path = db.split("///")[-1] if "///" in db else "saas.db"
+
+con = sqlite3.connect(path)
+cur = con.cursor()
+
+def has_col(table, col):
+    cur.execute(f"PRAGMA table_info({table})")
+    return any(r[1] == col for r in cur.fetchall())
+
+added = False
+if not has_col("tenants", "version"):
+    cur.execute("ALTER TABLE tenants ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+    added = True
+if not has_col("tenants", "updated_at"):
+    cur.execute("ALTER TABLE tenants ADD COLUMN updated_at DATETIME")
+    cur.execute("UPDATE tenants SET updated_at = created_at WHERE updated_at IS NULL")
+    added = True
+
+con.commit(); con.close()
+print("OK: tenants.version/updated_at" if added else "No changes")
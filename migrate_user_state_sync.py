@@ -0,0 +1,21 @@
+# migrate_user_state_sync.py
+import os, sqlite3
+
+db = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./saas.db")
+path = db.split("///")[-1] if "///" in db else "saas.db"
+
+con = sqlite3.connect(path)
+cur = con.cursor()
+
+def has_index(name):
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (name,))
+    return cur.fetchone() is not None
+
+added = False
+# процесс детей раз в LAST_MSG_SYNC_SEC читает строки user_state, изменённые с прошлого раза
+if not has_index("ix_user_state_updated_at"):
+    cur.execute("CREATE INDEX ix_user_state_updated_at ON user_state (updated_at)")
+    added = True
+
+con.commit(); con.close()
+print("OK: ix_user_state_updated_at" if added else "No changes")
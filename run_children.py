@@ -1,10 +1,15 @@
 import asyncio
 from app.db import init_db
-from app.bots.children_runner import run_children_loop
+from app.settings import settings
+from app.bots.children_runner import run_children_loop, run_children_supervisor, run_until_signal
 
 async def main():
     await init_db()
-    await run_children_loop()
+    await run_until_signal(run_children_loop())
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if settings.CHILD_SHARDS > 1:
+        asyncio.run(init_db())
+        run_children_supervisor()
+    else:
+        asyncio.run(main())
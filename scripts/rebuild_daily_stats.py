@@ -0,0 +1,83 @@
+# scripts/rebuild_daily_stats.py
+"""
+Пересобирает tenant_daily_stats из user_access (новые пользователи) и events
+(регистрации, FTD/RD, суммы, переходы в Platinum).
+Запуск:  python -m scripts.rebuild_daily_stats [tenant_id]
+"""
+import asyncio
+import sys
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import select
+
+from app.db import SessionLocal
+from app.models import Tenant, UserAccess, Event, TenantDailyStats
+from app.stats import DAILY_COUNTERS, utc_day
+
+
+async def main(tenant_id: Optional[int] = None):
+    rows: Dict[Tuple[int, object], Dict[str, float]] = defaultdict(lambda: dict.fromkeys(DAILY_COUNTERS, 0))
+
+    def scoped(q, col):
+        return q.where(col == tenant_id) if tenant_id is not None else q
+
+    async with SessionLocal() as s:
+        thresholds = {
+            r.id: float(r.platinum_threshold_usd or 500.0)
+            for r in (await s.execute(scoped(select(Tenant.id, Tenant.platinum_threshold_usd), Tenant.id))).all()
+        }
+        platinum = set()
+
+        res = await s.stream(scoped(
+            select(UserAccess.tenant_id, UserAccess.click_id, UserAccess.created_at, UserAccess.is_platinum),
+            UserAccess.tenant_id,
+        ))
+        async for r in res:
+            rows[(r.tenant_id, utc_day(r.created_at))]["new_users"] += 1
+            if r.is_platinum:
+                platinum.add((r.tenant_id, r.click_id))
+
+        # события по пользователю в хронологическом порядке: первая регистрация,
+        # депозиты и момент, когда накопленная сумма перешла порог Platinum
+        registered = set()
+        cum: Dict[Tuple[int, str], float] = defaultdict(float)
+        res = await s.stream(scoped(
+            select(Event.tenant_id, Event.click_id, Event.kind, Event.amount, Event.created_at)
+            .where(Event.kind.in_(("reg", "ftd", "rd")))
+            .order_by(Event.id),
+            Event.tenant_id,
+        ))
+        async for e in res:
+            if e.tenant_id is None:
+                continue
+            key = (e.tenant_id, e.click_id)
+            day = rows[(e.tenant_id, utc_day(e.created_at))]
+            if e.kind == "reg":
+                if key not in registered:
+                    registered.add(key)
+                    day["registrations"] += 1
+                continue
+            day["ftds" if e.kind == "ftd" else "redeposits"] += 1
+            amt = float(e.amount or 0.0)
+            day["deposit_sum"] += amt
+            thr = thresholds.get(e.tenant_id, 500.0)
+            if key in platinum and cum[key] < thr <= cum[key] + amt:
+                day["platinum_upgrades"] += 1
+            cum[key] += amt
+
+        q = TenantDailyStats.__table__.delete()
+        if tenant_id is not None:
+            q = q.where(TenantDailyStats.tenant_id == tenant_id)
+        await s.execute(q)
+        if rows:
+            await s.execute(
+                TenantDailyStats.__table__.insert(),
+                [{"tenant_id": tid, "day": day, **vals} for (tid, day), vals in rows.items()],
+            )
+        await s.commit()
+    print(f"Готово. Дней: {len(rows)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else None))
@@ -0,0 +1,50 @@
+# scripts/rebuild_deposit_totals.py
+"""
+Пересобирает user_access.deposit_total / deposit_count из events (ftd + rd).
+Запуск:  python -m scripts.rebuild_deposit_totals [tenant_id]
+"""
+import asyncio
+import sys
+from typing import Optional
+
+from sqlalchemy import select, func
+
+from app.db import SessionLocal
+from app.models import UserAccess, Event
+
+
+async def main(tenant_id: Optional[int] = None):
+    ev = (
+        select(
+            Event.tenant_id,
+            Event.click_id,
+            func.coalesce(func.sum(Event.amount), 0.0).label("total"),
+            func.count().label("cnt"),
+        )
+        .where(Event.kind.in_(("ftd", "rd")))
+        .group_by(Event.tenant_id, Event.click_id)
+    )
+    ua = select(UserAccess.id, UserAccess.tenant_id, UserAccess.click_id,
+                UserAccess.deposit_total, UserAccess.deposit_count)
+    if tenant_id is not None:
+        ev = ev.where(Event.tenant_id == tenant_id)
+        ua = ua.where(UserAccess.tenant_id == tenant_id)
+
+    fixed = 0
+    async with SessionLocal() as s:
+        sums = {(r.tenant_id, r.click_id): (float(r.total), int(r.cnt)) for r in (await s.execute(ev)).all()}
+        for row in (await s.execute(ua)).all():
+            total, cnt = sums.get((row.tenant_id, row.click_id), (0.0, 0))
+            if abs(float(row.deposit_total or 0.0) - total) > 1e-9 or int(row.deposit_count or 0) != cnt:
+                await s.execute(
+                    UserAccess.__table__.update()
+                    .where(UserAccess.id == row.id)
+                    .values(deposit_total=total, deposit_count=cnt)
+                )
+                fixed += 1
+        await s.commit()
+    print(f"Готово. Исправлено: {fixed}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else None))
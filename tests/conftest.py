@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+# до импорта app: приложение создаёт engine по DATABASE_URL при импорте app.db
+_DB = os.path.join(tempfile.mkdtemp(prefix="saas-tests-"), "test.db")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{_DB}"
@@ -0,0 +1,13 @@
+from datetime import datetime
+
+from app.bots.child.broadcast import parse_send_at
+from app.settings import settings
+
+
+def test_day_month_without_year_picks_nearest_valid_date(monkeypatch):
+    monkeypatch.setattr(settings, "BC_TZ", "UTC")
+    now = datetime(2026, 10, 17, 12, 0)
+    assert parse_send_at("29.02 10:00", now) == datetime(2028, 2, 29, 10, 0)   # ближайший високосный
+    assert parse_send_at("17.10 13:00", now) == datetime(2026, 10, 17, 13, 0)
+    assert parse_send_at("17.10 11:00", now) == datetime(2027, 10, 17, 11, 0)  # уже прошло — через год
+    assert parse_send_at("31.02 10:00", now) is None
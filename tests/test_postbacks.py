@@ -0,0 +1,202 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+from starlette.requests import Request
+
+from app.db import SessionLocal, init_db
+from app.models import Event, PostbackDedup, PushJob, Tenant, UserAccess
+from app.settings import settings
+from app.web.postbacks import _push_next_screen, pp_batch, pp_ftd, pp_rd, pp_reg
+
+# база одна на все тесты (conftest): у каждого теста свой click_id
+
+
+async def _setup(click_id="clk-1", user_id=100):
+    await init_db()
+    async with SessionLocal() as s:
+        if await s.get(Tenant, 1) is None:
+            s.add(Tenant(id=1, owner_telegram_id=1, pb_secret="s3cret"))
+        s.add(UserAccess(tenant_id=1, user_id=user_id, click_id=click_id))
+        await s.commit()
+
+
+async def _reg(secret, click_id="clk-1"):
+    return await pp_reg(click_id=click_id, trader_id=None, tid=None, secret=secret)
+
+
+async def _deposit(kind, click_id, sumdep, txn_id=None):
+    endpoint = pp_ftd if kind == "ftd" else pp_rd
+    return await endpoint(click_id=click_id, sumdep=sumdep, sum_alt=None, amount_alt=None,
+                          trader_id=None, txn_id=txn_id, txn_alt=None, tid=None, secret="s3cret")
+
+
+async def _batch(items):
+    body = json.dumps(items).encode()
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    return await pp_batch(Request({"type": "http", "method": "POST", "headers": []}, receive))
+
+
+async def _state(click_id="clk-1"):
+    async with SessionLocal() as s:
+        registered = (await s.execute(
+            select(UserAccess.is_registered).where(UserAccess.click_id == click_id)
+        )).scalar_one()
+        kinds = (await s.execute(select(Event.kind).where(Event.click_id == click_id))).scalars().all()
+    return registered, kinds
+
+
+async def _deposits(click_id):
+    async with SessionLocal() as s:
+        return (await s.execute(
+            select(UserAccess.deposit_total, UserAccess.deposit_count).where(UserAccess.click_id == click_id)
+        )).one()
+
+
+def test_non_ascii_secret_is_rejected():
+    async def run():
+        await _setup()
+        resp = await _reg("сек рет")
+        return resp, await _state()
+
+    resp, (registered, kinds) = asyncio.run(run())
+    assert resp == {"status": "error", "message": "bad_secret"}
+    assert not registered
+    assert kinds == ["reg_bad"]   # неудачная попытка записана
+
+
+def test_push_for_deleted_user_or_tenant_is_dropped():
+    async def run():
+        await init_db()
+        async with SessionLocal() as s:
+            orphan = UserAccess(tenant_id=404, user_id=404, click_id="clk-orphan")
+            s.add(orphan)
+            await s.commit()
+            orphan_id = orphan.id
+        # ни исключения (повтор), ни отправки: задача просто снимается
+        await _push_next_screen(10 ** 9)
+        await _push_next_screen(orphan_id)
+
+    asyncio.run(run())
+
+
+def test_duplicate_reg_is_applied_once():
+    async def run():
+        await _setup("clk-dup-reg", 101)
+        first = await _reg("s3cret", "clk-dup-reg")
+        second = await _reg("s3cret", "clk-dup-reg")
+        return first, second, await _state("clk-dup-reg")
+
+    first, second, (registered, kinds) = asyncio.run(run())
+    assert first["status"] == "ok" and "duplicate" not in first
+    assert second == {**first, "duplicate": True}   # сохранённый ответ первого
+    assert registered
+    assert kinds == ["reg"]
+
+
+def test_same_txn_id_is_applied_once():
+    async def run():
+        await _setup("clk-same-txn", 102)
+        await _deposit("ftd", "clk-same-txn", "50", txn_id="t-1")
+        again = await _deposit("ftd", "clk-same-txn", "50", txn_id="t-1")
+        return again, await _deposits("clk-same-txn")
+
+    again, (total, count) = asyncio.run(run())
+    assert again["duplicate"] is True
+    assert (total, count) == (50.0, 1)
+
+
+def test_different_txn_ids_with_same_amount_are_both_applied():
+    async def run():
+        await _setup("clk-two-txn", 103)
+        a = await _deposit("rd", "clk-two-txn", "25", txn_id="t-1")
+        b = await _deposit("rd", "clk-two-txn", "25", txn_id="t-2")
+        return a, b, await _deposits("clk-two-txn")
+
+    a, b, (total, count) = asyncio.run(run())
+    assert "duplicate" not in a and "duplicate" not in b
+    assert (total, count) == (50.0, 2)
+
+
+def test_expired_dedup_key_is_claimed_again():
+    async def run():
+        await _setup("clk-expired", 104)
+        await _deposit("rd", "clk-expired", "10", txn_id="t-1")
+        # окно прошло: ключ остаётся в таблице до чистки, но уже не блокирует
+        async with SessionLocal() as s:
+            await s.execute(
+                PostbackDedup.__table__.update().where(PostbackDedup.kind == "rd")
+                .values(created_at=datetime.utcnow() - timedelta(days=2))
+            )
+            await s.commit()
+        again = await _deposit("rd", "clk-expired", "10", txn_id="t-1")
+        return again, await _deposits("clk-expired")
+
+    again, (total, count) = asyncio.run(run())
+    assert "duplicate" not in again
+    assert (total, count) == (20.0, 2)
+
+
+def test_batch_reports_each_item():
+    async def run():
+        await _setup("clk-b1", 201)
+        reg = {"kind": "reg", "click_id": "clk-b1", "secret": "s3cret"}
+        first = await _batch([
+            reg,
+            reg,                                                         # повтор внутри батча
+            {"kind": "ftd", "click_id": "clk-b1", "secret": "wrong", "sumdep": "5"},
+            {"kind": "reg", "click_id": "clk-missing", "secret": "s3cret"},
+            {"kind": "refund", "click_id": "clk-b1", "secret": "s3cret"},
+            "not an object",
+        ])
+        again = await _batch([reg])                                      # уже применён раньше
+        return first, again, await _state("clk-b1")
+
+    first, again, (registered, kinds) = asyncio.run(run())
+    assert first["status"] == "ok" and first["count"] == 6
+    ok, dup, bad, nf, bad_kind, bad_type = first["results"]
+    assert ok["status"] == "ok" and ok["kind"] == "reg" and "duplicate" not in ok
+    assert dup == {**ok, "duplicate": True}
+    assert bad == {"status": "error", "message": "bad_secret", "click_id": "clk-b1"}
+    assert nf == {"status": "not_found", "click_id": "clk-missing"}
+    assert bad_kind == bad_type == {"status": "error", "message": "bad_item"}
+    assert again["results"] == [{**ok, "duplicate": True}]
+    assert registered
+    assert sorted(kinds) == ["ftd_bad", "reg"]
+
+
+def test_batch_collapses_items_of_one_user():
+    async def run():
+        await _setup("clk-b2", 202)
+        resp = await _batch([
+            {"kind": "reg", "click_id": "clk-b2", "secret": "s3cret"},
+            {"kind": "ftd", "click_id": "clk-b2", "secret": "s3cret", "sumdep": "100", "txn_id": "t-1"},
+            {"kind": "rd", "click_id": "clk-b2", "secret": "s3cret", "sum": "50", "txn_id": "t-2"},
+            {"kind": "rd", "click_id": "clk-b2", "secret": "s3cret", "amount": "25", "txn_id": "t-3"},
+        ])
+        async with SessionLocal() as s:
+            ua = (await s.execute(select(UserAccess).where(UserAccess.click_id == "clk-b2"))).scalar_one()
+            jobs = (await s.execute(
+                select(func.count()).select_from(PushJob).where(PushJob.ua_id == ua.id)
+            )).scalar_one()
+        return resp, ua, jobs, await _state("clk-b2")
+
+    resp, ua, jobs, (_, kinds) = asyncio.run(run())
+    assert [r["status"] for r in resp["results"]] == ["ok"] * 4
+    assert [r.get("amount") for r in resp["results"]] == [None, 100.0, 50.0, 25.0]
+    # у всех элементов одно итоговое состояние пользователя
+    assert all(r["state"] == resp["results"][-1]["state"] for r in resp["results"])
+    assert ua.is_registered and ua.has_deposit
+    assert (ua.deposit_total, ua.deposit_count, ua.total_deposits) == (175.0, 3, 3)
+    assert jobs == 1                      # один пуш итогового экрана
+    assert sorted(kinds) == ["ftd", "rd", "rd", "reg"]
+
+
+def test_batch_over_limit_is_rejected(monkeypatch):
+    monkeypatch.setattr(settings, "PP_BATCH_MAX", 2)
+    items = [{"kind": "reg", "click_id": "clk-b3", "secret": "s3cret"}] * 3
+    assert asyncio.run(_batch(items)) == {"status": "error", "message": "too_many", "max": 2}
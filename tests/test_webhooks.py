@@ -0,0 +1,28 @@
+import asyncio
+
+from app.settings import settings
+from app.web.webhooks import make_webhook_app
+
+
+class _Engine:
+    def get_bot(self, tenant_id):
+        return object()
+
+    def secret_for(self, tenant_id):
+        return "s3cret"
+
+
+def _endpoint():
+    app = make_webhook_app(_Engine())
+    path = settings.webhook_prefix(0) + "/{tenant_id}"
+    return next(r.endpoint for r in app.routes if getattr(r, "path", None) == path)
+
+
+def test_non_ascii_secret_is_rejected():
+    resp = asyncio.run(_endpoint()(tenant_id=1, request=None, secret="сек рет"))
+    assert resp.status_code == 403
+
+
+def test_wrong_secret_is_rejected():
+    resp = asyncio.run(_endpoint()(tenant_id=1, request=None, secret="nope"))
+    assert resp.status_code == 403